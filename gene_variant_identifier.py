@@ -1,12 +1,12 @@
 #!/usr/bin/env ./venv/bin/python
 
 import sys
-from PyQt5.QtWidgets import QFileDialog
-from PyQt5 import QtWidgets
-from PyQt5.QtCore import QCoreApplication
+import argparse
+import datetime
 from contexttimer import Timer
 
 from lib import GeneVariantIdentifier
+from lib import profiling
 
 
 def run(pool_root):
@@ -17,6 +17,10 @@ def run(pool_root):
         print(outfile)
 
 def get_pool_root():
+    from PyQt5.QtWidgets import QFileDialog
+    from PyQt5 import QtWidgets
+    from PyQt5.QtCore import QCoreApplication
+
     app = QtWidgets.QApplication(sys.argv)
     options = QFileDialog.Options()
     qfd = QFileDialog()
@@ -27,9 +31,26 @@ def get_pool_root():
     QCoreApplication.processEvents()
     return pool_root
 
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pool_root', nargs='?', help='pool directory, picked in a dialog if not given')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='DIR',
+                        help='profile each stage into DIR, <pool_root>.profile.<timestamp> by default')
+    parser.add_argument('--top', type=int, default=profiling.DEFAULT_TOP, help='hotspots listed after profiling')
+    return parser.parse_args()
+
 if __name__ == '__main__':
-    pool_root = get_pool_root()
+    args = parse_args()
+    pool_root = args.pool_root or get_pool_root()
     if pool_root:
-        run(pool_root)
-
-
+        if args.profile is not None:
+            now = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')
+            profile_dir = args.profile or f'{pool_root.rstrip("/")}.profile.{now}'
+            profiling.enable(profile_dir)
+            try:
+                run(pool_root)
+            finally:
+                print(profiling.summarise(profile_dir, top=args.top))
+                profiling.disable()
+        else:
+            run(pool_root)
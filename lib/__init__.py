@@ -1,7 +1,11 @@
 from .gene_variant_identifier import GeneVariantIdentifier
+from . import backends
 from . import exporters
 from . import filters
 from . import importers
+from . import incremental
+from . import results
+from . import sharding
 from . import utils
 
-__all__ = ['GeneVariantIdentifier', 'exporters', 'filters', 'importers', 'utils']
+__all__ = ['GeneVariantIdentifier', 'backends', 'exporters', 'filters', 'importers', 'incremental', 'results', 'sharding', 'utils']
@@ -0,0 +1,259 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+from contexttimer import Timer
+
+from lib import utils, columns as c
+
+# parsed intervals are cached next to the annotation file, keyed by its size & mtime
+CACHE_SUFFIX = '.intervals.npz'
+
+GFF3 = 'gff3'
+GTF = 'gtf'
+BED = 'bed'
+
+FORMATS = {
+    '.gff': GFF3,
+    '.gff3': GFF3,
+    '.gtf': GTF,
+    '.bed': BED
+}
+
+COMPRESSED_EXTENSIONS = {'.gz', '.bz2'}
+
+BED_COLUMNS = 12
+
+GENE_FEATURES = {'gene'}
+
+CHROMO_PREFIX_REGEX = re.compile(r'^chr', re.I)
+GFF3_ID_REGEX = re.compile(r'(?:^|;)\s*ID=(?:gene:)?([^;]+)')
+GTF_GENE_ID_REGEX = re.compile(r'gene_id "([^"]+)"')
+
+
+def annotation_format(path):
+    root, ext = os.path.splitext(path.lower())
+    if ext in COMPRESSED_EXTENSIONS:
+        root, ext = os.path.splitext(root)
+    return FORMATS.get(ext)
+
+
+def normalize_chromosome(chromo):
+    """ 'Chr1', 'chr1' & '1' all name the same chromosome """
+    return CHROMO_PREFIX_REGEX.sub('', str(chromo)).lower()
+
+
+class IntervalAnnotation(object):
+    """
+    Assigns `column` (gene_id or custom_int_id) to the rows it's missing from by the interval of a GFF3, GTF or
+    BED file their position falls in. GFF3/GTF files give gene intervals, named by gene id, BED files any named
+    intervals. Coordinates are 1-based & inclusive, like the positions they're matched against.
+
+    Intervals are kept sorted by start per chromosome & looked up with a binary search per row. A running
+    maximum of their ends tells whether a position is covered by any interval starting before it, & a table of
+    maximum ends over the preceding 2^k intervals finds the latest starting one that covers it in log steps,
+    however deeply intervals nest. The parsed index is cached to disk, so later runs only have to map it.
+    """
+
+    def __init__(self, path, column=c.gene_id):
+        self.path = os.path.abspath(path)
+        self.column = column
+        self.format = annotation_format(path)
+
+        if self.format is None:
+            raise RuntimeError(
+                f"Annotation file '{path}' not recognized.\n"
+                f"Must be one of {sorted(FORMATS.keys())}, optionally compressed"
+            )
+
+        self._index = None
+
+    def __getstate__(self):
+        # worker processes map the cached index themselves rather than being sent it
+        state = self.__dict__.copy()
+        state['_index'] = None
+        return state
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self.load()
+        return self._index
+
+    def load(self):
+        with Timer(factor=1000) as t:
+            signature = np.array(utils.file_signature(self.path), dtype=np.int64)
+            cache_file = self.path + CACHE_SUFFIX
+
+            index = None
+
+            if os.path.isfile(cache_file):
+                # noinspection PyBroadException
+                try:
+                    with np.load(cache_file) as cached:
+                        if np.array_equal(cached['signature'], signature):
+                            index = {key: cached[key] for key in cached.files if key != 'signature'}
+                except Exception:
+                    pass
+
+            if index is None:
+                index = self.build(self.parse())
+                try:
+                    tmp_file = f'{cache_file}.{os.getpid()}.tmp.npz'
+                    np.savez(tmp_file, signature=signature, **index)
+                    os.replace(tmp_file, cache_file)
+                except OSError as e:
+                    print(f'warning: unable to cache annotation intervals to {cache_file}: {e}')
+
+            index['lookup'] = {chromo: i for i, chromo in enumerate(index['chromosomes'].tolist())}
+            index['skips'] = self.skips(index)
+
+            print("loading annotation {} took {}.ms".format(self.path, round(t.elapsed, 1)))
+
+        return index
+
+    def parse(self):
+        """ DataFrame of chromo, start, end & name, 1-based inclusive """
+        if self.format == BED:
+            # BED has 3 to 12 columns, & track/browser lines just the one
+            df = pd.read_csv(self.path, sep='\t', header=None, comment='#', dtype=str, names=range(BED_COLUMNS))
+            df = df[~df[0].str.startswith(('track', 'browser'))]
+            df = pd.DataFrame({
+                'chromo': df[0],
+                'start': df[1].astype(np.int64) + 1,
+                'end': df[2].astype(np.int64),
+                'name': df[3]
+            })
+            unnamed = df['name'].isna()
+            df.loc[unnamed, 'name'] = df['chromo'][unnamed] + ':' + df['start'][unnamed].astype(str) + '-' + \
+                df['end'][unnamed].astype(str)
+            return df
+
+        df = pd.read_csv(self.path, sep='\t', header=None, comment='#', usecols=[0, 2, 3, 4, 8], dtype={0: str},
+                         names=['chromo', 'feature', 'start', 'end', 'attributes'])
+
+        if self.format == GFF3:
+            df = df[df['feature'].isin(GENE_FEATURES)]
+            df['name'] = df['attributes'].str.extract(GFF3_ID_REGEX, expand=False)
+            return df.dropna(subset=['name'])
+
+        df['name'] = df['attributes'].str.extract(GTF_GENE_ID_REGEX, expand=False)
+        df = df.dropna(subset=['name'])
+
+        genes = df[df['feature'].isin(GENE_FEATURES)]
+
+        if len(genes):
+            return genes
+
+        # no gene records, so span each gene's transcripts & exons
+        return df.groupby(['chromo', 'name'], sort=False).agg({'start': 'min', 'end': 'max'}).reset_index()
+
+    @staticmethod
+    def build(df):
+        df = df.assign(chromo=df['chromo'].map(normalize_chromosome)).sort_values(['chromo', 'start'], kind='mergesort')
+
+        chromosomes, offsets = np.unique(df['chromo'].values.astype(str), return_index=True)
+
+        starts = df['start'].values.astype(np.int64)
+        ends = df['end'].values.astype(np.int64)
+
+        max_ends = ends.copy()
+        for lo, hi in zip(offsets, [*offsets[1:], len(df)]):
+            max_ends[lo:hi] = np.maximum.accumulate(ends[lo:hi])
+
+        return {
+            'chromosomes': chromosomes,
+            'offsets': np.append(offsets, len(df)).astype(np.int64),
+            'starts': starts,
+            'ends': ends,
+            'max_ends': max_ends,
+            'names': df['name'].values.astype(str)
+        }
+
+    @staticmethod
+    def skips(index):
+        """
+        skips[k][i] is the maximum end of intervals i - 2^k + 1 to i, for as many k as it takes to step back over
+        the most intervals starting within another one's span
+        """
+        offsets, starts, ends = index['offsets'], index['starts'], index['ends']
+
+        depth = 0
+        for lo, hi in zip(offsets[:-1], offsets[1:]):
+            if hi > lo:
+                within = np.searchsorted(starts[lo:hi], ends[lo:hi], side='right') - 1 - np.arange(hi - lo)
+                depth = max(depth, int(within.max()))
+
+        skips = [ends]
+        while (1 << len(skips)) <= depth:
+            step = 1 << (len(skips) - 1)
+            previous = skips[-1]
+            skips.append(np.maximum(previous, np.concatenate([previous[:step], previous[:-step]])))
+
+        return skips
+
+    def lookup(self, chromos, positions):
+        """ Position in the index of the interval each (chromo, position) falls in, -1 where there's none """
+        index = self.index
+        starts, ends, max_ends = index['starts'], index['ends'], index['max_ends']
+
+        positions = np.asarray(positions, dtype=np.int64)
+        hits = np.full(len(positions), -1, dtype=np.int64)
+
+        chromo_codes, chromo_values = pd.factorize(chromos)
+
+        for i, chromo in enumerate(chromo_values):
+            k = index['lookup'].get(normalize_chromosome(chromo))
+            if k is None:
+                continue
+
+            lo, hi = index['offsets'][k], index['offsets'][k + 1]
+            rows = np.flatnonzero(chromo_codes == i)
+            pos = positions[rows]
+
+            # last interval starting at or before each position
+            j = np.searchsorted(starts[lo:hi], pos, side='right') - 1 + lo
+            candidates = (j >= lo) & (max_ends[np.maximum(j, lo)] >= pos)
+
+            direct = candidates & (ends[np.maximum(j, lo)] >= pos)
+            hits[rows[direct]] = j[direct]
+
+            # the latest starting interval ends too early, but an earlier, longer one covers the position, so step
+            # back over runs of intervals that all end too early, longest runs first
+            covered = candidates & ~direct
+            jj, p = j[covered], pos[covered]
+            for k in reversed(range(len(index['skips']))):
+                jj = np.where(index['skips'][k][jj] < p, jj - (1 << k), jj)
+            hits[rows[covered]] = jj
+
+        return hits
+
+    def annotate(self, df):
+        """ Fill `column` in where it's missing (NaN or empty), adding the column if need be """
+        if df is None or df.empty or c.chromo not in df.columns or c.pos not in df.columns:
+            return df
+
+        if self.column in df.columns:
+            values = df[self.column]
+            missing = (values.isna() | (values.astype(str) == c.OBJECT_DEFAULT)).values
+        else:
+            missing = np.ones(len(df), dtype=bool)
+
+        if not missing.any():
+            return df
+
+        hits = np.full(len(df), -1, dtype=np.int64)
+        hits[missing] = self.lookup(df[c.chromo].values[missing], df[c.pos].values[missing])
+
+        found = hits >= 0
+
+        if self.column in df.columns:
+            values = df[self.column].values.astype(object)
+        else:
+            values = np.full(len(df), c.COLUMNS[self.column].na_fill, dtype=object)
+
+        values[found] = self.index['names'][hits[found]]
+
+        df[self.column] = values
+
+        return df
@@ -0,0 +1,38 @@
+"""
+Build an annotation file's interval cache ahead of a run, or look positions up in it:
+
+    python -m lib.annotations build genes.gff3
+    python -m lib.annotations lookup genes.gff3 chr1:12345 chr2:678
+"""
+import argparse
+
+from lib.annotations import IntervalAnnotation
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m lib.annotations')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    build = commands.add_parser('build', help='parse & cache the intervals of an annotation file')
+    build.add_argument('annotation')
+
+    lookup = commands.add_parser('lookup', help='print the interval each chromo:pos falls in')
+    lookup.add_argument('annotation')
+    lookup.add_argument('positions', nargs='+')
+
+    args = parser.parse_args()
+
+    annotation = IntervalAnnotation(args.annotation)
+
+    if args.command == 'build':
+        print(f"{len(annotation.index['names'])} intervals on {len(annotation.index['chromosomes'])} chromosomes")
+    elif args.command == 'lookup':
+        chromos, positions = zip(*(position.rsplit(':', 1) for position in args.positions))
+        hits = annotation.lookup(list(chromos), [int(p) for p in positions])
+        for position, hit in zip(args.positions, hits):
+            print(position, annotation.index['names'][hit] if hit >= 0 else '-')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+from .sqlite_backend import SqliteBackend
+
+__all__ = ['SqliteBackend']
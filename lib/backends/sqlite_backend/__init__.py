@@ -0,0 +1,323 @@
+import os
+import sqlite3
+import tempfile
+import pandas as pd
+from natsort import natsorted
+from contexttimer import Timer
+
+from lib.gene_variant_identifier import POOL_SORT, SUMMARY_SORTS
+from lib import columns as c
+
+# rows per chunk streamed into the database and per batch streamed out to the exporter
+BATCH_SIZE = 50000
+
+VARIANTS = 'variants'
+FLAGGED_GENES = 'flagged_genes'
+SITE_HITS = 'site_hits'
+POOL_SITE_HITS = 'pool_site_hits'
+GENE_HITS = 'gene_hits'
+ANNOTATED = 'annotated'
+
+INDEXES = {
+    'variants_site': [c.chromo, c.pos],
+    'variants_pool_site': [c.pool, c.chromo, c.pos],
+    'variants_gene': [c.gene_id]
+}
+
+
+def _q(identifier):
+    """ Quote a column/table name, flagged gene sheet names can be anything """
+    return '"{}"'.format(str(identifier).replace('"', '""'))
+
+
+def _literal(value):
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def _cols(columns, table=None):
+    prefix = f'{table}.' if table else ''
+    return ', '.join(prefix + _q(col) for col in columns)
+
+
+class SqliteBackend(object):
+    """
+    Out-of-core alternative to GeneVariantIdentifier.load_dataframes/analyse: imports are streamed into an
+    embedded SQLite database and the hit columns & sheets are computed there with SQL aggregations.
+    """
+
+    def __init__(self, gvi, db_path=None):
+        self.gvi = gvi
+        self._temporary = not db_path
+
+        if self._temporary:
+            fd, db_path = tempfile.mkstemp(prefix='gvi_', suffix='.sqlite')
+            os.close(fd)
+
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode = OFF')
+        self.conn.execute('PRAGMA synchronous = OFF')
+
+        self._columns = []
+        self._flagged_columns = []
+        self._hit_columns = []
+
+    def close(self):
+        self.conn.close()
+        if self._temporary:
+            os.remove(self.db_path)
+
+    def apply(self):
+        try:
+            self.load()
+
+            self.analyse()
+
+            with Timer(factor=1000) as t:
+                outfile = self.gvi.exporter.export_batches(self.sheets())
+                print("xlsx export took {}.ms total".format(round(t.elapsed, 1)))
+
+            if self.gvi.sampler:
+                self.gvi.report_preview()
+        finally:
+            self.close()
+
+        return outfile
+
+    def load(self):
+        with Timer(factor=1000) as t:
+            self.conn.execute(f'DROP TABLE IF EXISTS {VARIANTS}')
+
+            for (pool_dir, filename), loader in self.gvi.loader_map.items():
+                try:
+                    for df in loader.iter_dataframes(pool_dir, filename, BATCH_SIZE):
+                        self.append(df)
+                except Exception as exc:
+                    raise RuntimeError(
+                        '%r generated an exception while loading %r/%r: %s' % (
+                            type(loader).__name__, pool_dir, filename, exc)
+                    ) from exc
+
+            if not self._columns:
+                raise RuntimeError(f"No variants imported from {self.gvi.pool_root}.")
+
+            for name, columns in INDEXES.items():
+                if all(col in self._columns for col in columns):
+                    self.conn.execute(f'CREATE INDEX {name} ON {VARIANTS} ({_cols(columns)})')
+
+            self.conn.commit()
+
+            self.gvi.data_filter.save_stats()
+
+            print("pool imports took {}.ms total".format(round(t.elapsed, 1)))
+
+    def append(self, df):
+        if df is None or df.empty:
+            return
+
+        for col in df.columns:
+            if df[col].dtype.name == c.CATEGORY:
+                df[col] = df[col].astype(c.OBJECT)
+
+        if self._columns:
+            # importers don't all produce the same columns when nothing is selected
+            for col in df.columns:
+                if col not in self._columns:
+                    self.conn.execute(f'ALTER TABLE {VARIANTS} ADD COLUMN {_q(col)}')
+                    self._columns.append(col)
+        else:
+            self._columns = list(df.columns)
+
+        df.to_sql(VARIANTS, self.conn, if_exists='append', index=False)
+
+    def analyse(self):
+        with Timer(factor=1000) as t:
+            self.add_flagged_genes()
+
+            self.conn.executescript(f'''
+                DROP TABLE IF EXISTS {SITE_HITS};
+                CREATE TABLE {SITE_HITS} AS
+                    SELECT {_cols([c.chromo, c.pos])}, COUNT(DISTINCT {_q(c.pool)}) - 1 AS {_q(c.background)}
+                    FROM {VARIANTS} GROUP BY {_cols([c.chromo, c.pos])};
+                CREATE UNIQUE INDEX {SITE_HITS}_site ON {SITE_HITS} ({_cols([c.chromo, c.pos])});
+
+                DROP TABLE IF EXISTS {POOL_SITE_HITS};
+                CREATE TABLE {POOL_SITE_HITS} AS
+                    SELECT {_cols([c.pool, c.chromo, c.pos])}, COUNT(DISTINCT {_q(c.sample)}) - 1 AS {_q(c.cand_pos)}
+                    FROM {VARIANTS} GROUP BY {_cols([c.pool, c.chromo, c.pos])};
+                CREATE UNIQUE INDEX {POOL_SITE_HITS}_site ON {POOL_SITE_HITS} ({_cols([c.pool, c.chromo, c.pos])});
+
+                DROP TABLE IF EXISTS {GENE_HITS};
+                CREATE TABLE {GENE_HITS} AS
+                    SELECT {_q(c.gene_id)},
+                        COUNT(DISTINCT {_q(c.sample)}) - 1 AS {_q(c.cand_gene)},
+                        {self._hom_ratio_sql()}
+                    FROM {VARIANTS} WHERE {_q(c.gene_id)} IS NOT NULL GROUP BY {_q(c.gene_id)};
+                CREATE UNIQUE INDEX {GENE_HITS}_gene ON {GENE_HITS} ({_q(c.gene_id)});
+            ''')
+
+            self.add_stored_background()
+
+            self.create_annotated_view()
+
+            print("mutation analysis took {}.ms".format(round(t.elapsed, 1)))
+
+    def add_flagged_genes(self):
+        self._flagged_columns = []
+
+        self.conn.execute(f'DROP TABLE IF EXISTS {FLAGGED_GENES}')
+
+        if not self.gvi.flagged_genes_loader:
+            return
+
+        flagged_genes = self.gvi.flagged_genes_loader.load()
+
+        if (isinstance(flagged_genes, type(None))) or not len(flagged_genes):
+            return
+
+        flagged_genes.to_sql(FLAGGED_GENES, self.conn, index=True, index_label=c.gene_id)
+        self.conn.execute(f'CREATE UNIQUE INDEX {FLAGGED_GENES}_gene ON {FLAGGED_GENES} ({_q(c.gene_id)})')
+
+        self._flagged_columns = list(flagged_genes.columns)
+
+    def add_stored_background(self):
+        store = self.gvi.background_store
+
+        if not store:
+            return
+
+        source = os.path.abspath(self.gvi.pool_root)
+
+        cursor = self.conn.execute(f'SELECT rowid, {_cols([c.chromo, c.pos])} FROM {SITE_HITS}')
+
+        stored = []
+
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            df = pd.DataFrame.from_records(rows, columns=['rowid', c.chromo, c.pos])
+            stored.extend((rowid,) for rowid in df['rowid'][store.contains(df[c.chromo], df[c.pos], exclude_source=source)].tolist())
+
+        self.conn.executemany(
+            f'UPDATE {SITE_HITS} SET {_q(c.background)} = {_q(c.background)} + 1 WHERE rowid = ?', stored
+        )
+
+    def _hom_ratio_sql(self):
+        self._hit_columns = [c.background, c.cand_pos, c.cand_gene]
+
+        hom_label = self.gvi.hom_label
+
+        hom = self.conn.execute(
+            f'SELECT 1 FROM {VARIANTS} WHERE {_q(c.hh)} = ? LIMIT 1', (hom_label,)
+        ).fetchone()
+
+        if not hom:
+            print(f'{hom_label} not found in {c.hh} values')
+            return f'NULL AS {_q(c.cand_gene_hom_ratio)}'
+
+        self._hit_columns.append(c.cand_gene_hom_ratio)
+
+        # percentage of total that are Homo, genes without hh values get the column's na_fill
+        return (
+            f'COALESCE(SUM({_q(c.hh)} = {_literal(hom_label)}) * 1.0 / COUNT({_q(c.hh)}), '
+            f'{c.FLOAT64_DEFAULT}) AS {_q(c.cand_gene_hom_ratio)}'
+        )
+
+    def create_annotated_view(self):
+        flagged_cols = ', '.join(
+            f'COALESCE(f.{_q(col)}, 0) AS {_q(col)}' for col in self._flagged_columns
+        )
+        flagged_join = f'LEFT JOIN {FLAGGED_GENES} f ON f.{_q(c.gene_id)} = v.{_q(c.gene_id)}'
+        hit_tables = {c.background: 's', c.cand_pos: 'p', c.cand_gene: 'g', c.cand_gene_hom_ratio: 'g'}
+        hit_cols = ', '.join(f'{hit_tables[col]}.{_q(col)}' for col in self._hit_columns)
+
+        self.conn.executescript(f'''
+            DROP VIEW IF EXISTS {ANNOTATED};
+            CREATE VIEW {ANNOTATED} AS
+                SELECT {_cols(self._columns, 'v')},
+                    {flagged_cols + ',' if flagged_cols else ''}
+                    {hit_cols}
+                FROM {VARIANTS} v
+                {flagged_join if flagged_cols else ''}
+                JOIN {SITE_HITS} s ON s.{_q(c.chromo)} = v.{_q(c.chromo)} AND s.{_q(c.pos)} = v.{_q(c.pos)}
+                JOIN {POOL_SITE_HITS} p
+                    ON p.{_q(c.pool)} = v.{_q(c.pool)} AND p.{_q(c.chromo)} = v.{_q(c.chromo)}
+                    AND p.{_q(c.pos)} = v.{_q(c.pos)}
+                JOIN {GENE_HITS} g ON g.{_q(c.gene_id)} = v.{_q(c.gene_id)};
+        ''')
+
+    def sheets(self):
+        """ Lazily evaluated batches of every sheet, in the same order as GeneVariantIdentifier.analyse """
+        pools = natsorted(
+            row[0] for row in self.conn.execute(f'SELECT DISTINCT {_q(c.pool)} FROM {VARIANTS}')
+        )
+
+        sheets = {pool: self.pool_batches(pool) for pool in pools}
+
+        summaries = {
+            c.background: f'{_q(c.background)} > 0',
+            c.cand_pos: f'{_q(c.cand_pos)} > 0 AND {_q(c.background)} = 0',
+            c.cand_gene: f'{_q(c.cand_gene)} > 0 AND {_q(c.background)} = 0'
+        }
+
+        if self._flagged_columns:
+            summaries[c.flagged_gene] = f'{_q(c.flagged_gene)} > 0 AND {_q(c.background)} = 0'
+
+        for col, where in summaries.items():
+            sort = SUMMARY_SORTS[col]
+            limit = f' LIMIT {int(self.gvi.summary_top)}' if self.gvi.summary_top else ''
+            sheets[c.COLUMNS[col].title] = self._batches(
+                f'SELECT * FROM {ANNOTATED} WHERE {where} ORDER BY {self._order_by(**sort)}{limit}'
+            )
+
+        return sheets
+
+    def pool_batches(self, pool):
+        samples = sorted(
+            row[0] for row in self.conn.execute(
+                f'SELECT DISTINCT {_q(c.sample)} FROM {VARIANTS} WHERE {_q(c.pool)} = ?', (pool,)
+            )
+        )
+
+        idx = [
+            col for col in [*self._columns, *self._flagged_columns, *self._hit_columns]
+            if col not in {c.sample, c.pool}
+        ]
+
+        # pivot_table names the sample columns (<values>, <sample>) & the only value column left is the pool
+        sample_cols = [(c.pool, sample) for sample in samples]
+
+        counts = ', '.join(
+            f'SUM({_q(c.sample)} = ?) AS {_q(sample)}' for sample in samples
+        )
+
+        return self._batches(
+            f'SELECT {_cols(idx)}, {counts} FROM {ANNOTATED} WHERE {_q(c.pool)} = ? '
+            f'GROUP BY {_cols(idx)} ORDER BY {self._order_by(**POOL_SORT)}',
+            params=(*samples, pool),
+            names=[*idx, *sample_cols]
+        )
+
+    @staticmethod
+    def _order_by(by, ascending):
+        return ', '.join(f'{_q(col)} {"ASC" if asc else "DESC"}' for col, asc in zip(by, ascending))
+
+    def _batches(self, sql, params=(), names=None):
+        bools = set(self._flagged_columns)
+
+        def batches():
+            cursor = self.conn.execute(sql, params)
+            columns = names or [d[0] for d in cursor.description]
+            rows = cursor.fetchmany(BATCH_SIZE)
+            # always yield at least one, possibly empty, batch so the sheet still gets its header
+            while True:
+                df = pd.DataFrame.from_records(rows, columns=columns)
+                for col in bools.intersection(df.columns):
+                    df[col] = df[col].astype(bool)
+                yield df
+                rows = cursor.fetchmany(BATCH_SIZE)
+                if not rows:
+                    return
+
+        return batches()
@@ -0,0 +1,241 @@
+import os
+import json
+import zlib
+import numpy as np
+import pandas as pd
+from contexttimer import Timer
+
+from lib import columns as c
+
+CHROMOSOMES_FILE = 'chromosomes.json'
+MANIFEST_FILE = 'manifest.json'
+SEGMENT_FILE = 'segment_{:05d}.npy'
+
+# segments of one source that trigger a compaction on add, each segment is one more binary search per lookup
+COMPACT_SEGMENTS = 8
+
+# key layout, high to low bits: chromosome id | position | allele code
+CHROMO_BITS = 16
+POS_BITS = 32
+ALLELE_BITS = 16
+
+ALLELE_MASK = (1 << ALLELE_BITS) - 1
+MAX_CHROMOSOMES = 1 << CHROMO_BITS
+MAX_POS = 1 << POS_BITS
+SITE_SHIFT = np.uint64(ALLELE_BITS)
+CHROMO_SHIFT = np.uint64(POS_BITS + ALLELE_BITS)
+
+
+class BackgroundStore(object):
+    """
+    Append-only store of variant sites seen in past runs, used as extra background evidence.
+
+    Sites are packed into uint64 chromosome/position/allele keys and kept as sorted, de-duplicated segments of
+    .npy files, one per import, which are memory-mapped and binary searched so nothing is read into memory
+    up front. Each segment holds the sites of one source pool root only, so a project's own sites can be left out
+    of its background, and segment files are numbered by a counter in the manifest that never goes back.
+
+    Once a source has `compact_segments` segments, adding to the store compacts it (None to leave that to the
+    compact command).
+    """
+
+    def __init__(self, path, compact_segments=COMPACT_SEGMENTS):
+        self.path = path
+        self.compact_segments = compact_segments
+
+        self.chromosomes = self._read_json(CHROMOSOMES_FILE, [])
+        self.chromosome_ids = {chromo: i for i, chromo in enumerate(self.chromosomes)}
+
+        manifest = self._read_json(MANIFEST_FILE, {'next_segment': 0, 'segments': []})
+
+        if isinstance(manifest, list):
+            # stores written before the counter, numbered from the segment count, which compaction could repeat
+            numbers = [int(entry['segment'].split('_')[1].split('.')[0]) for entry in manifest]
+            manifest = {'next_segment': max(numbers, default=-1) + 1, 'segments': manifest}
+
+        self.next_segment = manifest['next_segment']
+        self.manifest = manifest['segments']
+
+        self.segments = [
+            np.load(os.path.join(self.path, entry['segment']), mmap_mode='r')
+            for entry in self.manifest
+        ]
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def _read_json(self, filename, default):
+        filename = os.path.join(self.path, filename)
+        if not os.path.isfile(filename):
+            return default
+        with open(filename) as file:
+            return json.load(file)
+
+    def _write_json(self, filename, data):
+        # replaced whole, so an interrupted add or compaction never leaves a truncated manifest behind
+        filename = os.path.join(self.path, filename)
+        tmp_file = f'{filename}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as file:
+            json.dump(data, file, indent=2)
+        os.replace(tmp_file, filename)
+
+    def _write_manifest(self):
+        self._write_json(MANIFEST_FILE, {'next_segment': self.next_segment, 'segments': self.manifest})
+
+    def _new_segment_file(self):
+        segment_file = SEGMENT_FILE.format(self.next_segment)
+        self.next_segment += 1
+        return segment_file
+
+    def pack(self, chromos, positions, changes=None, add_chromosomes=False):
+        """ uint64 keys for each site, sites on chromosomes unknown to the store get a key that matches nothing """
+        codes, chromo_names = pd.factorize(pd.Series(chromos).astype(c.OBJECT))
+
+        if add_chromosomes:
+            new_chromos = [chromo for chromo in chromo_names if chromo not in self.chromosome_ids]
+            if len(self.chromosomes) + len(new_chromos) > MAX_CHROMOSOMES:
+                raise RuntimeError(
+                    f"Background store {self.path} can hold at most {MAX_CHROMOSOMES} chromosomes, "
+                    f"{len(self.chromosomes) + len(new_chromos)} needed"
+                )
+            for chromo in new_chromos:
+                self.chromosome_ids[chromo] = len(self.chromosomes)
+                self.chromosomes.append(chromo)
+
+        positions = np.asarray(positions, dtype=np.int64)
+        out_of_range = (positions < 0) | (positions >= MAX_POS)
+        if out_of_range.any():
+            raise RuntimeError(
+                f"Background store positions must be from 0 to {MAX_POS - 1}, got {positions[out_of_range][0]}"
+            )
+
+        # the last entry catches missing chromosomes (code -1)
+        chromo_ids = np.array([self.chromosome_ids.get(chromo, -1) for chromo in chromo_names] + [-1])
+        ids = chromo_ids[codes]
+        unknown = ids < 0
+        ids = np.where(unknown, 0, ids).astype(np.uint64)
+
+        keys = (ids << CHROMO_SHIFT) | (np.asarray(positions, dtype=np.uint64) << SITE_SHIFT)
+
+        if changes is not None:
+            codes, alleles = pd.factorize(pd.Series(changes).astype(c.OBJECT))
+            allele_codes = np.array(
+                [zlib.crc32(str(allele).encode()) & ALLELE_MASK for allele in alleles] + [0], dtype=np.uint64
+            )
+            keys |= allele_codes[codes]
+
+        keys[unknown] = np.iinfo(np.uint64).max
+
+        return keys
+
+    def contains(self, chromos, positions, changes=None, exclude_source=None):
+        """
+        Boolean mask of the sites seen in any past run. Without `changes` any allele at the position matches,
+        the same way background mutations are counted within a run. Sites added from `exclude_source` only don't
+        count, a project rerun mustn't be its own background.
+        """
+        keys = self.pack(chromos, positions, changes)
+
+        # searching sorted needles is an order of magnitude faster, and cohorts repeat sites per sample
+        keys, inverse = np.unique(keys, return_inverse=True)
+        found = np.zeros(len(keys), dtype=bool)
+
+        if changes is None:
+            lower = keys
+            upper = keys + np.uint64(ALLELE_MASK)
+        else:
+            lower = upper = keys
+
+        for entry, segment in zip(self.manifest, self.segments):
+            if exclude_source is not None and entry['source'] == exclude_source:
+                continue
+            found |= np.searchsorted(segment, lower, side='left') != np.searchsorted(segment, upper, side='right')
+
+        # the unknown chromosome sentinel must never match
+        found[keys == np.iinfo(np.uint64).max] = False
+
+        return found[inverse.reshape(-1)]
+
+    def add(self, chromos, positions, changes, source):
+        """ Append the given sites as a new segment, skipping any already added from the same source """
+        with Timer(factor=1000) as t:
+            os.makedirs(self.path, exist_ok=True)
+
+            keys = np.unique(self.pack(chromos, positions, changes, add_chromosomes=True))
+
+            exact = np.zeros(len(keys), dtype=bool)
+            for entry, segment in zip(self.manifest, self.segments):
+                if entry['source'] != source or not len(segment):
+                    continue
+                idx = np.searchsorted(segment, keys)
+                exact |= (idx < len(segment)) & (segment[np.minimum(idx, len(segment) - 1)] == keys)
+
+            keys = keys[~exact]
+
+            segment_file = self._new_segment_file()
+
+            np.save(os.path.join(self.path, segment_file), keys)
+
+            self.manifest.append({'segment': segment_file, 'source': source, 'sites': len(keys)})
+            self.segments.append(np.load(os.path.join(self.path, segment_file), mmap_mode='r'))
+
+            # chromosomes first, so a manifest never points at keys with unknown chromosome ids
+            self._write_json(CHROMOSOMES_FILE, self.chromosomes)
+            self._write_manifest()
+
+            print("adding {} new background sites from {} took {}.ms".format(len(keys), source, round(t.elapsed, 1)))
+
+        if self.compact_segments and \
+                sum(entry['source'] == source for entry in self.manifest) >= self.compact_segments:
+            self.compact()
+
+        return len(keys)
+
+    def add_pool_root(self, pool_root):
+        """ Import every pool of a pool root, using its config & filters, and add all of its sites """
+        from lib.gene_variant_identifier import GeneVariantIdentifier
+
+        df = GeneVariantIdentifier(pool_root).load_dataframes()
+
+        if df is None or df.empty:
+            print(f'warning: no variants imported from {pool_root}')
+            return 0
+
+        return self.add(df[c.chromo], df[c.pos], df[c.change], source=os.path.abspath(pool_root))
+
+    def compact(self):
+        """
+        Merge the segments of each source into one, the only operation that removes existing files. Merged
+        segments are written under new names before the manifest is swapped, so a failed compaction loses nothing.
+        """
+        by_source = {}
+        for entry, segment in zip(self.manifest, self.segments):
+            by_source.setdefault(entry['source'], []).append((entry, segment))
+
+        if all(len(entries) < 2 for entries in by_source.values()):
+            return
+
+        manifest = []
+        segments = []
+        old_segments = []
+
+        for source, entries in by_source.items():
+            if len(entries) < 2:
+                manifest.append(entries[0][0])
+                segments.append(entries[0][1])
+                continue
+
+            keys = np.unique(np.concatenate([segment for _, segment in entries]))
+            segment_file = self._new_segment_file()
+            np.save(os.path.join(self.path, segment_file), keys)
+
+            manifest.append({'segment': segment_file, 'source': source, 'sites': len(keys)})
+            segments.append(np.load(os.path.join(self.path, segment_file), mmap_mode='r'))
+            old_segments += [entry['segment'] for entry, _ in entries]
+
+        self.manifest = manifest
+        self.segments = segments
+        self._write_manifest()
+
+        for old_segment in old_segments:
+            os.remove(os.path.join(self.path, old_segment))
@@ -0,0 +1,44 @@
+"""
+Build & inspect a cross-project background site store:
+
+    python -m lib.background_store add <store> <pool_root> [<pool_root> ...]
+    python -m lib.background_store info <store>
+    python -m lib.background_store compact <store>
+"""
+import argparse
+
+from lib.background_store import BackgroundStore
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m lib.background_store')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    add = commands.add_parser('add', help='import pool roots & append their sites to the store')
+    add.add_argument('store')
+    add.add_argument('pool_roots', nargs='+')
+
+    info = commands.add_parser('info', help='print the sources & site counts of the store')
+    info.add_argument('store')
+
+    compact = commands.add_parser('compact', help='merge the store segments into one')
+    compact.add_argument('store')
+
+    args = parser.parse_args()
+
+    store = BackgroundStore(args.store)
+
+    if args.command == 'add':
+        for pool_root in args.pool_roots:
+            store.add_pool_root(pool_root)
+    elif args.command == 'info':
+        for entry in store.manifest:
+            print(f"{entry['segment']}: {entry['sites']} sites from {entry['source']}")
+        print(f'{len(store)} sites on {len(store.chromosomes)} chromosomes')
+    elif args.command == 'compact':
+        store.compact()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import os
+import datetime
+import traceback
+import concurrent.futures
+import yaml
+from contexttimer import Timer
+
+from lib.gene_variant_identifier import GeneVariantIdentifier, SQLITE_BACKEND
+from lib.sharding import ShardRunner
+from lib.scheduler import ImportScheduler, MB
+
+DEFAULT_PROJECTS = 2
+REPORT_FILE = 'gene_variant_identifier_batch_{}.yaml'
+
+OK = 'ok'
+FAILED = 'failed'
+
+
+def load_manifest(filename):
+    """ Pool roots listed in a yaml file, or one per line in a text file (# comments), relative to the file """
+    with open(filename) as file:
+        if os.path.splitext(filename)[1] in {'.yaml', '.yml'}:
+            pool_roots = yaml.safe_load(file) or []
+        else:
+            pool_roots = [line.split('#', 1)[0].strip() for line in file]
+
+    base = os.path.dirname(os.path.abspath(filename))
+
+    return [os.path.join(base, pool_root) for pool_root in pool_roots if pool_root]
+
+
+class BatchRunner(object):
+    """
+    Run many pool roots in one process: up to `projects` at once, all importing through one shared worker pool
+    within one memory budget, and sharing the parsed flagged gene lists & background stores they have in
+    common. A failing project is reported rather than ending the batch.
+
+    Sharded projects run their shards one after another through the shared scheduler. SQLite backed projects
+    stream their imports in their own project thread, outside the shared workers & memory budget.
+    """
+
+    def __init__(self, pool_roots, projects=DEFAULT_PROJECTS, workers=None, memory_budget=None, processes=False,
+                 scratch_dir=None, report_file=None, prefetch_budget=None):
+        self.pool_roots = list(pool_roots)
+        self.projects = max(1, projects or 1)
+        self.workers = workers or os.cpu_count() or 1
+        self.memory_budget = memory_budget
+        self.processes = processes
+        self.scratch_dir = scratch_dir
+        self.report_file = report_file
+        self.prefetch_budget = prefetch_budget
+
+        self.statuses = []
+
+        self._background_stores = {}
+
+    def apply(self):
+        with Timer(factor=1000) as t:
+            executor_class = concurrent.futures.ProcessPoolExecutor if self.processes \
+                else concurrent.futures.ThreadPoolExecutor
+
+            with executor_class(max_workers=self.workers) as executor:
+                scheduler = ImportScheduler(
+                    workers=self.workers,
+                    memory_budget=self.memory_budget,
+                    processes=self.processes,
+                    scratch_dir=self.scratch_dir,
+                    executor=executor,
+                    prefetch_budget=self.prefetch_budget
+                )
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.projects) as projects:
+                    futures = [
+                        projects.submit(self.run_project, pool_root, scheduler)
+                        for pool_root in self.pool_roots
+                    ]
+                    self.statuses = [future.result() for future in futures]
+
+            print("batch of {} projects took {}.ms".format(len(self.statuses), round(t.elapsed, 1)))
+
+        return self.write_report(self.statuses)
+
+    def run_project(self, pool_root, scheduler):
+        status = {'pool_root': pool_root, 'status': OK, 'outfile': None, 'error': None}
+
+        with Timer(factor=1000) as t:
+            try:
+                gvi = GeneVariantIdentifier(pool_root)
+                gvi.scheduler = scheduler
+                gvi.background_store = self._shared_background_store(gvi.background_store)
+
+                if gvi.shards:
+                    # rather than a process pool of its own, outside the batch's workers & memory budget
+                    status['outfile'] = ShardRunner(pool_root, shards=gvi.shards, scheduler=scheduler).apply()
+                else:
+                    if gvi.backend == SQLITE_BACKEND:
+                        print(f"warning: {pool_root} uses Backend: {SQLITE_BACKEND}, its imports stream one "
+                              f"file at a time outside the batch's shared workers & memory budget")
+                    status['outfile'] = gvi.apply()
+            except Exception as exc:
+                traceback.print_exc()
+                status['status'] = FAILED
+                status['error'] = f'{type(exc).__name__}: {exc}'
+
+            status['ms'] = round(t.elapsed, 1)
+
+        print("project {} {} after {}.ms".format(pool_root, status['status'], status['ms']))
+
+        return status
+
+    def _shared_background_store(self, background_store):
+        if background_store is None:
+            return None
+        return self._background_stores.setdefault(os.path.abspath(background_store.path), background_store)
+
+    def write_report(self, statuses):
+        report_file = self.report_file or REPORT_FILE.format(datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S'))
+
+        report = {
+            'projects': statuses,
+            'failed': sum(status['status'] == FAILED for status in statuses),
+            'memory_budget_mb': None if self.memory_budget is None else round(self.memory_budget / MB),
+            'workers': self.workers
+        }
+
+        with open(report_file, 'w') as file:
+            yaml.safe_dump(report, file, default_flow_style=False)
+
+        return report_file
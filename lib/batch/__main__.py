@@ -0,0 +1,66 @@
+"""
+Run many pool roots in one invocation, sharing the import workers & reference data between them:
+
+    python -m lib.batch <pool_root> [<pool_root> ...] [--manifest roots.txt] [--projects 2] [--workers 8]
+        [--memory-budget 16000] [--prefetch-budget 2000] [--processes] [--report report.yaml] [--profile DIR]
+"""
+import sys
+import argparse
+
+from lib import profiling
+from lib.batch import BatchRunner, load_manifest, DEFAULT_PROJECTS, FAILED
+from lib.scheduler import MB
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m lib.batch')
+    parser.add_argument('pool_roots', nargs='*')
+    parser.add_argument('--manifest', help='yaml list, or text file with one pool root per line')
+    parser.add_argument('--projects', type=int, default=DEFAULT_PROJECTS, help='projects analysed at once')
+    parser.add_argument('--workers', type=int, default=None, help='import workers shared by all projects')
+    parser.add_argument('--memory-budget', type=float, default=None, help='MB, shared by all projects\' imports')
+    parser.add_argument('--prefetch-budget', type=float, default=None, help='MB read ahead of the imports')
+    parser.add_argument('--processes', action='store_true', help='import in worker processes')
+    parser.add_argument('--scratch-dir', default=None)
+    parser.add_argument('--report', default=None, help='status report file (yaml)')
+    parser.add_argument('--profile', default=None, metavar='DIR', help='profile each stage into DIR')
+    parser.add_argument('--top', type=int, default=profiling.DEFAULT_TOP, help='hotspots listed after profiling')
+
+    args = parser.parse_args()
+
+    pool_roots = list(args.pool_roots)
+    if args.manifest:
+        pool_roots += load_manifest(args.manifest)
+
+    if not pool_roots:
+        parser.error('no pool roots given')
+
+    runner = BatchRunner(
+        pool_roots,
+        projects=args.projects,
+        workers=args.workers,
+        memory_budget=args.memory_budget * MB if args.memory_budget else None,
+        processes=args.processes,
+        scratch_dir=args.scratch_dir,
+        report_file=args.report,
+        prefetch_budget=args.prefetch_budget * MB if args.prefetch_budget else None
+    )
+
+    if args.profile:
+        profiling.enable(args.profile)
+
+    try:
+        report_file = runner.apply()
+    finally:
+        if args.profile:
+            print(profiling.summarise(args.profile, top=args.top))
+            profiling.disable()
+
+    print(report_file)
+
+    if any(status['status'] == FAILED for status in runner.statuses):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -43,8 +43,14 @@ cand_pos = 'cand_pos'
 cand_gene = 'cand_gene'
 cand_gene_hom_ratio = 'cand_gene_hom_ratio'
 flagged_gene = 'flagged_gene'
+gene_samples = 'gene_samples'
+gene_positions = 'gene_positions'
+gene_mean_qual = 'gene_mean_qual'
 
-hom = 'Hom'  # TODO: make expected value configurable
+hom = 'Hom'  # default, see the 'Hom Label' config
+
+# optional per gene aggregates, see the 'Gene Statistics' config
+GENE_STATISTICS = [gene_samples, gene_positions, gene_mean_qual]
 
 # These are needed to "fillna" - otherwise df.pivot_table drops all rows with any NaN/None in the index.
 # Note - this means any rows with missing CATEGORY columns may get dropped :(
@@ -91,11 +97,17 @@ COLUMNS = {
     cand_pos: ColumnMeta('Candidate: Positional', UINT64, None, None, UINT64_DEFAULT),
     cand_gene: ColumnMeta('Candidate: Gene', UINT64, None, None, UINT64_DEFAULT),
     cand_gene_hom_ratio: ColumnMeta('Gene Hit Homozygosity', FLOAT64, None, {'num_format': '0%'}, FLOAT64_DEFAULT),
-    flagged_gene: ColumnMeta('Flagged Gene', UINT64, None, None, UINT64_DEFAULT)
+    flagged_gene: ColumnMeta('Flagged Gene', UINT64, None, None, UINT64_DEFAULT),
+    gene_samples: ColumnMeta('Gene Samples', UINT64, None, None, UINT64_DEFAULT),
+    gene_positions: ColumnMeta('Gene Positions', UINT64, None, None, UINT64_DEFAULT),
+    gene_mean_qual: ColumnMeta('Gene Mean Quality', FLOAT64, None, {'num_format': '0.0'}, FLOAT64_DEFAULT)
 }
 
 COLUMN_KEYS = list(COLUMNS.keys())
 
+# the gene statistics are computed by the analysis, so no importer has them to select
+SELECTABLE_KEYS = [col for col in COLUMN_KEYS if col not in GENE_STATISTICS]
+
 # Map of raw input columns names to normalized column
 LOOKUP = {
     title: col
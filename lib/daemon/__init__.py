@@ -0,0 +1,214 @@
+import os
+import json
+import datetime
+import threading
+import traceback
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from contexttimer import Timer
+
+from lib.gene_variant_identifier import GeneVariantIdentifier, MEMORY_BACKEND
+from lib.importers import ConfigImporter
+from lib.incremental import AnalysisState
+from lib import utils
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_INTERVAL = 2.0
+
+IDLE = 'idle'
+RUNNING = 'running'
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """
+    Keeps a pool root's imports & analysis state resident, polls it for new, changed or deleted files and
+    regenerates the workbook once they have settled. Changes to the config, flagged genes workbook, annotation
+    files or background store rebuild the state from scratch. Runs can also be triggered, and the status
+    queried, over a local HTTP endpoint:
+
+        GET  /status  current state, last output & error, tracked files
+        POST /run     re-analyse now
+    """
+
+    def __init__(self, pool_root, host=DEFAULT_HOST, port=DEFAULT_PORT, interval=DEFAULT_INTERVAL):
+        self.pool_root = pool_root
+        self.host = host
+        self.port = port
+        self.interval = interval
+
+        self.gvi = None
+        self.state = None
+
+        self.lock = threading.Lock()
+        self.trigger = threading.Event()
+        self.stopped = threading.Event()
+
+        self.status = {
+            'pool_root': os.path.abspath(pool_root),
+            'state': IDLE,
+            'runs': 0,
+            'last_run': None,
+            'last_runtime_ms': None,
+            'last_outfile': None,
+            'last_error': None,
+            'files': 0,
+            'pools': []
+        }
+
+        self._snapshot = None
+
+    def _input_signature(self):
+        try:
+            if self.state is None:
+                config_file = ConfigImporter(self.pool_root).config_file
+                return utils.file_signature(config_file) if config_file else None
+            # the config, flagged genes workbook, annotation files & background store the state was built with
+            return self.state.input_signature()
+        except OSError:
+            # a missing input, the run reports it
+            return None
+
+    def snapshot(self):
+        """
+        Signatures of every file in the pool directories & of the other inputs, to detect changes without
+        importing anything
+        """
+        snapshot = {}
+        for pool_dir in next(os.walk(self.pool_root))[1]:
+            directory = os.path.join(self.pool_root, pool_dir)
+            for entry in os.scandir(directory):
+                if entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot, self._input_signature()
+
+    @staticmethod
+    def check_config(gvi):
+        """ The daemon always keeps an in-memory analysis state of every site, whatever the config says """
+        if gvi.sampler:
+            raise RuntimeError(
+                "Preview settings aren't supported by the daemon, as preview runs aren't incremental.\n"
+                "Remove Preview Fraction & Preview Chromosomes from the config"
+            )
+        if gvi.shards:
+            print("warning: the daemon ignores Shards, every chromosome is kept in memory")
+        if gvi.backend != MEMORY_BACKEND:
+            print(f"warning: the daemon ignores Backend: {gvi.backend}, using the {MEMORY_BACKEND} backend")
+
+    def serve_forever(self):
+        server = _ThreadingHTTPServer((self.host, self.port), self._handler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        print(f'watching {self.pool_root}, listening on http://{self.host}:{server.server_address[1]}')
+
+        try:
+            self.run()
+            self.watch()
+        finally:
+            server.shutdown()
+
+    def stop(self):
+        self.stopped.set()
+        self.trigger.set()
+
+    def watch(self):
+        last_seen = self.snapshot()
+        self._snapshot = last_seen
+
+        while not self.stopped.is_set():
+            triggered = self.trigger.wait(self.interval)
+            self.trigger.clear()
+
+            if self.stopped.is_set():
+                return
+
+            current = self.snapshot()
+
+            # only re-run once files have stopped changing between two polls, so half-copied files are skipped
+            settled = current == last_seen
+            last_seen = current
+
+            if triggered or (settled and current != self._snapshot):
+                self.run()
+
+    def run(self):
+        with self.lock:
+            self.status['state'] = RUNNING
+
+        snapshot = self.snapshot()
+        files, signature = snapshot
+
+        try:
+            with Timer(factor=1000) as t:
+                if self.state is None or self.state.input_signature() != self.state.signature:
+                    # config & other input changes can alter every imported frame or cached pool, so start over
+                    gvi = GeneVariantIdentifier(self.pool_root)
+                    self.check_config(gvi)
+                    self.gvi, self.state = gvi, AnalysisState(gvi, persist=gvi.incremental)
+                    # the inputs the state was actually built with, so the rebuild doesn't trigger another run
+                    signature = self.state.signature
+                else:
+                    self.gvi.discover()
+
+                self.state.refresh()
+
+                dfs = self.state.analyse()
+
+                outfile = self.gvi.exporter.export(dfs) if dfs else None
+
+            with self.lock:
+                self.status.update({
+                    'last_outfile': outfile,
+                    'last_error': None,
+                    'last_runtime_ms': round(t.elapsed, 1),
+                    'files': len(self.state.manifest),
+                    'pools': sorted({pool_dir for pool_dir, _ in self.state.manifest})
+                })
+
+            print("daemon run took {}.ms, wrote {}".format(round(t.elapsed, 1), outfile))
+        except Exception as exc:
+            traceback.print_exc()
+            with self.lock:
+                self.status['last_error'] = f'{type(exc).__name__}: {exc}'
+        finally:
+            self._snapshot = (files, signature)
+            with self.lock:
+                self.status['state'] = IDLE
+                self.status['runs'] += 1
+                self.status['last_run'] = datetime.datetime.now().isoformat()
+
+    def _handler(self):
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, code, body):
+                payload = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path.rstrip('/') == '/status':
+                    with daemon.lock:
+                        self._send(200, dict(daemon.status))
+                else:
+                    self._send(404, {'error': f'unknown path {self.path}'})
+
+            def do_POST(self):
+                if self.path.rstrip('/') == '/run':
+                    daemon.trigger.set()
+                    self._send(202, {'triggered': True})
+                else:
+                    self._send(404, {'error': f'unknown path {self.path}'})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,29 @@
+"""
+Keep a pool root resident in memory & regenerate its workbook whenever files change:
+
+    python -m lib.daemon <pool_root> [--host 127.0.0.1] [--port 8765] [--interval 2]
+"""
+import argparse
+
+from lib.daemon import Daemon, DEFAULT_HOST, DEFAULT_PORT, DEFAULT_INTERVAL
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m lib.daemon')
+    parser.add_argument('pool_root')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help='seconds between polls')
+
+    args = parser.parse_args()
+
+    daemon = Daemon(args.pool_root, host=args.host, port=args.port, interval=args.interval)
+
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        daemon.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,16 @@
+import os
 import re
 import datetime
-from typing import Dict
+import concurrent.futures
+from typing import Dict, Iterable
 from contexttimer import Timer
+import numpy as np
 import pandas as pd
 import xlsxwriter
-from xlsxwriter.utility import xl_rowcol_to_cell, xl_col_to_name
+from xlsxwriter.utility import xl_rowcol_to_cell
 
 import lib.columns as c
+from lib.profiling import profiled
 
 SHEET_NAME_SUBS = {
     '[': '(',
@@ -24,19 +28,77 @@ COLORS = {
     'yellow': '#FFFA91'
 }
 
+# matches the header style pandas' to_excel writes
+HEADER_FORMAT = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+
+# summary sheets share one workbook when splitting, unless split_summaries
+SUMMARY_SHEETS = {c.COLUMNS[col].title for col in [c.background, c.cand_pos, c.cand_gene, c.flagged_gene]}
+SUMMARIES_WORKBOOK = 'Summaries'
+
+INDEX_SHEET = 'Index'
+INDEX_COLUMNS = ['Sheet', 'Workbook', 'Rows']
+
+# in priority order, a row with several hits takes the first one's color
 HIGHLIGHT_COLORS = {
     c.background: COLORS['gray'],
     c.cand_pos: COLORS['yellow'],
     c.cand_gene: COLORS['green']
 }
 
+NO_HIGHLIGHT = -1
+
+COLUMN_WIDTH = 15
+
+
+def highlight_classes(df):
+    """ Position in HIGHLIGHT_COLORS of the color each row is highlighted with, NO_HIGHLIGHT for none """
+    classes = np.full(len(df), NO_HIGHLIGHT, dtype=np.int8)
+    # lowest priority first, so higher priority hits overwrite it
+    for i, col in reversed(list(enumerate(HIGHLIGHT_COLORS))):
+        if col in df.columns:
+            classes[df[col].values > 0] = i
+    return classes
+
+
+@profiled('export workbook', detail=lambda outfile, sheets, static_highlights=False: os.path.basename(outfile))
+def export_workbook(outfile, sheets: Dict[str, pd.DataFrame], static_highlights=False):
+    """ Write `sheets` into their own workbook, in a worker process when splitting """
+    with Timer(factor=1000) as t:
+        writer = pd.ExcelWriter(outfile, engine='xlsxwriter')
+
+        for sheet_name, df in sheets.items():
+            XlsxExporter.process_pool(writer, df, sheet_name, static_highlights)
+
+        writer.save()
+        writer.close()
+
+        print("{} export took {}.ms".format(os.path.basename(outfile), round(t.elapsed, 1)))
+
+    return outfile
+
 
 class XlsxExporter(object):
+    """
+    Writes every sheet into a single workbook, or with `split`, each pool's sheet (& each summary sheet, with
+    `split_summaries`) into its own workbook, concurrently in up to `workers` processes, plus an index workbook
+    linking to them.
 
-    def __init__(self, basename):
+    Hit rows are highlighted by conditional formats, or with `static_highlights`, by formats written with each
+    row's cells. Those look the same, but Excel doesn't have to re-evaluate formulas over the whole sheet.
+    """
+
+    def __init__(self, basename, split=False, split_summaries=False, workers=None, static_highlights=False):
         self.basename = basename
+        self.split = split
+        self.split_summaries = split_summaries
+        self.workers = workers
+        self.static_highlights = static_highlights
 
+    @profiled('export')
     def export(self, dataframes: Dict[str, pd.DataFrame]):
+        if self.split:
+            return self.export_split(dataframes)
+
         now = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')
 
         outfile = f'{self.basename}.{now}.xlsx'
@@ -45,7 +107,7 @@ class XlsxExporter(object):
 
         for pool_name, df in dataframes.items():
             with Timer(factor=1000) as t:
-                self.process_pool(writer, df, pool_name)
+                self.process_pool(writer, df, pool_name, self.static_highlights)
                 print("{} export took {}.ms".format(pool_name, round(t.elapsed, 1)))
 
         writer.save()
@@ -53,38 +115,195 @@ class XlsxExporter(object):
 
         return outfile
 
+    def export_split(self, dataframes: Dict[str, pd.DataFrame]):
+        """ Separate workbooks in a <basename>.<timestamp> directory, returns the index workbook linking them """
+        now = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')
+
+        outfile = f'{self.basename}.{now}.xlsx'
+        outdir = f'{self.basename}.{now}'
+
+        os.makedirs(outdir, exist_ok=True)
+
+        workbooks = {}
+
+        for sheet_name, df in dataframes.items():
+            if sheet_name in SUMMARY_SHEETS and not self.split_summaries:
+                workbook_name = SUMMARIES_WORKBOOK
+            else:
+                workbook_name = self.clean_sheet_name(sheet_name)
+            workbooks.setdefault(os.path.join(outdir, f'{workbook_name}.xlsx'), {})[sheet_name] = df
+
+        with Timer(factor=1000) as t:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+                # largest first, so the run doesn't end on one big workbook
+                future_map = {
+                    executor.submit(export_workbook, workbook, sheets, self.static_highlights): workbook
+                    for workbook, sheets in sorted(
+                        workbooks.items(), key=lambda item: sum(len(df) for df in item[1].values()), reverse=True
+                    )
+                }
+                for future in concurrent.futures.as_completed(future_map):
+                    workbook = future_map[future]
+                    try:
+                        future.result()
+                    except Exception as exc:
+                        raise RuntimeError(
+                            '%r generated an exception: %s' % (os.path.basename(workbook), exc)
+                        ) from exc
+
+            print("workbook exports took {}.ms total".format(round(t.elapsed, 1)))
+
+        self.write_index(outfile, workbooks)
+
+        return outfile
+
+    def write_index(self, outfile, workbooks):
+        """ One row per sheet, linking to it in its workbook (relative to the index, so they can move together) """
+        workbook = xlsxwriter.Workbook(outfile)
+
+        sheet = workbook.add_worksheet(INDEX_SHEET)
+
+        sheet.write_row(0, 0, INDEX_COLUMNS, workbook.add_format(HEADER_FORMAT))
+
+        row = 0
+
+        for workbook_file, sheets in workbooks.items():
+            relative_path = os.path.relpath(workbook_file, os.path.dirname(os.path.abspath(outfile)))
+            for sheet_name, df in sheets.items():
+                row += 1
+                sheet_name = self.clean_sheet_name(sheet_name)
+                sheet.write(row, 0, sheet_name)
+                sheet.write_url(row, 1, f"external:{relative_path}#'{sheet_name}'!A1", string=relative_path)
+                sheet.write(row, 2, len(df))
+
+        sheet.set_column(0, 0, 30)
+        sheet.set_column(1, 1, 50)
+        sheet.freeze_panes(1, 0)
+
+        workbook.close()
+
+    @profiled('export')
+    def export_batches(self, batches: Dict[str, Iterable[pd.DataFrame]]):
+        """ Stream each sheet's DataFrame batches straight into the workbook, holding only one batch at a time """
+        now = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')
+
+        outfile = f'{self.basename}.{now}.xlsx'
+
+        workbook = xlsxwriter.Workbook(outfile, {'constant_memory': True})
+
+        for pool_name, dfs in batches.items():
+            with Timer(factor=1000) as t:
+                self.process_pool_batches(workbook, dfs, pool_name, self.static_highlights)
+                print("{} export took {}.ms".format(pool_name, round(t.elapsed, 1)))
+
+        workbook.close()
+
+        return outfile
+
     @staticmethod
-    def process_pool(writer, df, sheet_name):
+    def process_pool(writer, df, sheet_name, static_highlights=False):
+        if static_highlights:
+            # to_excel can't format rows, so the cells are written like the batches
+            XlsxExporter.process_pool_batches(writer.book, [df], sheet_name, static_highlights)
+            return
 
         sheet_name = XlsxExporter.clean_sheet_name(sheet_name)
 
         df.rename(index=str, columns=c.OUTPUT_NAMES).to_excel(writer, sheet_name, index=False)
 
-        af_row, af_col = df.shape
-
         workbook: xlsxwriter.Workbook = writer.book
 
         sheet = workbook.get_worksheet_by_name(sheet_name)
 
-        to_format = {
-            cc: c.COLUMNS[cc].xlsx_format
-            for cc in df.columns
-            if cc in c.COLUMNS and c.COLUMNS[cc].xlsx_format
-        }
+        XlsxExporter.format_sheet(workbook, sheet, list(df.columns), len(df))
+
+    @staticmethod
+    def process_pool_batches(workbook, dfs, sheet_name, static_highlights=False):
+        sheet = workbook.add_worksheet(XlsxExporter.clean_sheet_name(sheet_name))
+
+        header_format = workbook.add_format(HEADER_FORMAT)
 
-        for col, xlsx_format in to_format.items():
-            XlsxExporter.format_column(workbook, sheet, df, col, xlsx_format)
+        columns = None
+        column_formats = None
+        row_formats = None
+        row = 0
 
-        for col, bg_color in HIGHLIGHT_COLORS.items():
-            XlsxExporter.highlight(workbook, sheet, df, col, bg_color)
+        for df in dfs:
+            if columns is None:
+                columns = list(df.columns)
+                sheet.write_row(0, 0, [str(c.OUTPUT_NAMES.get(col, col)) for col in columns], header_format)
+                # in constant_memory mode rows are flushed before the column formats are set, so cells carry them
+                column_formats = XlsxExporter.column_formats(workbook, columns)
+                # NO_HIGHLIGHT picks the last, uncolored formats
+                row_formats = [*XlsxExporter.highlight_formats(workbook, columns), column_formats] \
+                    if static_highlights else None
 
-        for i in range(0, len(df.columns)):
-            sheet.set_column(i, i, 15)
+            # to_excel leaves missing values blank
+            nulls = np.column_stack([df[col].isna().values for col in columns]) if len(df) else []
+
+            if static_highlights:
+                for values, missing, highlight in zip(
+                        zip(*(df[col].tolist() for col in columns)), nulls, highlight_classes(df)):
+                    row += 1
+                    XlsxExporter.write_values(sheet, row, values, missing, row_formats[highlight])
+                continue
+
+            for values, missing in zip(zip(*(df[col].tolist() for col in columns)), nulls):
+                row += 1
+                XlsxExporter.write_values(sheet, row, values, missing, column_formats)
+
+        if columns is not None:
+            XlsxExporter.format_sheet(workbook, sheet, columns, row, static_highlights, column_formats)
+
+    @staticmethod
+    def write_values(sheet, row, values, missing, formats):
+        for col, (value, null, _format) in enumerate(zip(values, missing, formats)):
+            if not null:
+                sheet.write(row, col, value, _format)
+            elif _format is not None:
+                # still colored, like the conditional format
+                sheet.write_blank(row, col, None, _format)
+
+    @staticmethod
+    def highlight_formats(workbook, columns):
+        """ Cell formats of each column for each highlight color, the column's own format plus the color """
+        return [
+            [
+                workbook.add_format({**(XlsxExporter.column_format(col) or {}), 'bg_color': bg_color})
+                for col in columns
+            ]
+            for bg_color in HIGHLIGHT_COLORS.values()
+        ]
+
+    @staticmethod
+    def column_format(col):
+        return c.COLUMNS[col].xlsx_format if col in c.COLUMNS else None
+
+    @staticmethod
+    def column_formats(workbook, columns):
+        """ Cell format of each column, None for those without one """
+        return [
+            workbook.add_format(xlsx_format) if xlsx_format else None
+            for xlsx_format in map(XlsxExporter.column_format, columns)
+        ]
+
+    @staticmethod
+    def format_sheet(workbook, sheet, columns, num_rows, static_highlights=False, column_formats=None):
+        if column_formats is None:
+            column_formats = XlsxExporter.column_formats(workbook, columns)
+
+        if not static_highlights:
+            for col, bg_color in HIGHLIGHT_COLORS.items():
+                XlsxExporter.highlight(workbook, sheet, columns, num_rows, col, bg_color)
+
+        # width & format together, setting either later would drop the other
+        for i, _format in enumerate(column_formats):
+            sheet.set_column(i, i, COLUMN_WIDTH, _format)
 
         sheet.freeze_panes(1, 0)
 
-        if af_row > 0 and af_col > 0:
-            sheet.autofilter(0, 0, af_row - 1, af_col - 1)
+        if num_rows > 0 and columns:
+            sheet.autofilter(0, 0, num_rows - 1, len(columns) - 1)
 
     @staticmethod
     def clean_sheet_name(sheet_name):
@@ -93,16 +312,9 @@ class XlsxExporter(object):
         return re.sub('\s+', ' ', sheet_name).strip()
 
     @staticmethod
-    def format_column(workbook, sheet, df, col, xlsx_format):
-        column = xl_col_to_name(df.columns.get_loc(col))
-        _format = workbook.add_format(xlsx_format)
-        sheet.set_column(f'{column}:{column}', None, _format)
-
-    @staticmethod
-    def highlight(workbook, sheet, df, col, bg_color):
-        af_row, af_col = df.shape
-        whole_sheet_end = xl_rowcol_to_cell(af_row, af_col - 1)
-        column = df.columns.get_loc(col)
+    def highlight(workbook, sheet, columns, num_rows, col, bg_color):
+        whole_sheet_end = xl_rowcol_to_cell(num_rows, len(columns) - 1)
+        column = columns.index(col)
         ref = xl_rowcol_to_cell(1, column, col_abs=True)
         _format = workbook.add_format({'bg_color': bg_color})
         sheet.conditional_format(
@@ -3,10 +3,19 @@ import glob
 from natsort import natsorted
 from contexttimer import Timer
 import concurrent.futures
-
+import numpy as np
+import pandas as pd
+
+from .annotations import IntervalAnnotation
+from .background_store import BackgroundStore
+from .membership import Membership
+from .profiling import profiled
+from .sampling import SiteSampler
 from .filters import BooleanFilterTree
 from .exporters import XlsxExporter
 from .importers import ConfigImporter, FlaggedGenesImporter, SnpEffImporter, VcfImporter
+from .importers.snp_eff_importer import PANDAS_ENGINE, ENGINES as SNPEFF_ENGINES
+from .scheduler import ImportScheduler, MB
 
 from . import utils
 from . import columns as c
@@ -15,12 +24,60 @@ CONFIG_FIELDS = {
     'FILTERS': 'Filters',
     'SELECT_COLS': 'Select Columns',
     'FLAGGED_GENES_PATH': 'Flagged Genes Path',
-    'FLAGGED_GENE_DETAILS': 'Flagged Genes Details'
+    'FLAGGED_GENE_DETAILS': 'Flagged Genes Details',
+    'SHARDS': 'Shards',
+    'BACKEND': 'Backend',
+    'BACKEND_PATH': 'Backend Path',
+    'INCREMENTAL': 'Incremental',
+    'BACKGROUND_STORE_PATH': 'Background Store Path',
+    'ADAPTIVE_FILTERS': 'Adaptive Filters',
+    'PRINT_FILTER_PLAN': 'Print Filter Plan',
+    'IMPORT_WORKERS': 'Import Workers',
+    'IMPORT_PROCESSES': 'Import Processes',
+    'IMPORT_MEMORY_BUDGET': 'Import Memory Budget',
+    'IMPORT_SCRATCH_DIR': 'Import Scratch Dir',
+    'SUMMARY_TOP': 'Summary Top',
+    'HOM_LABEL': 'Hom Label',
+    'GENE_STATISTICS': 'Gene Statistics',
+    'SNPEFF_ENGINE': 'SnpEff Engine',
+    'PREFETCH_BUDGET': 'Prefetch Budget',
+    'GENE_ANNOTATION_PATH': 'Gene Annotation Path',
+    'INTERVAL_ANNOTATION_PATH': 'Interval Annotation Path',
+    'SPLIT_EXPORT': 'Split Export',
+    'SPLIT_SUMMARIES': 'Split Summaries',
+    'EXPORT_WORKERS': 'Export Workers',
+    'PREVIEW_FRACTION': 'Preview Fraction',
+    'PREVIEW_CHROMOSOMES': 'Preview Chromosomes',
+    'PREVIEW_SEED': 'Preview Seed',
+    'STATIC_HIGHLIGHTS': 'Static Highlights'
+}
+
+FILTER_STATS_SUFFIX = '.filter_stats.yaml'
+
+MEMORY_BACKEND = 'memory'
+SQLITE_BACKEND = 'sqlite'
+BACKENDS = [MEMORY_BACKEND, SQLITE_BACKEND]
+
+# read by the analysis whatever the Select Columns, see GeneVariantIdentifier.import_columns
+ANALYSIS_COLUMNS = [c.chromo, c.pos, c.hh, c.gene_id]
+
+POOL_SORT = {'by': [c.chromo, c.pos, c.hh], 'ascending': [1, 1, 0]}
+
+# pool directory files that are never imported themselves
+INDEX_SUFFIXES = ('.tbi', '.csi')
+
+# Summary sheets, keyed by the hit column they report on, in output order. Each is sorted by its own score key
+# (if any) & then by POOL_SORT, see GeneVariantIdentifier.summary
+SUMMARY_SORTS = {
+    c.background: {'by': [c.background, c.chromo, c.pos, c.hh], 'ascending': [0, 1, 1, 0]},
+    c.cand_pos: {'by': [c.cand_pos, c.chromo, c.pos, c.hh], 'ascending': [0, 1, 1, 0]},
+    c.cand_gene: {'by': [c.cand_gene, c.chromo, c.pos, c.hh], 'ascending': [0, 1, 1, 0]},
+    c.flagged_gene: {'by': [c.chromo, c.pos, c.hh], 'ascending': [1, 1, 0]}
 }
 
 
 class GeneVariantIdentifier(object):
-    def __init__(self, pool_root):
+    def __init__(self, pool_root, chromosomes=None):
         if not pool_root or not os.path.isdir(pool_root):
             raise RuntimeError("Please call using a directory, not a specific file.")
 
@@ -33,35 +90,149 @@ class GeneVariantIdentifier(object):
 
         self.pool_dirs = pool_dirs
 
-        self.config = ConfigImporter(pool_root).load()
+        config_importer = ConfigImporter(pool_root)
+
+        self.config_file = config_importer.config_file
+
+        self.config = config_importer.load()
 
         self._select = self.config.get(CONFIG_FIELDS['SELECT_COLS'])
 
         for col in self._select:
-            if col not in c.COLUMN_KEYS:
+            if col in c.GENE_STATISTICS:
+                raise RuntimeError(
+                    f"Selected column '{col}' is computed by the analysis, not imported.\n"
+                    f"List it under '{CONFIG_FIELDS['GENE_STATISTICS']}' instead"
+                )
+            if col not in c.SELECTABLE_KEYS:
                 raise RuntimeError(
                     f"Selected column '{col}' not a recognized column key.\n"
-                    f"Must be one of {c.COLUMN_KEYS}"
+                    f"Must be one of {c.SELECTABLE_KEYS}"
+                )
+
+        # the hh value counted as homozygous
+        self.hom_label = self.config.get(CONFIG_FIELDS['HOM_LABEL'], c.hom)
+
+        self.gene_statistics = self.config.get(CONFIG_FIELDS['GENE_STATISTICS']) or []
+
+        for col in self.gene_statistics:
+            if col not in c.GENE_STATISTICS:
+                raise RuntimeError(
+                    f"Gene statistic '{col}' not recognized.\n"
+                    f"Must be one of {c.GENE_STATISTICS}"
                 )
 
-        self.data_filter = BooleanFilterTree(self.config.get(CONFIG_FIELDS['FILTERS']))
+        # rule selectivity & cost are recorded next to the config, to order the filters of the next run
+        self.data_filter = BooleanFilterTree(
+            self.config.get(CONFIG_FIELDS['FILTERS']),
+            stats_file=os.path.splitext(self.config_file)[0] + FILTER_STATS_SUFFIX if self.config_file else None,
+            adaptive=self.config.get(CONFIG_FIELDS['ADAPTIVE_FILTERS'], False)
+        )
+
+        if self.config.get(CONFIG_FIELDS['PRINT_FILTER_PLAN']):
+            print("filter plan:\n" + self.data_filter.describe_plan())
+
+        # restricts imports & analysis to a single shard of chromosomes, see lib.sharding
+        self.chromosomes = set(chromosomes) if chromosomes else None
+
+        self.shards = self.config.get(CONFIG_FIELDS['SHARDS'])
+
+        self.backend = self.config.get(CONFIG_FIELDS['BACKEND'], MEMORY_BACKEND)
+
+        if self.backend not in BACKENDS:
+            raise RuntimeError(
+                f"Backend '{self.backend}' not recognized.\n"
+                f"Must be one of {BACKENDS}"
+            )
+
+        self.snpeff_engine = self.config.get(CONFIG_FIELDS['SNPEFF_ENGINE'], PANDAS_ENGINE)
+
+        if self.snpeff_engine not in SNPEFF_ENGINES:
+            raise RuntimeError(
+                f"SnpEff engine '{self.snpeff_engine}' not recognized.\n"
+                f"Must be one of {SNPEFF_ENGINES}"
+            )
+
+        self.backend_path = self.config.get(CONFIG_FIELDS['BACKEND_PATH'])
+
+        self.incremental = self.config.get(CONFIG_FIELDS['INCREMENTAL'], False)
+
+        # a quick look at a consistent subset of sites, for checking the config before a full run
+        preview_fraction = self.config.get(CONFIG_FIELDS['PREVIEW_FRACTION'])
+        preview_chromosomes = self.config.get(CONFIG_FIELDS['PREVIEW_CHROMOSOMES'])
+
+        self.sampler = None
+
+        if preview_fraction is not None or preview_chromosomes:
+            self.sampler = SiteSampler(
+                fraction=preview_fraction,
+                chromosomes=preview_chromosomes,
+                seed=self.config.get(CONFIG_FIELDS['PREVIEW_SEED'], 0)
+            )
+            if self.incremental:
+                # the state describes every site, so it's left alone
+                print("warning: preview runs aren't incremental")
+                self.incremental = False
+
+        if self.gene_statistics and (self.backend == SQLITE_BACKEND or self.incremental):
+            print("warning: Gene Statistics are only added by the in-memory, non-incremental analysis")
+
+        # keep only the first N rows of each summary sheet, for quick look runs
+        self.summary_top = self.config.get(CONFIG_FIELDS['SUMMARY_TOP'])
+
+        memory_budget = self.config.get(CONFIG_FIELDS['IMPORT_MEMORY_BUDGET'])  # MB
+        prefetch_budget = self.config.get(CONFIG_FIELDS['PREFETCH_BUDGET'])  # MB
+
+        self.scheduler = ImportScheduler(
+            workers=self.config.get(CONFIG_FIELDS['IMPORT_WORKERS'], 1),
+            memory_budget=memory_budget * MB if memory_budget else None,
+            processes=self.config.get(CONFIG_FIELDS['IMPORT_PROCESSES'], False),
+            scratch_dir=self.config.get(CONFIG_FIELDS['IMPORT_SCRATCH_DIR']),
+            prefetch_budget=prefetch_budget * MB if prefetch_budget else None
+        )
+
+        # fill in gene ids & custom interval ids the variant files are missing, from GFF3/GTF/BED intervals
+        self.annotations = []
+
+        for field, column in [('GENE_ANNOTATION_PATH', c.gene_id), ('INTERVAL_ANNOTATION_PATH', c.custom_int_id)]:
+            annotation_path = self.config.get(CONFIG_FIELDS[field])
+            if not annotation_path:
+                continue
+            annotation_path = os.path.join(pool_root, annotation_path)
+            if os.path.isfile(annotation_path):
+                annotation = IntervalAnnotation(annotation_path, column=column)
+                annotation.index  # parsed or mapped from its cache once, up front
+                self.annotations.append(annotation)
+            else:
+                print("warning: unable to locate specified annotation file: " + annotation_path)
 
         self.loaders = [
             VcfImporter(
                 data_filter=self.data_filter,
-                select=self._select
+                select=self._select,
+                chromosomes=self.chromosomes,
+                columns=self.import_columns(),
+                annotations=self.annotations,
+                sampler=self.sampler
             ),
             SnpEffImporter(
                 data_filter=self.data_filter,
-                select=self._select
+                select=self._select,
+                chromosomes=self.chromosomes,
+                columns=self.import_columns(),
+                annotations=self.annotations,
+                engine=self.snpeff_engine,
+                sampler=self.sampler
             )
         ]
 
         self.loader_map = {}
+        self._unidentified = {}
 
-        for pool_dir in pool_dirs:
-            for path, loader in self._loader_map(pool_dir).items():
-                self.loader_map[path] = loader
+        # pool & sample membership of each site & gene, once analysed
+        self.membership = None
+
+        self.discover()
 
         flagged_genes_path = self.config.get(CONFIG_FIELDS['FLAGGED_GENES_PATH'])
         flagged_genes_details = self.config.get(CONFIG_FIELDS['FLAGGED_GENE_DETAILS'])
@@ -75,7 +246,52 @@ class GeneVariantIdentifier(object):
                 details=flagged_genes_details
             )
 
-        self.exporter = XlsxExporter(basename=pool_root)
+        background_store_path = self.config.get(CONFIG_FIELDS['BACKGROUND_STORE_PATH'])
+
+        self.background_store = None
+
+        if background_store_path:
+            background_store_path = os.path.join(pool_root, background_store_path)
+            if os.path.isdir(background_store_path):
+                self.background_store = BackgroundStore(background_store_path)
+            else:
+                print("warning: unable to locate specified background store: " + background_store_path)
+
+        # a workbook per pool, written concurrently, plus an index workbook linking them
+        self.exporter = XlsxExporter(
+            basename=f'{pool_root}.preview' if self.sampler else pool_root,
+            split=self.config.get(CONFIG_FIELDS['SPLIT_EXPORT'], False),
+            split_summaries=self.config.get(CONFIG_FIELDS['SPLIT_SUMMARIES'], False),
+            workers=self.config.get(CONFIG_FIELDS['EXPORT_WORKERS']),
+            static_highlights=self.config.get(CONFIG_FIELDS['STATIC_HIGHLIGHTS'], False)
+        )
+
+    def import_columns(self):
+        """ The columns importers have to decode: selected, filtered on or analysed. None for every column """
+        if not self._select:
+            return None
+
+        columns = {*self._select, *self.data_filter.columns, *ANALYSIS_COLUMNS}
+
+        if c.gene_mean_qual in self.gene_statistics:
+            columns.add(c.qual)
+
+        return columns
+
+    @profiled('discovery')
+    def discover(self):
+        """ (Re-)discover the pool directories & a loader for each of their files, only probing new files """
+        self.pool_dirs = natsorted(next(os.walk(self.pool_root))[1])
+
+        loader_map = {}
+
+        for pool_dir in self.pool_dirs:
+            for path, loader in self._loader_map(pool_dir).items():
+                loader_map[path] = loader
+
+        self.loader_map = loader_map
+
+        return loader_map
 
     def _loader_map(self, pool_dir):
         filenames = glob.glob(
@@ -88,13 +304,28 @@ class GeneVariantIdentifier(object):
             )
         )
 
-        filenames = filter(os.path.isfile, filenames)
+        # tabix/CSI indexes sit next to their VCF, see VcfImporter.list_chromosomes
+        filenames = (
+            filename for filename in filenames
+            if os.path.isfile(filename) and not filename.endswith(INDEX_SUFFIXES)
+        )
 
         loader_map = {}
         for filename in filenames:
+            if (pool_dir, filename) in self.loader_map:
+                loader_map[(pool_dir, filename)] = self.loader_map[(pool_dir, filename)]
+                continue
+
+            # don't re-probe (and re-warn about) unidentified files until they change
+            signature = utils.file_signature(filename)
+            if self._unidentified.get(filename) == signature:
+                continue
+
             loader = self._loader_for(filename)
             if loader:
                 loader_map[(pool_dir, filename)] = loader
+            else:
+                self._unidentified[filename] = signature
 
         return loader_map
 
@@ -105,68 +336,78 @@ class GeneVariantIdentifier(object):
         print(f'unable to identify file: {filename}')
         return None
 
+    @profiled('chromosome discovery')
+    def discover_chromosomes(self):
+        chromosomes = set()
+        with Timer(factor=1000) as t:
+            for (pool_dir, filename), loader in self.loader_map.items():
+                chromosomes.update(loader.list_chromosomes(filename))
+            print("chromosome discovery took {}.ms".format(round(t.elapsed, 1)))
+        return natsorted(chromosomes)
+
     def apply(self):
-        df = self.load_dataframes()
+        if self.shards and self.chromosomes is None:
+            from .sharding import ShardRunner
+            return ShardRunner(self.pool_root, shards=self.shards).apply()
 
-        pivots = self.analyse(df)
+        if self.backend == SQLITE_BACKEND:
+            from .backends import SqliteBackend
+            return SqliteBackend(self, db_path=self.backend_path).apply()
+
+        if self.incremental:
+            from .incremental import AnalysisState
+            state = AnalysisState(self)
+            state.refresh()
+            pivots = state.analyse()
+        else:
+            df = self.load_dataframes()
+
+            pivots = self.analyse(df)
 
         with Timer(factor=1000) as t:
             outfile = self.exporter.export(pivots)
             print("xlsx export took {}.ms total".format(round(t.elapsed, 1)))
 
+        if self.sampler:
+            self.report_preview()
+
         return outfile
 
-    def load_dataframes(self):
+    def report_preview(self):
+        print(self.sampler.describe())
+        print("filter report:\n" + self.data_filter.describe_removed())
 
-        df = None
+    def load_dataframes(self):
 
         with Timer(factor=1000) as t:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-                future_map = {
-                    executor.submit(loader.import_as_dataframe, pool_dir, filename):
-                        (type(loader).__name__, pool_dir, filename)
-                    for (pool_dir, filename), loader in self.loader_map.items()
-                }
-                for future in concurrent.futures.as_completed(future_map):
-                    loader_name, pool_dir, filename = future_map[future]
-                    try:
-                        result = future.result()
-                    except Exception as exc:
-                        raise RuntimeError(
-                            '%r generated an exception while loading %r/%r: %s' % (loader_name, pool_dir, filename, exc)
-                        ) from exc
-                    else:
-                        if isinstance(df, type(None)):
-                            df = result
-                        else:
-                            df = utils.df_append(df, result, merge_categories=True, ignore_index=True)
-            df.reset_index(drop=True, inplace=True)
+            results = {}
+
+            for job, future in self.scheduler.as_completed(self.loader_map):
+                pool_dir, filename = job.key
+                try:
+                    results[job.key] = future.result()
+                except Exception as exc:
+                    raise RuntimeError(
+                        '%r generated an exception while loading %r/%r: %s' % (
+                            type(job.loader).__name__, pool_dir, filename, exc)
+                    ) from exc
+
+            # concatenated in discovery order regardless of the schedule, so row order is reproducible
+            df = utils.df_concat([results.pop(key) for key in self.loader_map], ignore_index=True)
+            self.data_filter.save_stats()
             print("pool imports took {}.ms total".format(round(t.elapsed, 1)))
         return df
 
-    def analyse(self, full_df):
-        with Timer(factor=1000) as t:
-            full_df = self.add_flagged_genes(full_df)
-
-            full_df = self.add_background_mutations(full_df)
-
-            full_df = self.add_candidate_pos_mutations(full_df)
-
-            full_df = self.add_candidate_gene_mutations(full_df)
+    def results(self, full_df=None, pools=None, sheets=None):
+        """ Lazily computed & memoized sheets, see lib.results.AnalysisResults """
+        from .results import AnalysisResults
+        return AnalysisResults(self, full_df=full_df, pools=pools, sheets=sheets)
 
-            full_df = self.add_candidate_gene_hh_ratios(full_df)
-
-            print("mutation analysis took {}.ms".format(round(t.elapsed, 1)))
+    def analyse(self, full_df):
+        full_df = self.annotate(full_df)
 
         with Timer(factor=1000) as t:
-            dfg = full_df.groupby(c.pool)
-
-            idx = [col for col in full_df.columns if col not in {c.sample, c.pool}]
-
-            dfs = {
-                pool: dfg.get_group(pool)
-                for pool in natsorted(dfg.groups.keys())
-            }
+            idx, dfs = self.split_pools(full_df)
 
             with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
                 future_map = {
@@ -186,91 +427,196 @@ class GeneVariantIdentifier(object):
 
             print("pool splitting took {}.ms total".format(round(t.elapsed, 1)))
 
+        dfs.update(self.summarise(full_df))
+
+        return dfs
+
+    def annotate(self, full_df):
+        """ Add the flagged gene & hit columns every sheet is built from """
         with Timer(factor=1000) as t:
-            dfs[c.COLUMNS[c.background].title] = full_df[full_df[c.background] > 0].sort_values(
-                    by=[c.background, c.chromo, c.pos, c.hh],
-                    ascending=[0, 1, 1, 0]).reset_index(drop=True)
-
-            dfs[c.COLUMNS[c.cand_pos].title] = full_df[
-                (full_df[c.cand_pos] > 0) & (full_df[c.background] == 0)].sort_values(
-                by=[c.cand_pos, c.chromo, c.pos, c.hh],
-                ascending=[0, 1, 1, 0]).reset_index(drop=True)
-
-            dfs[c.COLUMNS[c.cand_gene].title] = full_df[
-                (full_df[c.cand_gene] > 0) & (full_df[c.background] == 0)].sort_values(
-                by=[c.cand_gene, c.chromo, c.pos, c.hh],
-                ascending=[0, 1, 1, 0]).reset_index(drop=True)
-
-            if self.flagged_genes_loader and c.flagged_gene in full_df.columns:
-                dfs[c.COLUMNS[c.flagged_gene].title] = full_df[
-                    (full_df[c.flagged_gene] > 0) & (full_df[c.background] == 0)].sort_values(
-                    by=[c.chromo, c.pos, c.hh],
-                    ascending=[1, 1, 0]).reset_index(drop=True)
+            full_df = self.add_flagged_genes(full_df)
+
+            full_df = self.add_hit_columns(full_df)
+
+            full_df = self.add_stored_background(full_df)
+
+            full_df = self.add_gene_statistics(full_df)
+
+            print("mutation analysis took {}.ms".format(round(t.elapsed, 1)))
+
+        return full_df
+
+    @staticmethod
+    @profiled('split pools')
+    def split_pools(full_df, pools=None):
+        """ The pivot index columns & each pool's rows, in natural order """
+        dfg = full_df.groupby(c.pool)
+
+        idx = [col for col in full_df.columns if col not in {c.sample, c.pool}]
+
+        dfs = {
+            pool: dfg.get_group(pool)
+            for pool in natsorted(dfg.groups.keys())
+            if pools is None or pool in pools
+        }
+
+        return idx, dfs
+
+    def summary_columns(self, full_df):
+        """ Hit columns with a summary sheet for this frame, in output order """
+        return [
+            col for col in SUMMARY_SORTS
+            if col != c.flagged_gene or (self.flagged_genes_loader and c.flagged_gene in full_df.columns)
+        ]
+
+    @staticmethod
+    def summary_order(full_df):
+        """ Row positions of full_df in POOL_SORT order, shared by every summary sheet """
+        return full_df[POOL_SORT['by']].reset_index(drop=True).sort_values(**POOL_SORT).index.values
+
+    @staticmethod
+    def summary(full_df, col, order=None, top=None):
+        if order is None:
+            order = GeneVariantIdentifier.summary_order(full_df)
+
+        if col == c.background:
+            mask = full_df[c.background].values > 0
+        else:
+            mask = (full_df[col].values > 0) & (full_df[c.background].values == 0)
+
+        # the selected rows stay in POOL_SORT order, so a stable sort on the score key alone completes the order
+        rows = order[mask[order]]
+
+        sort = SUMMARY_SORTS[col]
+        score = len(sort['by']) - len(POOL_SORT['by'])
+
+        for by, ascending in reversed(list(zip(sort['by'][:score], sort['ascending'][:score]))):
+            values = full_df[by].values[rows]
+            rows = rows[np.argsort(values if ascending else -values, kind='mergesort')]
+
+        if top:
+            rows = rows[:top]
+
+        return full_df.take(rows).reset_index(drop=True)
+
+    @profiled('summarise')
+    def summarise(self, full_df):
+        with Timer(factor=1000) as t:
+            order = self.summary_order(full_df)
+
+            dfs = {
+                c.COLUMNS[col].title: self.summary(full_df, col, order=order, top=self.summary_top)
+                for col in self.summary_columns(full_df)
+            }
 
             print("summary results took {}.ms".format(round(t.elapsed, 1)))
 
         return dfs
 
+    @profiled('flagged genes')
     def add_flagged_genes(self, df):
         if not self.flagged_genes_loader:
             return df
 
-        flagged_genes = self.flagged_genes_loader.load()
+        flags = self.flagged_genes_loader.load_flags()
 
-        if (isinstance(flagged_genes, type(None))) or not len(flagged_genes):
+        if not flags:
             return df
 
-        df = df.merge(flagged_genes, left_on=c.gene_id, right_index=True, how='left')
-        fill_nas = {col: False for col in flagged_genes.columns}
-        return df.fillna(value=fill_nas)
-
-    @staticmethod
-    def add_background_mutations(df):
-        return GeneVariantIdentifier._add_hit_column(df, c.background, [c.chromo, c.pos], c.pool)
+        # membership of each distinct gene id, broadcast back to the rows, missing gene ids (-1) aren't flagged
+        codes, gene_ids = pd.factorize(df[c.gene_id])
+        gene_ids = pd.Index(gene_ids)
+
+        # on a copy, like the merge this replaced, so the caller's frame is left as it was
+        return df.assign(**{
+            col: np.append(gene_ids.isin(list(genes)), False)[codes] for col, genes in flags.items()
+        })
+
+    @profiled('hit columns')
+    def add_hit_columns(self, df):
+        """ Background, candidate positional & candidate gene hits, see lib.membership.Membership """
+        self.membership = Membership(df)
+        return self.membership.add_hit_columns(df)
+
+    @profiled('stored background')
+    def add_stored_background(self, df):
+        """ Count sites seen in other projects' runs, see lib.background_store, as one more background pool """
+        if not self.background_store or df.empty:
+            return df
 
-    @staticmethod
-    def add_candidate_pos_mutations(df):
-        return GeneVariantIdentifier._add_hit_column(df, c.cand_pos, [c.pool, c.chromo, c.pos], c.sample)
+        df[c.background] += self.background_store.contains(
+            df[c.chromo], df[c.pos], exclude_source=os.path.abspath(self.pool_root)
+        )
 
-    @staticmethod
-    def add_candidate_gene_mutations(df):
-        return GeneVariantIdentifier._add_hit_column(df, c.cand_gene, [c.gene_id], c.sample)
+        return df
 
-    @staticmethod
-    def add_candidate_gene_hh_ratios(df):
+    @profiled('gene statistics')
+    def add_gene_statistics(self, df):
+        """
+        Per gene homozygous ratio & any configured Gene Statistics, counted with bincounts over the factorized
+        gene ids & broadcast back to the rows. Rows of genes without any hh values get the column's na_fill.
+        """
         if df.empty:
             return df
 
+        genes, gene_ids = pd.factorize(df[c.gene_id])
+        n_genes = len(gene_ids)
+        rows = genes >= 0  # NaN gene ids aren't counted
+        genes = genes[rows]
+
+        def broadcast(col, values):
+            out = np.full(len(df), c.COLUMNS[col].na_fill, dtype=np.float64 if values.dtype.kind == 'f' else np.int64)
+            out[rows] = values[genes]
+            df[col] = out
+
+        hh_codes = df[c.hh].cat.codes.values[rows]
         hh_values = list(df.dtypes[c.hh].categories)  # ['Het', 'Hom']
 
-        if c.hom not in hh_values:
-            print(f'{c.hom} not found in {c.hh} values: {str(hh_values)}')
-            return df
+        if self.hom_label in hh_values:
+            counted = hh_codes >= 0
+            total = np.bincount(genes[counted], minlength=n_genes)
+            hom = np.bincount(genes[counted & (hh_codes == hh_values.index(self.hom_label))], minlength=n_genes)
 
-        df_hh = df.pivot_table(index=[c.gene_id], columns=[c.hh], aggfunc={c.sample: 'count'}, fill_value=0)
+            # percentage of total that are Homo
+            ratio = np.where(total > 0, hom / np.maximum(total, 1), c.FLOAT64_DEFAULT)
 
-        # percentage of total that are Homo
-        df_hh = (df_hh[(c.sample, c.hom)] / sum(df_hh[(c.sample, h)] for h in hh_values))
+            broadcast(c.cand_gene_hom_ratio, ratio)
+        else:
+            print(f'{self.hom_label} not found in {c.hh} values: {str(hh_values)}')
 
-        df_hh = df_hh.to_frame(name=c.cand_gene_hom_ratio)
+        if c.gene_samples in self.gene_statistics:
+            broadcast(c.gene_samples, self._distinct_per_gene(genes, n_genes, df[c.sample].cat.codes.values[rows]))
 
-        return df.merge(
-            df_hh,
-            left_on=[c.gene_id],
-            right_on=[c.gene_id],
-            how='inner'
-        )
+        if c.gene_positions in self.gene_statistics:
+            chromos = pd.factorize(df[c.chromo])[0][rows]
+            positions, uniques = pd.factorize(df[c.pos])
+            broadcast(
+                c.gene_positions,
+                self._distinct_per_gene(genes, n_genes, chromos * (len(uniques) + 1) + positions[rows])
+            )
+
+        if c.gene_mean_qual in self.gene_statistics:
+            if c.qual in df.columns:
+                qual = df[c.qual].values[rows].astype(np.float64)
+                counted = ~np.isnan(qual)
+                total = np.bincount(genes[counted], minlength=n_genes)
+                qual_sum = np.bincount(genes[counted], weights=qual[counted], minlength=n_genes)
+                broadcast(c.gene_mean_qual, np.where(total > 0, qual_sum / np.maximum(total, 1), c.FLOAT64_DEFAULT))
+            else:
+                print(f'{c.gene_mean_qual} needs the {c.qual} column')
+
+        return df
 
     @staticmethod
-    def _add_hit_column(df, title, intersect, count_by, agg='nunique'):
-        return df.merge(
-            (df.groupby(intersect)[count_by].agg(agg) - 1).to_frame(name=title),
-            left_on=intersect,
-            right_on=intersect,
-            how='inner'
-        )
+    def _distinct_per_gene(genes, n_genes, codes):
+        """ Count of distinct, non-NaN `codes` for each gene """
+        counted = codes >= 0
+        radix = int(codes.max()) + 1 if counted.any() else 1
+        pairs = np.unique(genes[counted].astype(np.int64) * radix + codes[counted])
+        return np.bincount(pairs // radix, minlength=n_genes)
 
     @staticmethod
+    @profiled('pivot', detail=lambda idx, pool, df: pool)
     def _pivot(idx, pool, df):
         with Timer(factor=1000) as t:
             def agg(x):
@@ -283,9 +629,7 @@ class GeneVariantIdentifier(object):
                 fill_value=0
             )
 
-            df2 = df1.sort_values(
-                by=[c.chromo, c.pos, c.hh],
-                ascending=[1, 1, 0])
+            df2 = df1.sort_values(**POOL_SORT)
 
             df = utils.reset_categorical_index(df2)
 
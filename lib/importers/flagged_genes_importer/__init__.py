@@ -1,12 +1,23 @@
 import os
 import re
 import glob
-import functools
+import json
+import hashlib
 import pandas as pd
-from lib import columns as c
+from lib import utils, columns as c
 
 GENE_ID_REGEX = re.compile(r'^AT(?:[1-5]|M|C)G[0-9]{5}(?:\.[0-9]+)?$')  # assuming upper & stripped
 
+# parsed gene lists are cached in the user's cache directory rather than next to the workbook, which may be
+# shared or read-only, one json file per workbook path, keyed by its size & mtime
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'gene_variant_identifier', 'flagged_genes'
+)
+
+# and per process, so batch runs sharing a workbook only read it once
+_gene_lists = {}
+
 
 class FlaggedGenesImporter(object):
     def __init__(self, path=None, filename=None, details=False):
@@ -35,30 +46,92 @@ class FlaggedGenesImporter(object):
 
         self.details = details
 
-    def load(self):
+    def load_gene_lists(self):
+        """ {sheet name: sorted gene ids} of the workbook, from cache unless it changed """
         if not self.absolute_path:
             return None
 
+        signature = utils.file_signature(self.absolute_path)
+        key = (self.absolute_path, signature)
+
+        if key in _gene_lists:
+            return _gene_lists[key]
+
+        cache_file = self.cache_file()
+        gene_lists = None
+
+        if os.path.isfile(cache_file):
+            # noinspection PyBroadException
+            try:
+                with open(cache_file) as file:
+                    cached = json.load(file)
+                if cached['path'] == self.absolute_path and tuple(cached['signature']) == signature:
+                    gene_lists = cached['gene_lists']
+            except Exception:
+                pass
+
+        if gene_lists is None:
+            gene_lists = self.parse()
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+                with open(tmp_file, 'w') as file:
+                    json.dump({'path': self.absolute_path, 'signature': signature, 'gene_lists': gene_lists}, file)
+                os.replace(tmp_file, cache_file)
+            except OSError as e:
+                print(f'warning: unable to cache flagged genes to {cache_file}: {e}')
+
+        _gene_lists[key] = gene_lists
+
+        return gene_lists
+
+    def cache_file(self):
+        return os.path.join(CACHE_DIR, hashlib.sha1(self.absolute_path.encode()).hexdigest() + '.json')
+
+    def parse(self):
         xls = pd.ExcelFile(self.absolute_path)
 
-        flagged_genes = {
-            sheet_name: xls.parse(sheet_name, parse_cols=0).iloc[:, 0].astype(str).str.upper().str.strip()
-            for sheet_name in xls.sheet_names
-        }
-
-        flagged_genes = [
-            sheet[sheet.str.match(GENE_ID_REGEX)]
-            .drop_duplicates()
-            .sort_values()
-            .to_frame(name=c.gene_id)
-            .assign(**{sheet_name: True})
-            .set_index(c.gene_id)
-            for sheet_name, sheet in flagged_genes.items()
-        ]
-
-        flagged_genes = functools.reduce(
-            lambda a, b: a.join(b, how='outer'), flagged_genes, pd.DataFrame()
-        ).fillna(False)
+        gene_lists = {}
+
+        for sheet_name in xls.sheet_names:
+            sheet = xls.parse(sheet_name, usecols=[0])
+            sheet = sheet.iloc[:, 0].astype(str).str.upper().str.strip() if len(sheet.columns) else pd.Series([])
+            gene_lists[sheet_name] = sorted(set(sheet[sheet.str.match(GENE_ID_REGEX)]))
+
+        return gene_lists
+
+    def load_flags(self):
+        """ {column: gene ids} for the flagged gene column & the per sheet detail columns, if any genes """
+        gene_lists = self.load_gene_lists()
+
+        if not gene_lists:
+            return None
+
+        flagged_genes = set().union(*gene_lists.values())
+
+        if not flagged_genes:
+            return None
+
+        flags = {c.flagged_gene: flagged_genes}
+
+        if self.details:
+            flags.update(gene_lists)
+
+        return flags
+
+    def load(self):
+        gene_lists = self.load_gene_lists()
+
+        if gene_lists is None:
+            return None
+
+        index = pd.Index(sorted(set().union(*gene_lists.values())), name=c.gene_id)
+
+        flagged_genes = pd.DataFrame(
+            {sheet_name: index.isin(genes) for sheet_name, genes in gene_lists.items()},
+            index=index,
+            columns=list(gene_lists.keys())
+        )
 
         flagged_genes = flagged_genes.assign(**{c.flagged_gene: True})
 
@@ -66,4 +139,3 @@ class FlaggedGenesImporter(object):
         cols = cols[-1:] + cols[:-1] if self.details else cols[-1:]
 
         return flagged_genes[cols]
-
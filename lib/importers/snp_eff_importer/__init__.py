@@ -1,11 +1,21 @@
+import io
 import os
 import re
+import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = None
+    pa_csv = None
+
 from contexttimer import Timer
 import concurrent.futures
 
 from lib import utils, columns as c
+from lib.profiling import profiled
 
 EXTENSION = 'snpeff'
 
@@ -15,13 +25,135 @@ COMMENT_START = '# '
 HEADER_START = COMMENT_START + c.COLUMNS[c.chromo].title
 HEADER_SEP = '\t'
 
+# rows per chunk when streaming a file, e.g. to pick out a shard's chromosomes
+CHUNK_SIZE = 100000
+
+# bytes per read when picking out the lines of a preview's rows
+BLOCK_SIZE = 4 * 1024 * 1024
+
+NEWLINE = ord('\n')
+TAB = ord('\t')
+COMMENT = ord('#')
+ZERO = ord('0')
+NINE = ord('9')
+
+# lines of nothing else are blank to pandas, so aren't rows
+SPACES = [ord(' '), ord('\r')]
+BLANKS = [*SPACES, NEWLINE]
+
+WORD = 8  # bytes in a uint64
+
+# bytes of each field stepped over looking for the tab ending it, see field_bounds
+STEP_BYTES = 32
+
+PANDAS_ENGINE = 'pandas'
+ARROW_ENGINE = 'arrow'  # multi-threaded pyarrow reader, if installed
+ENGINES = [PANDAS_ENGINE, ARROW_ENGINE]
+
+ARROW_TYPES = {
+    c.CATEGORY: pa.dictionary(pa.int32(), pa.string()) if pa else None,
+    c.OBJECT: pa.string() if pa else None,
+    c.UINT64: pa.uint64() if pa else None,
+    c.FLOAT64: pa.float64() if pa else None
+}
+
+
+def next_index(indexes, starts, ends):
+    """ The first of the sorted `indexes` at or after each start, or its end if that comes first """
+    following = np.searchsorted(indexes, starts)
+    return np.minimum(np.append(indexes, ends.max(initial=0))[following], ends)
+
+
+def field_bounds(buffer, starts, ends, fields):
+    """
+    Start & end offsets of each of the tab separated `fields` of every line, empty where a line has fewer. Tabs are
+    looked for by stepping over the first STEP_BYTES of the fields of all lines at once, which is cheap for the
+    leading fields, and only lines with longer fields search the tabs of the whole buffer.
+    """
+    last = len(buffer) - 1
+    bounds = {}
+    field_starts = starts
+    for field in range(max(fields) + 1):
+        field_ends = ends.copy()
+        found = field_starts >= ends
+        for i in range(STEP_BYTES):
+            if found.all():
+                break
+            offsets = field_starts + i
+            ended = ~found & ((offsets >= ends) | (buffer[np.minimum(offsets, last)] == TAB))
+            field_ends[ended] = offsets[ended]
+            found |= ended
+        if not found.all():
+            lines = np.flatnonzero(~found)
+            field_ends[lines] = next_index(np.flatnonzero(buffer == TAB), field_starts[lines], ends[lines])
+        bounds[field] = field_starts, field_ends
+        field_starts = np.minimum(field_ends + 1, ends)
+    return bounds
+
+
+def field_bytes(buffer, starts, ends, width):
+    """ The bytes of each field as rows of a fixed `width`, NUL padded """
+    last = len(buffer) - 1
+    chars = np.empty((len(starts), width), dtype=np.uint8)
+    for i in range(width):
+        offsets = starts + i
+        chars[:, i] = np.where(offsets < ends, buffer[np.minimum(offsets, last)], 0)
+    return chars
+
+
+def factorize_fields(buffer, starts, ends):
+    """ Codes & distinct decoded values of the fields, telling them apart by all of their bytes """
+    width = max(int((ends - starts).max(initial=0)), 1)
+    if width <= WORD:
+        # short fields are exactly their padded bytes as a single integer
+        words = field_bytes(buffer, starts, ends, WORD).view(np.uint64).ravel()
+        codes, uniques = pd.factorize(words)
+        values = uniques.astype(np.uint64).view(f'S{WORD}')
+    else:
+        codes, values = pd.factorize(field_bytes(buffer, starts, ends, width).view(f'S{width}').ravel())
+    return codes, [value.decode() for value in values]
+
+
+def field_integers(buffer, starts, ends):
+    """ The leading decimal digits of each field """
+    last = len(buffer) - 1
+    values = np.zeros(len(starts), dtype=np.uint64)
+    parsing = starts < ends
+    offsets = starts
+    while parsing.any():
+        digits = buffer[np.minimum(offsets, last)]
+        parsing &= (offsets < ends) & (digits >= ZERO) & (digits <= NINE)
+        values = np.where(parsing, values * np.uint64(10) + (digits - ZERO).astype(np.uint64), values)
+        offsets = offsets + 1
+    return values
+
 
 class SnpEffImporter(object):
     def __init__(self,
                  data_filter=None,
-                 select=None):
+                 select=None,
+                 chromosomes=None,
+                 columns=None,
+                 annotations=None,
+                 engine=PANDAS_ENGINE,
+                 sampler=None):
         self._filter = data_filter
         self._select = select
+        self._chromosomes = chromosomes
+        self._sampler = sampler  # lib.sampling.SiteSampler, for preview runs
+        self._annotations = annotations or []  # lib.annotations.IntervalAnnotation, applied before filtering
+        self._columns = columns  # only these are parsed, all recognized columns if None
+
+        if engine == ARROW_ENGINE and pa is None:
+            print(f"warning: pyarrow not installed, using the {PANDAS_ENGINE} SnpEff engine")
+            engine = PANDAS_ENGINE
+
+        self._engine = engine
+
+    @property
+    def counters(self):
+        """ Filter & sampler, whose counts import worker processes send back, see lib.scheduler """
+        return [counter for counter in (self._filter, self._sampler) if counter is not None]
 
     @classmethod
     def can_load(cls, filename):
@@ -36,6 +168,7 @@ class SnpEffImporter(object):
         except StopIteration:
             return False
 
+    @profiled('snpeff import', detail=lambda self, pool_dir, filename: filename)
     def import_as_dataframe(self, pool_dir, filename):
         with Timer(factor=1000) as t:
             sample_name = self.extract_sample_name(filename)
@@ -46,33 +179,61 @@ class SnpEffImporter(object):
                 print("warning: cannot find header in SnpEff TXT file, skipping: " + filename)
                 return None
 
-            to_add = {
-                c.pool: pool_dir,
-                c.sample: sample_name
-            }
+            df = self._prepare(df, pool_dir, sample_name)
 
-            df = df.assign(**to_add)
+            print("snpeff import of {} took {}.ms".format(filename, round(t.elapsed, 1)))
+        return df
 
-            for col in to_add.keys():
-                df[col] = df[col].astype(c.COLUMNS[col].dtype)
+    def iter_dataframes(self, pool_dir, filename, chunksize=CHUNK_SIZE):
+        """ Import as filtered chunks of at most `chunksize` rows, so the whole file is never held in memory """
+        sample_name = self.extract_sample_name(filename)
 
-            self._filter.apply(df, inplace=True)
+        try:
+            chunks = self.read_snp_txt(filename, chunksize=chunksize)
+        except StopIteration:
+            print("warning: cannot find header in SnpEff TXT file, skipping: " + filename)
+            return
 
-            if self._select:
-                df = df[[*self._select, *to_add.keys()]]
+        for chunk in chunks:
+            yield self._prepare(chunk, pool_dir, sample_name)
 
-            for col in df.columns:
-                if df[col].dtype.name == 'category':
-                    df[col] = df[col].cat.remove_unused_categories()
+    @profiled('snpeff prepare')
+    def _prepare(self, df, pool_dir, sample_name):
+        to_add = {
+            c.pool: pool_dir,
+            c.sample: sample_name
+        }
 
-            df.reset_index(drop=True, inplace=True)
+        df = df.assign(**to_add)
+
+        for col in to_add.keys():
+            df[col] = df[col].astype(c.COLUMNS[col].dtype)
+
+        for annotation in self._annotations:
+            df = annotation.annotate(df)
+
+        self._filter.apply(df, inplace=True)
+
+        if self._select:
+            df = df[[*self._select, *to_add.keys()]]
+
+        for col in df.columns:
+            if df[col].dtype.name == 'category':
+                df[col] = df[col].cat.remove_unused_categories()
+
+        df.reset_index(drop=True, inplace=True)
 
-            print("snpeff import of {} took {}.ms".format(filename, round(t.elapsed, 1)))
         return df
 
-    def read_snp_txt(self, filename):
+    def read_snp_txt(self, filename, chunksize=None):
         columns, use_columns, dtypes = self.extract_columns(filename)
 
+        sampled = self._sampled(filename, columns)
+
+        if self._columns is not None:
+            use_columns = [col for col in use_columns if col in self._columns or col == c.chromo]
+            dtypes = {col: dtypes[col] for col in use_columns}
+
         kwargs = {
             'comment': '#',
             'header': None,
@@ -83,7 +244,206 @@ class SnpEffImporter(object):
             'keep_default_na': False
         }
 
-        return pd.read_csv(filename, **kwargs)
+        if sampled:
+            return self._read_sampled(filename, columns, use_columns, dtypes, kwargs, chunksize)
+
+        if chunksize:
+            return self._read_chunks(filename, chunksize, kwargs)
+
+        if self._engine == ARROW_ENGINE:
+            df = self._read_arrow(filename, columns, use_columns, dtypes)
+            if df is not None:
+                if self._chromosomes:
+                    df = df[df[c.chromo].isin(self._chromosomes)].reset_index(drop=True).astype(dtypes)
+                return df
+
+        if not self._chromosomes:
+            return pd.read_csv(filename, **kwargs)
+
+        chunks = list(self._read_chunks(filename, CHUNK_SIZE, kwargs))
+
+        if not chunks:
+            return pd.read_csv(filename, nrows=0, **kwargs)
+
+        # chunks are categorized independently, so re-apply the dtypes across the whole shard or preview
+        return pd.concat(chunks, ignore_index=True).astype(dtypes)
+
+    def _sampled(self, filename, columns):
+        """ Whether to sample the file's rows for a preview """
+        if not self._sampler:
+            return False
+
+        if c.chromo not in columns or c.pos not in columns:
+            print(f"warning: no {c.chromo} & {c.pos} columns to preview by, reading all of: {filename}")
+            return False
+
+        return True
+
+    def _read_sampled(self, filename, columns, use_columns, dtypes, kwargs, chunksize=None):
+        """
+        The rows of a preview's sites. Only the chromo & pos fields of each line are picked out of the raw bytes to
+        choose them, & only the lines of the rows kept are handed on to the parser, so the rest are never parsed.
+        """
+        with Timer(factor=1000) as t:
+            data = self._kept_lines(filename, columns.index(c.chromo), columns.index(c.pos))
+            print("picking out the preview rows of {} took {}.ms".format(filename, round(t.elapsed, 1)))
+
+        if not data:
+            df = pd.read_csv(filename, nrows=0, **kwargs)
+            return [df] if chunksize else df
+
+        if chunksize:
+            return pd.read_csv(io.BytesIO(data), chunksize=chunksize, **kwargs)
+
+        if self._engine == ARROW_ENGINE:
+            df = self._read_arrow(io.BytesIO(data), columns, use_columns, dtypes)
+            if df is not None:
+                return df
+
+        return pd.read_csv(io.BytesIO(data), **kwargs)
+
+    def _kept_lines(self, filename, chromo_field, pos_field):
+        """
+        The lines of the file's rows at a preview's sites (& on a shard's chromosomes), read block by block. Rows
+        are told apart from comment & blank lines like pandas does, and end at a comment character like its rows.
+        """
+        kept = []
+        rest = b''
+
+        with open(filename, 'rb') as file:
+            while True:
+                block = file.read(BLOCK_SIZE)
+                data = rest + block
+                if block:
+                    # whole lines only, the rest goes with the next block
+                    end = data.rfind(b'\n') + 1
+                    data, rest = data[:end], data[end:]
+                elif data and not data.endswith(b'\n'):
+                    data += b'\n'
+
+                if data:
+                    kept.extend(self._kept_block(data, chromo_field, pos_field))
+
+                if not block:
+                    break
+
+        return b'\n'.join(kept) + b'\n' if kept else b''
+
+    def _kept_block(self, data, chromo_field, pos_field):
+        buffer = np.frombuffer(data, dtype=np.uint8)
+
+        ends = np.flatnonzero(buffer == NEWLINE)
+        starts = np.concatenate([[0], ends[:-1] + 1])
+
+        first = buffer[starts]
+        rows = (first != COMMENT) & ~np.isin(first, BLANKS)
+        # lines starting with a space are rows unless they're all blank, rare enough to check one by one
+        for i in np.flatnonzero(np.isin(first, SPACES)):
+            rows[i] = bool(data[starts[i]:ends[i]].strip(b' \r'))
+
+        starts, ends = starts[rows], ends[rows]
+
+        if not len(starts):
+            return []
+
+        # pandas' comment character ends a row wherever it is
+        row_ends = next_index(np.flatnonzero(buffer == COMMENT), starts, ends) if b'#' in data else ends
+        bounds = field_bounds(buffer, starts, row_ends, [chromo_field, pos_field])
+
+        codes, chromo_values = factorize_fields(buffer, *bounds[chromo_field])
+        chromos = pd.Categorical.from_codes(codes, chromo_values)
+        positions = field_integers(buffer, *bounds[pos_field])
+
+        keep = np.ones(len(starts), dtype=bool)
+        if self._chromosomes:
+            keep = np.isin(chromos.categories, list(self._chromosomes))[codes]
+        keep[keep] = self._sampler.mask(chromos[keep], positions[keep])
+
+        # cut at any comment, so the arrow engine reads them like pandas
+        return [data[start:end] for start, end in zip(starts[keep], row_ends[keep])]
+
+    @staticmethod
+    def _read_arrow(source, columns, use_columns, dtypes):
+        """
+        Parse with pyarrow's multi-threaded reader straight from `source` (a filename or binary file), categories
+        from its dictionary encoding. Leading comment lines of a file are skipped by count & later ones as invalid
+        rows. Rows pandas would read differently, e.g. short rows it fills with NaN, make it give up & return None,
+        leaving the file to pandas.
+        """
+        skip_rows = 0
+        if isinstance(source, str):
+            with open(source, 'rb') as file:
+                for line in file:
+                    if not line.startswith(b'#'):
+                        break
+                    skip_rows += 1
+
+        def invalid_row(row):
+            return 'skip' if row.text.startswith('#') else 'error'
+
+        # unrecognized columns still need a unique name to be skipped by
+        column_names = [col if col is not None else f'_unused_{i}' for i, col in enumerate(columns)]
+
+        # comment lines with a full row of fields parse fine, so they're picked out by their first field
+        first = column_names[0]
+        column_types = {col: ARROW_TYPES[dtype] for col, dtype in dtypes.items()}
+        column_types.setdefault(first, ARROW_TYPES[c.CATEGORY])
+
+        try:
+            table = pa_csv.read_csv(
+                source,
+                read_options=pa_csv.ReadOptions(column_names=column_names, skip_rows=skip_rows, use_threads=True),
+                parse_options=pa_csv.ParseOptions(delimiter='\t', invalid_row_handler=invalid_row),
+                convert_options=pa_csv.ConvertOptions(
+                    include_columns=use_columns if first in use_columns else [first, *use_columns],
+                    column_types=column_types,
+                    strings_can_be_null=False
+                )
+            )
+        except pa.ArrowInvalid as exc:
+            print(f"warning: {ARROW_ENGINE} engine can't read {getattr(source, 'name', source)}, using "
+                  f"{PANDAS_ENGINE}: {str(exc).splitlines()[0]}")
+            return None
+
+        df = table.to_pandas(self_destruct=True)
+
+        commented = df[first].str.startswith('#').values
+        if commented.any():
+            df = df[~commented].reset_index(drop=True)
+            df[first] = df[first].cat.remove_unused_categories()
+        if first not in use_columns:
+            del df[first]
+
+        # pandas sorts inferred categories, arrow keeps them in order of appearance
+        for col, dtype in dtypes.items():
+            if dtype == c.CATEGORY:
+                df[col] = df[col].cat.reorder_categories(sorted(df[col].cat.categories))
+
+        return df
+
+    def _read_chunks(self, filename, chunksize, kwargs):
+        for chunk in pd.read_csv(filename, chunksize=chunksize, **kwargs):
+            if self._chromosomes:
+                chunk = chunk[chunk[c.chromo].isin(self._chromosomes)]
+            yield chunk
+
+    def list_chromosomes(self, filename):
+        columns, *_ = self.extract_columns(filename)
+
+        if c.chromo not in columns:
+            return []
+
+        df = pd.read_csv(
+            filename,
+            comment='#',
+            header=None,
+            names=columns,
+            usecols=[c.chromo],
+            dtype={c.chromo: c.CATEGORY},
+            sep='\t'
+        )
+
+        return list(df[c.chromo].cat.categories)
 
     @staticmethod
     def extract_columns(filename):
@@ -1,4 +1,5 @@
 import re
+import itertools
 import pandas as pd
 from contexttimer import Timer
 
@@ -6,6 +7,7 @@ from contexttimer import Timer
 from pysam import VariantFile
 
 from lib import columns as c
+from lib.profiling import profiled
 
 info_list_regex = re.compile(r'^.*: \'(.+)\'\s*$')
 info_list_sep_regex = re.compile(r'[|(]')
@@ -16,9 +18,22 @@ gene_id_regex = re.compile(r'^AT[1-5]G\d{5}$')
 class VcfImporter(object):
     def __init__(self,
                  data_filter=None,
-                 select=None):
+                 select=None,
+                 chromosomes=None,
+                 columns=None,
+                 annotations=None,
+                 sampler=None):
         self._filter = data_filter
         self._select = select
+        self._chromosomes = chromosomes
+        self._sampler = sampler  # lib.sampling.SiteSampler, for preview runs
+        self._annotations = annotations or []  # lib.annotations.IntervalAnnotation, applied before filtering
+        self._columns = columns  # only these effect fields are split out, all of them if None
+
+    @property
+    def counters(self):
+        """ Filter & sampler, whose counts import worker processes send back, see lib.scheduler """
+        return [counter for counter in (self._filter, self._sampler) if counter is not None]
 
     @classmethod
     def can_load(cls, filename):
@@ -42,6 +57,7 @@ class VcfImporter(object):
                     pass
         return True
 
+    @profiled('vcf import', detail=lambda self, pool_dir, filename: filename)
     def import_as_dataframe(self, pool_dir, filename):
         with Timer(factor=1000) as t:
             vcf_in = VariantFile(filename)
@@ -88,34 +104,56 @@ class VcfImporter(object):
 
             eff_fields = [s.strip(' ][)') for s in info_list_sep_regex.split(desc_match[1])]
 
-            num_eff_field = len(eff_fields)
-
             if not eff_fields:
                 print("warning: unable to parse vcf snpEff effect fields, skipping: " + filename)
                 return None
 
-            def split_effects(eff):
-                a = [s.strip(' )') or None for s in info_list_sep_regex.split(eff[0])] if eff else []
-                missing = num_eff_field - len(a)
-                if missing:
-                    a.extend([None] * missing)
-                return a
-
-            raw_columns = [
+            base_columns = [
                 c.chromo,
                 c.pos,
                 c.ref,
                 c.change,
                 c.change_type,
-                c.hh,
-                *eff_fields,
+                c.hh
+            ]
+
+            # typed only if every field is recognized, so decide before leaving out the unneeded ones
+            typed = None not in c.normalize([*base_columns, *eff_fields, c.sample])
+
+            needed = self._eff_columns()
+
+            eff_indexes = [
+                i for i, field in enumerate(eff_fields)
+                if needed is None or field in needed or c.LOOKUP.get(field) in needed
+            ]
+
+            def split_effects(eff):
+                a = info_list_sep_regex.split(eff[0]) if eff else []
+                num_split = len(a)
+                return [(a[i].strip(' )') or None) if i < num_split else None for i in eff_indexes]
+
+            raw_columns = [
+                *base_columns,
+                *(eff_fields[i] for i in eff_indexes),
                 c.sample
             ]
 
+            chromosomes = self._chromosomes
+            sampler = self._sampler
+            sampled = [0, 0]  # records seen & kept by the sampler
+
             def row_gen():
-                for rec in vcf_in:
-                    chrom = rec.chrom if rec.chrom.startswith('chr') else f'chr{rec.chrom}'
+                for rec in self._records(vcf_in, chromosomes):
+                    chrom = self.normalize_chromosome(rec.chrom)
+                    if chromosomes and chrom not in chromosomes:
+                        continue
                     pos = rec.pos
+                    if sampler:
+                        # before any of the record's info is decoded
+                        sampled[0] += 1
+                        if not sampler.keep(chrom, pos):
+                            continue
+                        sampled[1] += 1
                     ref = rec.ref
                     alts = rec.alts
                     num_alts = len(alts)
@@ -141,7 +179,7 @@ class VcfImporter(object):
 
             columns = [col for col in normalized_columns if col is not None]
 
-            if len(columns) == len(raw_columns):
+            if typed:
                 dtype = {}
                 defaults = {}
 
@@ -159,7 +197,16 @@ class VcfImporter(object):
 
             vcf_in.close()
 
-            if c.gene_id not in df.columns:
+            if sampler:
+                sampler.count(*sampled)
+
+            has_gene_ids = c.gene_id in df.columns
+
+            # annotated gene ids take precedence over those derived below, which only fill in the rest
+            for annotation in self._annotations:
+                df = annotation.annotate(df)
+
+            if not has_gene_ids:
 
                 gene_id_candidates = {}
 
@@ -187,7 +234,12 @@ class VcfImporter(object):
                     best = gene_id_candidates[best_col_key]
                     method = best['method']
                     print(f'{c.gene_id} was {method} from {best_col_key} in {filename}')
-                    df[c.gene_id] = best['column']
+                    if c.gene_id in df.columns:
+                        gene_ids = df[c.gene_id]
+                        missing = gene_ids.isna() | (gene_ids.astype(str) == c.OBJECT_DEFAULT)
+                        df[c.gene_id] = gene_ids.astype(object).where(~missing, best['column'].astype(object))
+                    else:
+                        df[c.gene_id] = best['column']
 
             to_add = {
                 c.pool: pool_dir
@@ -215,3 +267,45 @@ class VcfImporter(object):
             print("vcf import of {} took {}.ms".format(filename, round(t.elapsed, 1)))
 
             return df
+
+    def _eff_columns(self):
+        """ Effect fields to split out, None for all. gene_id may be derived from gene_name or transcript_id """
+        if self._columns is None:
+            return None
+
+        if c.gene_id in self._columns:
+            return {*self._columns, c.gene_name, c.transcript_id}
+
+        return self._columns
+
+    def iter_dataframes(self, pool_dir, filename, chunksize=None):
+        """ gene_id derivation needs to see the whole file, so this yields a single chunk """
+        df = self.import_as_dataframe(pool_dir, filename)
+        if df is not None:
+            yield df
+
+    def _records(self, vcf_in, chromosomes):
+        """ Every record, or with `chromosomes` & a tabix/CSI index only those of the shard's contigs """
+        if not chromosomes or vcf_in.index is None:
+            return vcf_in
+        return itertools.chain.from_iterable(
+            vcf_in.fetch(contig) for contig in vcf_in.index
+            if self.normalize_chromosome(contig) in chromosomes
+        )
+
+    def list_chromosomes(self, filename):
+        with VariantFile(filename) as vcf_in:
+            if vcf_in.index is not None:
+                # a tabix index only lists the contigs with records, so no shard is planned for the others
+                contigs = list(vcf_in.index)
+            else:
+                print(f'warning: no tabix/CSI index for {filename}, every chromosome shard reads all of it')
+                contigs = list(vcf_in.header.contigs)
+                if not contigs:
+                    # no ##contig lines in the header, so we have to scan the records
+                    contigs = {rec.chrom for rec in vcf_in}
+        return {self.normalize_chromosome(contig) for contig in contigs}
+
+    @staticmethod
+    def normalize_chromosome(chrom):
+        return chrom if chrom.startswith('chr') else f'chr{chrom}'
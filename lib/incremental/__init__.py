@@ -0,0 +1,403 @@
+import os
+import shutil
+import hashlib
+import pandas as pd
+from natsort import natsorted
+from contexttimer import Timer
+
+from lib.gene_variant_identifier import GeneVariantIdentifier
+from lib.background_store import MANIFEST_FILE
+from lib import utils, columns as c
+
+STATE_FILE = 'state.pkl'
+FRAMES_DIR = 'frames'
+POOLS_DIR = 'pools'
+# pivot caches of the first layout, removed on save
+PIVOTS_DIR = 'pivots'
+
+# bumped when the layout of the state changes, older states are rebuilt
+STATE_VERSION = 2
+
+# Row counts kept per key, summed over every imported file. A key is present while its count is non-zero,
+# so these are the per-site pool & sample sets and per-gene sample & Het/Hom counts the hit columns derive from.
+COUNTS = {
+    'site_pools': [c.chromo, c.pos, c.pool],
+    'site_samples': [c.pool, c.chromo, c.pos, c.sample],
+    'gene_samples': [c.gene_id, c.sample],
+    'gene_hh': [c.gene_id, c.hh]
+}
+
+HIT_COLUMNS = [c.background, c.cand_pos, c.cand_gene, c.cand_gene_hom_ratio]
+
+
+def _contribution(df, keys):
+    if df is None or df.empty or any(key not in df.columns for key in keys):
+        return pd.Series([], dtype='int64')
+    # plain object keys, so contributions of differently categorized files align
+    return df.groupby([df[key].astype(c.OBJECT) for key in keys]).size()
+
+
+def _add(counts, contribution, sign=1):
+    if counts is None or counts.empty:
+        return contribution * sign if sign > 0 else None
+    if contribution.empty:
+        return counts
+    counts = counts.add(contribution * sign, fill_value=0).astype('int64')
+    return counts[counts > 0]
+
+
+class AnalysisState(object):
+    """
+    Persistent analysis state of a pool root, so that adding, removing or replacing a sample file only
+    re-imports that file and rebuilds the pools it touches. Everything is kept in `<pool_root>.state` next to the
+    pool root and rebuilt from scratch whenever the config, flagged genes workbook or background store change.
+    With `persist` off it is only held in memory, e.g. by the daemon.
+
+    Per key row counts give the hit columns without the other pools' rows. Each pool keeps its pivot, its sheet
+    with hit columns & its rows of the summary sheets, and only pools with a changed file, or sharing a site or
+    gene with one, are rebuilt. The summary sheets are then sorted from the pools' summary rows alone.
+    """
+
+    def __init__(self, gvi: GeneVariantIdentifier, state_dir=None, persist=True):
+        self.gvi = gvi
+        self.state_dir = state_dir or f'{os.path.normpath(gvi.pool_root)}.state'
+        self.persist = persist
+
+        self.signature = self.input_signature()
+        self.manifest = {}
+        self.counts = {name: None for name in COUNTS}
+        self.frames = {}
+        self.pools = {}
+        self.hits = {}
+
+        # pools whose cache files need writing
+        self.dirty = set()
+
+        self.load()
+
+    def input_signature(self):
+        """ Signatures of every input besides the sample files, the state is rebuilt when they change """
+        config_file = self.gvi.config_file
+        loader = self.gvi.flagged_genes_loader
+        flagged_genes_file = loader.absolute_path if loader else None
+        store = self.gvi.background_store
+        store_manifest = os.path.join(store.path, MANIFEST_FILE) if store else None
+
+        return (
+            utils.file_signature(config_file) if config_file else None,
+            utils.file_signature(flagged_genes_file) if flagged_genes_file else None,
+            tuple(sorted(self.gvi.chromosomes)) if self.gvi.chromosomes else None,
+            tuple(utils.file_signature(annotation.path) for annotation in self.gvi.annotations),
+            utils.file_signature(store_manifest) if store_manifest and os.path.isfile(store_manifest) else None
+        )
+
+    def _path(self, *parts):
+        return os.path.join(self.state_dir, *parts)
+
+    def _frame_path(self, key):
+        pool_dir, filename = key
+        return self._path(FRAMES_DIR, hashlib.sha1(f'{pool_dir}\0{filename}'.encode()).hexdigest() + '.pkl')
+
+    def _pool_path(self, pool):
+        return self._path(POOLS_DIR, hashlib.sha1(pool.encode()).hexdigest() + '.pkl')
+
+    def load(self):
+        if not self.persist or not os.path.isfile(self._path(STATE_FILE)):
+            return
+
+        state = pd.read_pickle(self._path(STATE_FILE))
+
+        if state.get('version') != STATE_VERSION or state['signature'] != self.signature:
+            print(f'config changed since {self.state_dir} was written, rebuilding analysis state')
+            return
+
+        self.manifest = state['manifest']
+        self.counts = state['counts']
+
+        for key in self.manifest:
+            self.frames[key] = pd.read_pickle(self._frame_path(key))
+
+        for pool in state['pools']:
+            self.pools[pool] = pd.read_pickle(self._pool_path(pool))
+
+    def save(self):
+        if not self.persist:
+            return
+
+        for directory in [FRAMES_DIR, POOLS_DIR]:
+            os.makedirs(self._path(directory), exist_ok=True)
+
+        for key, frame in self.frames.items():
+            if not os.path.isfile(self._frame_path(key)):
+                pd.to_pickle(frame, self._frame_path(key))
+
+        for pool in self.dirty:
+            if pool in self.pools:
+                pd.to_pickle(self.pools[pool], self._pool_path(pool))
+
+        self.dirty = set()
+
+        pd.to_pickle({
+            'version': STATE_VERSION,
+            'signature': self.signature,
+            'manifest': self.manifest,
+            'counts': self.counts,
+            'pools': list(self.pools.keys())
+        }, self._path(STATE_FILE))
+
+        # anything else, e.g. of removed files & pools, or of older layouts, is stale
+        keep = {
+            FRAMES_DIR: {os.path.basename(self._frame_path(key)) for key in self.frames},
+            POOLS_DIR: {os.path.basename(self._pool_path(pool)) for pool in self.pools}
+        }
+        for directory, filenames in keep.items():
+            for filename in os.listdir(self._path(directory)):
+                if filename not in filenames:
+                    os.remove(self._path(directory, filename))
+
+        shutil.rmtree(self._path(PIVOTS_DIR), ignore_errors=True)
+
+    def refresh(self):
+        """ Bring the state up to date with the files in the pool root, returning the pools that changed """
+        with Timer(factor=1000) as t:
+            current = {}
+            for key in self.gvi.loader_map:
+                try:
+                    current[key] = utils.file_signature(key[1])
+                except FileNotFoundError:
+                    # deleted since discovery, so treat it as removed
+                    continue
+
+            stale = [key for key, sig in self.manifest.items() if current.get(key) != sig]
+            fresh = [key for key, sig in current.items() if self.manifest.get(key) != sig]
+
+            # sites & genes of every changed file, their hits may have changed in any pool
+            touched = [self.frames.get(key) for key in stale]
+
+            for key in stale:
+                self.remove(key)
+
+            for key, df in self.import_dataframes(fresh):
+                self.add(key, df, current[key])
+
+            touched += [self.frames.get(key) for key in fresh]
+
+            if fresh:
+                self.gvi.data_filter.save_stats()
+
+            changed = {pool_dir for pool_dir, _ in [*stale, *fresh]}
+
+            if changed or not self.hits:
+                self.update_hits()
+
+            rebuilt = self.invalidate(changed, touched)
+
+            if changed:
+                self.save()
+
+            print("{} changed files in {} pools, {} pools to rebuild, state refresh took {}.ms".format(
+                len(set(stale) | set(fresh)), len(changed), len(rebuilt), round(t.elapsed, 1)))
+
+        return changed
+
+    def invalidate(self, changed, touched):
+        """ Drop the cached sheets of pools that changed or share a site or gene with a changed file """
+        touched = [df for df in touched if df is not None and not df.empty]
+
+        if touched:
+            sites = pd.MultiIndex.from_frame(
+                utils.df_concat([df[[c.chromo, c.pos]].astype({c.chromo: c.OBJECT}) for df in touched])
+                .drop_duplicates()
+            )
+            genes = pd.Index(pd.concat([df[c.gene_id].astype(c.OBJECT) for df in touched]).unique())
+
+        rebuilt = set(changed)
+
+        for pool in changed:
+            self.pools.pop(pool, None)
+
+        for pool, cache in list(self.pools.items()):
+            if pool in changed or not touched:
+                continue
+
+            pivot = cache['pivot']
+            pivot_sites = pd.MultiIndex.from_arrays([pivot[c.chromo].astype(c.OBJECT), pivot[c.pos]])
+
+            if pivot_sites.isin(sites).any() or pivot[c.gene_id].astype(c.OBJECT).isin(genes).any():
+                # the pivot itself only depends on the pool's own files
+                self.pools[pool] = {'pivot': pivot}
+                rebuilt.add(pool)
+
+        self.dirty |= rebuilt
+
+        return rebuilt
+
+    def import_dataframes(self, keys):
+        """ Import the files through the shared scheduler like GeneVariantIdentifier.load_dataframes """
+        if not keys:
+            return []
+
+        results = {}
+
+        for job, future in self.gvi.scheduler.as_completed({key: self.gvi.loader_map[key] for key in keys}):
+            pool_dir, filename = job.key
+            try:
+                results[job.key] = future.result()
+            except Exception as exc:
+                raise RuntimeError(
+                    '%r generated an exception while loading %r/%r: %s' % (
+                        type(job.loader).__name__, pool_dir, filename, exc)
+                ) from exc
+
+        # added in discovery order regardless of the schedule, so the counts are reproducible
+        return [(key, results.pop(key)) for key in keys]
+
+    def add(self, key, df, signature):
+        for name, keys in COUNTS.items():
+            self.counts[name] = _add(self.counts[name], _contribution(df, keys))
+
+        self.frames[key] = df
+        self.manifest[key] = signature
+
+    def remove(self, key):
+        df = self.frames.pop(key, None)
+
+        for name, keys in COUNTS.items():
+            self.counts[name] = _add(self.counts[name], _contribution(df, keys), sign=-1)
+
+        del self.manifest[key]
+
+        if self.persist and os.path.isfile(self._frame_path(key)):
+            os.remove(self._frame_path(key))
+
+    def update_hits(self):
+        """ The hit columns derived from the per-key counts, equivalent to GeneVariantIdentifier's groupbys """
+        hits = {}
+
+        def _hit(name, level):
+            counts = self.counts[name]
+            if counts is None:
+                return pd.Series([], dtype='int64')
+            return counts.groupby(level=level).size() - 1
+
+        hits[c.background] = _hit('site_pools', [0, 1])
+        hits[c.cand_pos] = _hit('site_samples', [0, 1, 2])
+        hits[c.cand_gene] = _hit('gene_samples', 0)
+
+        hom_label = self.gvi.hom_label
+        gene_hh = self.counts['gene_hh']
+        if gene_hh is not None and hom_label in gene_hh.index.get_level_values(1):
+            gene_hh = gene_hh.unstack(fill_value=0)
+            # percentage of total that are Homo
+            hits[c.cand_gene_hom_ratio] = gene_hh[hom_label] / gene_hh.sum(axis=1)
+        else:
+            print(f'{hom_label} not found in {c.hh} values')
+
+        self.hits = hits
+
+    def add_hits(self, df, pool=None):
+        """ Attach the hit columns, dropping rows without counts like GeneVariantIdentifier.add_hit_columns """
+        joins = {
+            c.background: [c.chromo, c.pos],
+            c.cand_pos: [c.pool, c.chromo, c.pos],
+            c.cand_gene: [c.gene_id],
+            c.cand_gene_hom_ratio: [c.gene_id]
+        }
+
+        for col in HIT_COLUMNS:
+            if col not in self.hits:
+                continue
+
+            hits = self.hits[col]
+            on = joins[col]
+
+            if pool is not None and c.pool in on:
+                # pivots have no pool column, so pick out the pool's hits up front
+                hits = hits.xs(pool, level=0)
+                on = [key for key in on if key != c.pool]
+
+            hits = hits.to_frame(name=col)
+            hits.index.names = on
+
+            if col == c.cand_gene_hom_ratio:
+                # like GeneVariantIdentifier.add_gene_statistics, genes without hh values are kept
+                df = df.merge(hits, left_on=on, right_index=True, how='left')
+                df[col] = df[col].fillna(c.FLOAT64_DEFAULT)
+            else:
+                df = df.merge(hits, left_on=on, right_index=True, how='inner')
+
+            if col == c.background:
+                df = self.gvi.add_stored_background(df)
+
+        return df
+
+    def pool_rows(self, pool):
+        """ The imported rows of one pool, with the flagged gene columns """
+        df = utils.df_concat(
+            [df for (pool_dir, _), df in self.frames.items() if pool_dir == pool and df is not None and not df.empty],
+            ignore_index=True
+        )
+        return None if df is None else self.gvi.add_flagged_genes(df)
+
+    def summary_rows(self, df):
+        """ The rows any summary sheet picks, see GeneVariantIdentifier.summary """
+        background = df[c.background].values > 0
+        mask = background.copy()
+        for col in self.gvi.summary_columns(df):
+            if col != c.background:
+                mask |= (df[col].values > 0) & ~background
+        return df[mask]
+
+    def build_pool(self, pool):
+        """ Pivot (unless cached), sheet & summary rows of a pool, None if it has no rows """
+        rows = self.pool_rows(pool)
+
+        if rows is None:
+            return None
+
+        cache = self.pools.get(pool) or {}
+
+        if 'pivot' not in cache:
+            idx = [col for col in rows.columns if col not in {c.sample, c.pool}]
+            cache['pivot'] = self.gvi._pivot(idx, pool, rows)
+
+        sheet = self.add_hits(cache['pivot'], pool=pool)
+
+        sample_cols = [col for col in sheet.columns if isinstance(col, tuple)]
+        sheet = sheet[[col for col in sheet.columns if col not in sample_cols] + sample_cols]
+
+        cache['sheet'] = sheet.reset_index(drop=True)
+        cache['summary'] = self.summary_rows(self.add_hits(rows))
+
+        return cache
+
+    def analyse(self):
+        """ Same sheets as GeneVariantIdentifier.analyse, only rebuilding pools affected since the last run """
+        with Timer(factor=1000) as t:
+            pools = natsorted({pool_dir for pool_dir, _ in self.manifest})
+
+            for pool in pools:
+                if 'sheet' not in self.pools.get(pool, {}):
+                    cache = self.build_pool(pool)
+                    if cache is None:
+                        self.pools.pop(pool, None)
+                    else:
+                        self.pools[pool] = cache
+                    self.dirty.add(pool)
+
+            self.pools = {pool: self.pools[pool] for pool in pools if pool in self.pools}
+
+            self.save()
+
+            print("pool splitting took {}.ms total".format(round(t.elapsed, 1)))
+
+        if not self.pools:
+            return {}
+
+        dfs = {pool: cache['sheet'] for pool, cache in self.pools.items()}
+
+        summary_rows = utils.df_concat([cache['summary'] for cache in self.pools.values()], ignore_index=True)
+
+        dfs.update(self.gvi.summarise(summary_rows))
+
+        return dfs
@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+from contexttimer import Timer
+
+from lib import columns as c
+
+WORD_BITS = 64
+
+# set bits of every byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def bitsets(rows, ids, num_rows, num_ids):
+    """ A row of uint64 words per `rows` code, with the bit of each of its `ids` set """
+    bits = np.zeros((num_rows, max(1, -(-num_ids // WORD_BITS))), dtype=np.uint64)
+    if not num_rows or not num_ids:
+        return bits
+    pairs = np.unique(rows.astype(np.int64) * num_ids + ids)
+    rows, ids = pairs // num_ids, pairs % num_ids
+    np.bitwise_or.at(bits, (rows, ids // WORD_BITS), np.left_shift(np.uint64(1), (ids % WORD_BITS).astype(np.uint64)))
+    return bits
+
+
+def popcount(bits):
+    """ Set bits per row """
+    num_rows, num_words = bits.shape
+    return POPCOUNT[np.ascontiguousarray(bits).view(np.uint8)].reshape(num_rows, num_words * 8).sum(
+        axis=1, dtype=np.int64)
+
+
+def broadcast(values, codes):
+    """ values[codes] where there's a code, 0 elsewhere """
+    out = np.zeros(len(codes), dtype=values.dtype)
+    coded = codes >= 0
+    out[coded] = values[codes[coded]]
+    return out
+
+
+class Membership(object):
+    """
+    Which pools & samples each site (chromo, pos) was seen in, & which samples each gene, as bitsets over pool &
+    sample ids, built once from the imported rows. The background, candidate positional & candidate gene hit
+    counts are popcounts of these, and sites() & genes() answer set queries across pools & samples, e.g. sites in
+    pools A and B but not C.
+
+    Samples are told apart by pool & name for sites, since candidate positional hits are counted within a pool,
+    and by name alone for genes, like the nunique counts they replace.
+    """
+
+    def __init__(self, df):
+        with Timer(factor=1000) as t:
+            chromos, chromo_values = pd.factorize(df[c.chromo])
+            positions, position_values = pd.factorize(df[c.pos])
+            radix = len(position_values) + 1
+
+            # rows without a chromo don't have a site
+            sited = chromos >= 0
+            self.row_sites = np.full(len(df), -1, dtype=np.int64)
+            self.row_sites[sited], site_keys = pd.factorize(chromos[sited].astype(np.int64) * radix + positions[sited])
+
+            self.row_pools, self.pools = pd.factorize(df[c.pool])
+            sample_names, self.samples = pd.factorize(df[c.sample])
+            self.row_genes, self.gene_ids = pd.factorize(df[c.gene_id])
+
+            # samples as (pool, name) pairs
+            self.row_pool_samples, pool_sample_keys = pd.factorize(
+                self.row_pools.astype(np.int64) * len(self.samples) + sample_names
+            )
+            self.pool_samples = [
+                (self.pools[key // len(self.samples)], self.samples[key % len(self.samples)])
+                for key in pool_sample_keys
+            ]
+
+            self.site_index = pd.DataFrame({
+                c.chromo: chromo_values.take(site_keys // radix),
+                c.pos: position_values.take(site_keys % radix)
+            })
+
+            num_sites = len(site_keys)
+            num_pool_samples = len(pool_sample_keys)
+
+            self.site_pools = bitsets(self.row_sites[sited], self.row_pools[sited], num_sites, len(self.pools))
+            self.site_samples = bitsets(
+                self.row_sites[sited], self.row_pool_samples[sited], num_sites, num_pool_samples
+            )
+            self.pool_sample_masks = bitsets(
+                pool_sample_keys // len(self.samples), np.arange(num_pool_samples), len(self.pools), num_pool_samples
+            )
+
+            # genes are counted over the rows with a site, as the merge on sites had dropped the rest first
+            gened = (self.row_genes >= 0) & sited
+            self.gene_samples = bitsets(
+                self.row_genes[gened], sample_names[gened], len(self.gene_ids), len(self.samples)
+            )
+
+            print("membership bitsets took {}.ms".format(round(t.elapsed, 1)))
+
+    def add_hit_columns(self, df):
+        """
+        Background, candidate positional & candidate gene hits per row, as the number of other pools with the
+        site, other samples of the pool with the site & other samples with the gene. Rows without a site or gene
+        are dropped, as the inner merges on the grouped counts did.
+        """
+        valid = (self.row_sites >= 0) & (self.row_genes >= 0)
+
+        sites, pools = self.row_sites, self.row_pools
+        num_pools = len(self.pools)
+
+        # within pool sample counts, once per distinct (site, pool)
+        site_pools, inverse = np.unique(np.maximum(sites, 0) * num_pools + pools, return_inverse=True)
+        cand_pos = popcount(
+            self.site_samples[site_pools // num_pools] & self.pool_sample_masks[site_pools % num_pools]
+        ) - 1 if len(self.site_index) else np.zeros(len(site_pools), dtype=np.int64)
+
+        hits = {
+            c.background: broadcast(popcount(self.site_pools) - 1, sites),
+            c.cand_pos: cand_pos[inverse.reshape(-1)],
+            c.cand_gene: broadcast(popcount(self.gene_samples) - 1, self.row_genes)
+        }
+
+        # the merges also grouped rows by each key in turn, in order of appearance, which pool sheet ties keep.
+        # Rows without a gene were only dropped by the last one, after they'd placed their sites
+        order = np.flatnonzero(sites >= 0)
+        for codes in [sites, pools.astype(np.int64) * max(len(self.site_index), 1) + sites]:
+            order = order[np.argsort(pd.factorize(codes[order])[0], kind='mergesort')]
+        order = order[valid[order]]
+        order = order[np.argsort(pd.factorize(self.row_genes[order])[0], kind='mergesort')]
+
+        df = df.take(order).reset_index(drop=True)
+
+        for col, values in hits.items():
+            df[col] = values[order]
+
+        return df
+
+    def _mask(self, names, ids, kind):
+        lookup = {name: i for i, name in enumerate(ids)}
+        masks = []
+        for name in names:
+            if name not in lookup:
+                raise RuntimeError(f"{kind} '{name}' not found.\nMust be one of {list(ids)}")
+            masks.append(lookup[name])
+        return masks
+
+    @staticmethod
+    def _has(bits, id_groups):
+        """ Rows with any of the bits of each group of ids set, one boolean array per group """
+        for ids in id_groups:
+            ids = np.asarray(ids, dtype=np.int64)
+            words = np.zeros(bits.shape[1], dtype=np.uint64)
+            np.bitwise_or.at(words, ids // WORD_BITS, np.left_shift(np.uint64(1), (ids % WORD_BITS).astype(np.uint64)))
+            yield (bits & words).any(axis=1)
+
+    def _select(self, bits, all_groups, any_groups, no_groups):
+        keep = np.ones(len(bits), dtype=bool)
+        for has in self._has(bits, all_groups):
+            keep &= has
+        if any_groups:
+            keep &= next(self._has(bits, [[i for ids in any_groups for i in ids]]))
+        if no_groups:
+            keep &= ~next(self._has(bits, [[i for ids in no_groups for i in ids]]))
+        return keep
+
+    def _pool_sample_groups(self, samples):
+        """ A sample named in a query is each (pool, name) pair with that name """
+        self._mask(samples, self.samples, 'Sample')
+        return [[i for i, (_, name) in enumerate(self.pool_samples) if name == sample] for sample in samples]
+
+    def sites(self, all_pools=(), any_pools=(), no_pools=(), all_samples=(), any_samples=(), no_samples=()):
+        """ The (chromo, pos) sites seen in all of `all_pools`, any of `any_pools` & none of `no_pools`, etc. """
+        keep = self._select(
+            self.site_pools,
+            [[i] for i in self._mask(all_pools, self.pools, 'Pool')],
+            [[i] for i in self._mask(any_pools, self.pools, 'Pool')],
+            [[i] for i in self._mask(no_pools, self.pools, 'Pool')]
+        )
+        keep &= self._select(
+            self.site_samples,
+            self._pool_sample_groups(all_samples),
+            self._pool_sample_groups(any_samples),
+            self._pool_sample_groups(no_samples)
+        )
+        return self.site_index[keep].reset_index(drop=True)
+
+    def genes(self, all_samples=(), any_samples=(), no_samples=()):
+        """ The gene ids with hits in all of `all_samples`, any of `any_samples` & none of `no_samples` """
+        keep = self._select(
+            self.gene_samples,
+            [[i] for i in self._mask(all_samples, self.samples, 'Sample')],
+            [[i] for i in self._mask(any_samples, self.samples, 'Sample')],
+            [[i] for i in self._mask(no_samples, self.samples, 'Sample')]
+        )
+        return list(self.gene_ids[keep])
+
+    def site_counts(self):
+        """ Pools & samples each site was seen in """
+        return self.site_index.assign(pools=popcount(self.site_pools), samples=popcount(self.site_samples))
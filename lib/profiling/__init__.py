@@ -0,0 +1,290 @@
+import io
+import os
+import re
+import time
+import pstats
+import cProfile
+import functools
+import threading
+import tracemalloc
+import yaml
+
+# set by enable() & inherited by worker processes, which start profiling their own stages when they see it
+PROFILE_DIR_ENV = 'GVI_PROFILE_DIR'
+
+STAGE_SUFFIX = '.stage.yaml'
+PSTATS_SUFFIX = '.pstats'
+COLLAPSED_SUFFIX = '.collapsed'
+
+# allocation sites kept per stage
+TOP_ALLOCATIONS = 20
+
+DEFAULT_TOP = 20
+
+# call paths accounting for less time than this are left out of the collapsed stacks, there can be exponentially
+# many through pandas' call graph
+MIN_STACK_SECONDS = 0.0005
+
+_local = threading.local()
+_lock = threading.Lock()
+_count = 0
+
+
+def enable(directory):
+    """ Profile every stage of this process & of the worker processes it starts from now on into `directory` """
+    os.makedirs(directory, exist_ok=True)
+    os.environ[PROFILE_DIR_ENV] = os.path.abspath(directory)
+
+
+def disable():
+    os.environ.pop(PROFILE_DIR_ENV, None)
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def profile_dir():
+    return os.environ.get(PROFILE_DIR_ENV)
+
+
+class _NotProfiling(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOT_PROFILING = _NotProfiling()
+
+
+def stage(name, detail=None):
+    """ A context profiling the block as a pipeline stage when profiling is enabled, a no-op otherwise """
+    directory = profile_dir()
+    return Stage(directory, name, detail) if directory else NOT_PROFILING
+
+
+def profiled(name, detail=None):
+    """ Decorator profiling each call as a stage, `detail` makes a label from the call's arguments """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profile_dir():
+                return func(*args, **kwargs)
+            with stage(name, detail(*args, **kwargs) if detail else None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Stage(object):
+    """
+    CPU profile & net allocations of one run of a stage, written into the profile directory as <prefix>.pstats,
+    <prefix>.collapsed (for flame graph tools) & <prefix>.stage.yaml.
+
+    cProfile only sees the thread it's enabled in, so stages run in worker threads & processes profile
+    themselves. A nested stage pauses the one around it, so profiled time is counted to the innermost stage only,
+    while wall time & allocations are inclusive, the latter also picking up other threads' while stages overlap.
+    Only the outermost stage of a process's main thread snapshots allocation sites, as snapshots cover the whole
+    heap & get slow with many live objects, so the stages of worker threads only count their net allocations.
+    The time spent on snapshots & writing profiles is left out of the wall time of the stages around.
+    """
+
+    def __init__(self, directory, name, detail=None):
+        self.directory = directory
+        self.name = name
+        self.detail = detail
+        self.overhead = 0.0  # of nested stages
+
+    def __enter__(self):
+        global _count
+
+        entered = time.perf_counter()
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        with _lock:
+            _count += 1
+            number = _count
+
+        label = f'{self.name}-{self.detail}' if self.detail is not None else self.name
+        self.prefix = os.path.join(
+            self.directory, '{}-{:05d}-{}'.format(os.getpid(), number, re.sub(r'[^\w.-]+', '_', label))[:120])
+
+        stack = _stack()
+        if stack:
+            stack[-1].pause()
+
+        outermost = not stack and threading.current_thread() is threading.main_thread()
+        self.snapshot = tracemalloc.take_snapshot() if outermost else None
+        self.traced = tracemalloc.get_traced_memory()[0]
+
+        stack.append(self)
+
+        self.start = time.perf_counter()
+        self.entry_overhead = self.start - entered
+        self.profile = cProfile.Profile()
+        self.resume()
+
+        return self
+
+    def pause(self):
+        if self.profile:
+            self.profile.disable()
+
+    def resume(self):
+        try:
+            self.profile.enable()
+        except ValueError:
+            # newer pythons allow one profiler per process, so a stage overlapping another goes without
+            self.profile = None
+
+    def __exit__(self, *exc):
+        self.pause()
+        exited = time.perf_counter()
+        wall = exited - self.start - self.overhead
+
+        allocated = tracemalloc.get_traced_memory()[0] - self.traced
+        allocations = []
+
+        if self.snapshot:
+            allocations = [
+                stat for stat in tracemalloc.take_snapshot().compare_to(self.snapshot, 'lineno')
+                if stat.traceback[0].filename != tracemalloc.__file__
+            ]
+            self.snapshot = None
+
+        stack = _stack()
+        stack.pop()
+
+        own = None
+
+        if self.profile:
+            stats = pstats.Stats(self.profile)
+            stats.dump_stats(self.prefix + PSTATS_SUFFIX)
+            own = stats.total_tt
+
+            with open(self.prefix + COLLAPSED_SUFFIX, 'w') as file:
+                for frames, microseconds in sorted(collapsed_stacks(stats).items()):
+                    file.write('{} {}\n'.format(';'.join(frames), microseconds))
+
+        with open(self.prefix + STAGE_SUFFIX, 'w') as file:
+            yaml.safe_dump({
+                'name': self.name,
+                'detail': None if self.detail is None else str(self.detail),
+                'pid': os.getpid(),
+                'thread': threading.current_thread().name,
+                'wall': wall,
+                'own': own,
+                'allocated': allocated,
+                'allocations': [
+                    [str(stat.traceback), stat.size_diff, stat.count_diff]
+                    for stat in allocations[:TOP_ALLOCATIONS]
+                ]
+            }, file, default_flow_style=False)
+
+        if stack:
+            stack[-1].overhead += self.overhead + self.entry_overhead + time.perf_counter() - exited
+            stack[-1].resume()
+
+        return False
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _frame(func):
+    filename, line, name = func
+    return f'{name} ({os.path.basename(filename)}:{line})' if line else name
+
+
+def collapsed_stacks(stats):
+    """
+    Semicolon joined call stacks & their own time in microseconds, in the collapsed format flame graph tools read.
+    cProfile only records caller & callee pairs, so each function's time is split over the stacks it's reached by
+    in proportion to the time of each call edge, and paths under MIN_STACK_SECONDS are dropped.
+    """
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (_, _, _, ct, *_) in callers.items():
+            callees.setdefault(caller, []).append((func, ct))
+
+    roots = [func for func, (_, _, _, _, callers) in stats.stats.items() if not callers]
+
+    stacks = {}
+
+    def walk(func, path, share):
+        _, _, tt, ct, _ = stats.stats[func]
+        path = path + (_frame(func),)
+        own = int(tt * share * 1e6)
+        if own > 0:
+            stacks[path] = stacks.get(path, 0) + own
+        for callee, edge_ct in callees.get(func, []):
+            callee_ct = stats.stats[callee][3]
+            if callee_ct <= 0 or share * edge_ct < MIN_STACK_SECONDS or _frame(callee) in path:
+                continue
+            walk(callee, path, share * edge_ct / callee_ct)
+
+    for root in roots:
+        walk(root, (), 1.0)
+
+    return stacks
+
+
+def summarise(directory, top=DEFAULT_TOP):
+    """ Hotspots over every stage profiled into `directory`, by any process """
+    records = []
+    pstats_files = []
+
+    for filename in sorted(os.listdir(directory)):
+        path = os.path.join(directory, filename)
+        if filename.endswith(STAGE_SUFFIX):
+            with open(path) as file:
+                records.append(yaml.safe_load(file))
+        elif filename.endswith(PSTATS_SUFFIX):
+            pstats_files.append(path)
+
+    if not records:
+        return f'no stages profiled in {directory}'
+
+    lines = [f'profile of {len(records)} stages in {directory}', '', 'stages by total wall time, own excludes nested stages (s):']
+
+    by_name = {}
+    for record in records:
+        totals = by_name.setdefault(record['name'], {'count': 0, 'wall': 0.0, 'own': 0.0, 'allocated': 0})
+        totals['count'] += 1
+        totals['wall'] += record['wall']
+        totals['own'] += record['own'] or 0.0
+        totals['allocated'] += record['allocated']
+
+    for name, totals in sorted(by_name.items(), key=lambda item: item[1]['wall'], reverse=True):
+        lines.append('  {:<28} {:>6} runs {:>10.3f} wall {:>10.3f} own {:>10.1f}MB allocated'.format(
+            name, totals['count'], totals['wall'], totals['own'], totals['allocated'] / 1024 / 1024))
+
+    lines += ['', f'slowest {top} stages (s):']
+
+    for record in sorted(records, key=lambda record: record['wall'], reverse=True)[:top]:
+        label = record['name'] if record['detail'] is None else '{} {}'.format(record['name'], record['detail'])
+        lines.append('  {:>10.3f} {} [pid {}, {}]'.format(record['wall'], label, record['pid'], record['thread']))
+
+    allocations = {}
+    for record in records:
+        for site, size, _ in record['allocations']:
+            allocations[site] = allocations.get(site, 0) + size
+
+    lines += ['', f'top {top} allocation sites (net MB, over stages):']
+
+    for site, size in sorted(allocations.items(), key=lambda item: item[1], reverse=True)[:top]:
+        lines.append('  {:>10.1f} {}'.format(size / 1024 / 1024, site))
+
+    stream = io.StringIO()
+    stats = pstats.Stats(*pstats_files, stream=stream)
+    stats.files = []  # rather than a line per stage
+    stats.sort_stats('tottime').print_stats(top)
+
+    lines += ['', f'top {top} functions by own time, over stages:', stream.getvalue()]
+
+    return '\n'.join(lines)
@@ -0,0 +1,100 @@
+from collections.abc import Mapping
+from contexttimer import Timer
+
+from lib import columns as c
+
+
+class AnalysisResults(Mapping):
+    """
+    Read-only mapping of sheet name to DataFrame, as returned by GeneVariantIdentifier.analyse, where each sheet
+    is only computed when first accessed & memoized after that. Importing & adding the hit columns is shared by
+    every sheet, so it happens on the first access of any of them.
+
+    `pools` & `sheets` restrict the available sheets, by pool name, summary sheet title or hit column key
+    (e.g. columns.cand_gene). Background is still counted over every pool.
+    """
+
+    def __init__(self, gvi, full_df=None, pools=None, sheets=None):
+        self.gvi = gvi
+        self.pools = set(pools) if pools is not None else None
+        self.sheets = {self._title(sheet) for sheet in sheets} if sheets is not None else None
+
+        self._raw_df = full_df
+        self._full_df = None
+        self._idx = None
+        self._pool_dfs = None
+        self._summaries = None
+        self._summary_order = None
+        self._cache = {}
+
+    @staticmethod
+    def _title(sheet):
+        return c.COLUMNS[sheet].title if sheet in c.COLUMNS else sheet
+
+    def _wanted(self, sheet_name):
+        return self.sheets is None or sheet_name in self.sheets
+
+    @property
+    def full_df(self):
+        """ Every imported row with the flagged gene & hit columns added """
+        if self._full_df is None:
+            full_df = self._raw_df if self._raw_df is not None else self.gvi.load_dataframes()
+            self._raw_df = None
+            self._full_df = self.gvi.annotate(full_df)
+
+            self._idx, self._pool_dfs = self.gvi.split_pools(self._full_df, pools=self.pools)
+            self._pool_dfs = {pool: df for pool, df in self._pool_dfs.items() if self._wanted(pool)}
+
+            self._summaries = {
+                c.COLUMNS[col].title: col
+                for col in self.gvi.summary_columns(self._full_df)
+                if self._wanted(c.COLUMNS[col].title)
+            }
+        return self._full_df
+
+    @property
+    def membership(self):
+        """ Pool & sample membership of every site & gene, for set queries, see lib.membership.Membership """
+        self.full_df
+        return self.gvi.membership
+
+    @property
+    def pool_names(self):
+        self.full_df
+        return list(self._pool_dfs.keys())
+
+    @property
+    def summary_names(self):
+        self.full_df
+        return list(self._summaries.keys())
+
+    def __getitem__(self, sheet_name):
+        sheet_name = self._title(sheet_name)
+
+        if sheet_name not in self._cache:
+            full_df = self.full_df
+
+            if sheet_name in self._pool_dfs:
+                self._cache[sheet_name] = self.gvi._pivot(self._idx, sheet_name, self._pool_dfs[sheet_name])
+            elif sheet_name in self._summaries:
+                with Timer(factor=1000) as t:
+                    if self._summary_order is None:
+                        self._summary_order = self.gvi.summary_order(full_df)
+                    self._cache[sheet_name] = self.gvi.summary(
+                        full_df, self._summaries[sheet_name], order=self._summary_order, top=self.gvi.summary_top
+                    )
+                    print("{} took {}.ms".format(sheet_name, round(t.elapsed, 1)))
+            else:
+                raise KeyError(sheet_name)
+
+        return self._cache[sheet_name]
+
+    def __iter__(self):
+        return iter([*self.pool_names, *self.summary_names])
+
+    def __len__(self):
+        return len(self.pool_names) + len(self.summary_names)
+
+    def __contains__(self, sheet_name):
+        sheet_name = self._title(sheet_name)
+        return sheet_name in self.pool_names or sheet_name in self.summary_names
@@ -0,0 +1,143 @@
+import zlib
+import threading
+import numpy as np
+import pandas as pd
+
+from lib.annotations import normalize_chromosome
+
+MASK64 = (1 << 64) - 1
+
+# splitmix64's finalizer, spreads neighbouring positions over the whole hash range
+MIX_SHIFTS = (30, 27, 31)
+MIX_MULTIPLIERS = (0xbf58476d1ce4e5b9, 0x94d049bb133111eb)
+
+GOLDEN = 0x9e3779b97f4a7c15
+
+
+def chromosome_key(chromo, seed=0):
+    """ The chromosome's part of the site hash, the same whatever its 'chr' prefix or case """
+    return (zlib.crc32(normalize_chromosome(chromo).encode()) << 32 ^ seed * GOLDEN) & MASK64
+
+
+def site_hash(key, pos):
+    """ 64 bit hash of a site, `key` from chromosome_key """
+    x = key ^ pos
+    x = ((x ^ (x >> MIX_SHIFTS[0])) * MIX_MULTIPLIERS[0]) & MASK64
+    x = ((x ^ (x >> MIX_SHIFTS[1])) * MIX_MULTIPLIERS[1]) & MASK64
+    return x ^ (x >> MIX_SHIFTS[2])
+
+
+def site_hashes(keys, positions):
+    """ site_hash of every site at once, uint64 arithmetic wraps like the masked python ints """
+    x = keys ^ positions
+    x = (x ^ (x >> np.uint64(MIX_SHIFTS[0]))) * np.uint64(MIX_MULTIPLIERS[0])
+    x = (x ^ (x >> np.uint64(MIX_SHIFTS[1]))) * np.uint64(MIX_MULTIPLIERS[1])
+    return x ^ (x >> np.uint64(MIX_SHIFTS[2]))
+
+
+class SiteSampler(object):
+    """
+    Picks out the sites of a preview run: those on `chromosomes` (if given) & a deterministic `fraction` of the
+    rest (if given), by a hash of chromosome & position. The same sites are kept in every sample & pool, and in
+    every run with the same `seed`, so the pools of a preview still overlap like the full data.
+
+    VcfImporter applies it before decoding anything else of a record, SnpEffImporter to the chromo & pos fields
+    it picks out of each line's raw bytes, so only the lines of the rows kept are parsed.
+    """
+
+    def __init__(self, fraction=None, chromosomes=None, seed=0):
+        if fraction is not None and not 0 < fraction <= 1:
+            raise RuntimeError(f"Preview fraction {fraction} must be greater than 0 & at most 1")
+
+        self.fraction = fraction
+        self.chromosomes = {normalize_chromosome(chromo) for chromo in chromosomes} if chromosomes else None
+        self.seed = seed
+
+        # sites hashing below this are kept
+        self.threshold = min(int(fraction * (1 << 64)), MASK64) if fraction is not None else MASK64
+
+        self._keys = {}
+        self._lock = threading.Lock()
+
+        self.seen = 0
+        self.kept = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def chromosome_key(self, chromo):
+        """ The chromosome's hash key, None if it isn't previewed at all """
+        try:
+            return self._keys[chromo]
+        except KeyError:
+            if self.chromosomes is None or normalize_chromosome(chromo) in self.chromosomes:
+                key = chromosome_key(chromo, self.seed)
+            else:
+                key = None
+            self._keys[chromo] = key
+            return key
+
+    def keep(self, chromo, pos):
+        key = self.chromosome_key(chromo)
+        return key is not None and (self.fraction is None or site_hash(key, pos) <= self.threshold)
+
+    def count(self, seen, kept):
+        with self._lock:
+            self.seen += seen
+            self.kept += kept
+
+    def reset_counts(self):
+        with self._lock:
+            self.seen = 0
+            self.kept = 0
+
+    def counts(self):
+        with self._lock:
+            return self.seen, self.kept
+
+    def merge_counts(self, counts):
+        self.count(*counts)
+
+    def mask(self, chromos, positions):
+        """
+        Whether to keep the site of each row, like keep() but for a whole chunk of rows at once. Each distinct
+        chromosome's key is looked up once.
+        """
+        codes, values = pd.factorize(chromos)
+
+        # code -1, a missing chromosome, picks the last entry, which isn't previewed
+        keys = np.zeros(len(values) + 1, dtype=np.uint64)
+        previewed = np.zeros(len(values) + 1, dtype=bool)
+
+        for i, chromo in enumerate(values):
+            key = self.chromosome_key(chromo)
+            if key is not None:
+                keys[i] = key
+                previewed[i] = True
+
+        keep = previewed[codes]
+
+        if self.fraction is not None:
+            positions = np.asarray(positions).astype(np.uint64)
+            keep &= site_hashes(keys[codes], positions) <= np.uint64(self.threshold)
+
+        self.count(len(keep), int(keep.sum()))
+
+        return keep
+
+    def describe(self):
+        parts = []
+        if self.chromosomes is not None:
+            parts.append('chromosomes {}'.format(', '.join(sorted(self.chromosomes))))
+        if self.fraction is not None:
+            parts.append('{:.1%} of sites (seed {})'.format(self.fraction, self.seed))
+        detail = ' & '.join(parts)
+        if self.seen:
+            detail += ', kept {} of {} records read ({:.1%})'.format(self.kept, self.seen, self.kept / self.seen)
+        return f'preview of {detail}'
@@ -0,0 +1,352 @@
+import os
+import shutil
+import tempfile
+import threading
+import concurrent.futures
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from contexttimer import Timer
+
+MB = 1024 * 1024
+
+# Rough in-memory DataFrame bytes & seconds per (uncompressed) input byte, by importer. pysam decodes every
+# record in python, SnpEff TXT goes through pandas' C parser.
+MEMORY_FACTORS = {
+    'VcfImporter': 3.0,
+    'SnpEffImporter': 4.0
+}
+SECONDS_PER_MB = {
+    'VcfImporter': 2.0,
+    'SnpEffImporter': 0.2
+}
+DEFAULT_MEMORY_FACTOR = 4.0
+DEFAULT_SECONDS_PER_MB = 1.0
+
+# typical expansion of gzip/bgzip & bzip2 compressed variant files
+COMPRESSION_FACTORS = {
+    b'\x1f\x8b': 6.0,
+    b'BZ': 8.0
+}
+
+# share of physical memory used when no budget is configured
+DEFAULT_BUDGET_SHARE = 0.5
+
+# bytes per read when pulling a file into the page cache
+PREFETCH_BLOCK_SIZE = 4 * MB
+
+# column encodings of write_frame
+CATEGORY_CODES = 'category'
+OBJECT_CODES = 'object'
+
+# object columns with at most this many distinct values per row are written as codes, not pickled
+CODED_OBJECTS_RATIO = 0.5
+
+ImportJob = namedtuple('ImportJob', ['key', 'loader', 'size', 'memory', 'seconds'])
+
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def compression_factor(filename):
+    with open(filename, 'rb') as file:
+        magic = file.read(2)
+    return COMPRESSION_FACTORS.get(magic, 1.0)
+
+
+def _run_import(loader, pool_dir, filename):
+    return loader.import_as_dataframe(pool_dir, filename)
+
+
+def _run_import_to_scratch(loader, pool_dir, filename, directory):
+    """ Import in a worker process, returning the frame's manifest & the rows its loader's counters counted """
+    counters = getattr(loader, 'counters', [])
+    for counter in counters:
+        counter.reset_counts()
+    manifest = write_frame(loader.import_as_dataframe(pool_dir, filename), directory)
+    return manifest, [counter.counts() for counter in counters]
+
+
+def write_frame(df, directory):
+    """
+    Write each column of `df` to its own .npy file in `directory`, returning the small manifest read_frame needs
+    to map them back. Categoricals are stored as their codes, as are object columns with few distinct values, so
+    only the remaining object columns have to be pickled.
+    """
+    if df is None:
+        return None
+
+    os.makedirs(directory, exist_ok=True)
+
+    columns = []
+
+    for i, col in enumerate(df.columns):
+        series = df[col]
+        path = os.path.join(directory, f'{i}.npy')
+        if series.dtype.name == 'category':
+            np.save(path, series.cat.codes.values)
+            columns.append((col, path, list(series.cat.categories), CATEGORY_CODES))
+            continue
+        if series.dtype == object:
+            codes, uniques = pd.factorize(series)
+            if len(uniques) <= CODED_OBJECTS_RATIO * len(series):
+                np.save(path, codes)
+                columns.append((col, path, list(uniques), OBJECT_CODES))
+                continue
+        np.save(path, series.values, allow_pickle=series.dtype == object)
+        columns.append((col, path, None, None))
+
+    return {'length': len(df), 'columns': columns}
+
+
+def read_frame(manifest):
+    """
+    Map the columns written by write_frame back without reading them into memory up front. Numeric columns &
+    the codes of categoricals stay read-only views of the mapped files until the frames are concatenated.
+    """
+    if manifest is None:
+        return None
+
+    data = {}
+
+    for col, path, values_of_codes, encoding in manifest['columns']:
+        try:
+            values = np.load(path, mmap_mode='r')
+        except ValueError:
+            # object arrays can't be memory-mapped
+            values = np.load(path, allow_pickle=True)
+        if encoding == CATEGORY_CODES:
+            values = pd.Categorical.from_codes(values, categories=values_of_codes)
+        elif encoding == OBJECT_CODES:
+            # missing values are code -1, the last entry
+            values = pd.Series([*values_of_codes, np.nan], dtype=object).values[values]
+        data[col] = values
+
+    return pd.DataFrame(
+        data, columns=[col for col, *_ in manifest['columns']], index=range(manifest['length']), copy=False
+    )
+
+
+class Prefetcher(object):
+    """
+    Reads files ahead of their imports in a background thread, so they're in the page cache by the time a
+    worker opens them & I/O overlaps with parsing. Files are hinted with posix_fadvise where available & read
+    through, which network filesystems need. At most `budget` bytes are read ahead of the imports started.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self._ahead = {}  # prefetched filename -> size, until its import starts
+        self._started = set()
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self, filenames):
+        self._thread = threading.Thread(target=self._run, args=(list(filenames),), daemon=True)
+        self._thread.start()
+        return self
+
+    def started(self, filename):
+        """ An import opened `filename`, so its read-ahead no longer counts against the budget """
+        with self._condition:
+            self._started.add(filename)
+            self._ahead.pop(filename, None)
+            self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self, filenames):
+        for filename in filenames:
+            size = os.path.getsize(filename)
+
+            with self._condition:
+                while not self._stopped and filename not in self._started and self._ahead \
+                        and sum(self._ahead.values()) + size > self.budget:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                if filename in self._started:
+                    continue
+                self._ahead[filename] = size
+
+            with Timer(factor=1000) as t:
+                self.prefetch(filename)
+                print("prefetching {} ({:.0f}MB) took {}.ms".format(filename, size / MB, round(t.elapsed, 1)))
+
+    def prefetch(self, filename):
+        with open(filename, 'rb', buffering=0) as file:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while file.read(PREFETCH_BLOCK_SIZE):
+                with self._condition:
+                    if self._stopped or filename in self._started:
+                        return
+
+
+class ImportScheduler(object):
+    """
+    Runs import jobs largest first, so small files fill in around the big ones instead of the run ending on a
+    single large file, while the estimated memory of the jobs in flight stays within `memory_budget` (bytes).
+    A job estimated over the whole budget still runs, but on its own.
+
+    Worker processes hand their DataFrames back through .npy files in a scratch directory, mapped by the
+    parent rather than pickled through a pipe, along with the counts of their loader's filter & sampler. The
+    scratch directory is removed once the run ends, however it ends; mapped columns stay readable after that on
+    POSIX systems.
+
+    A scheduler, and its `executor` if given, can be shared by several runs at once (see lib.batch): the
+    workers & memory budget then hold across all of them.
+
+    With a `prefetch_budget` (bytes), files are read ahead in schedule order, see Prefetcher.
+    """
+
+    def __init__(self, workers=1, memory_budget=None, processes=False, scratch_dir=None, executor=None,
+                 prefetch_budget=None):
+        self.workers = max(1, workers or 1)
+        self.processes = processes
+        self.scratch_dir = scratch_dir
+        self.executor = executor
+        self.prefetch_budget = prefetch_budget
+
+        if memory_budget is None:
+            memory = physical_memory()
+            memory_budget = memory * DEFAULT_BUDGET_SHARE if memory else float('inf')
+
+        self.memory_budget = memory_budget
+
+        self.in_flight = 0
+        self.running = 0
+        self._budget = threading.Condition()
+
+        self.peak_memory = 0
+        self.peak_workers = 0
+
+    @staticmethod
+    def estimate(key, loader):
+        _, filename = key
+        name = type(loader).__name__
+        size = os.path.getsize(filename)
+        expanded = size * compression_factor(filename)
+        return ImportJob(
+            key=key,
+            loader=loader,
+            size=size,
+            memory=expanded * MEMORY_FACTORS.get(name, DEFAULT_MEMORY_FACTOR),
+            seconds=expanded / MB * SECONDS_PER_MB.get(name, DEFAULT_SECONDS_PER_MB)
+        )
+
+    def plan(self, loader_map):
+        """ Jobs in the order they'll be considered, longest first """
+        jobs = [self.estimate(key, loader) for key, loader in loader_map.items()]
+        return sorted(jobs, key=lambda job: job.seconds, reverse=True)
+
+    def as_completed(self, loader_map):
+        """ Yield each (job, future) as its import completes """
+        pending = self.plan(loader_map)
+
+        print("import schedule: {} files, {} {}, {:.0f}MB memory budget".format(
+            len(pending), self.workers, 'processes' if self.processes else 'threads', self.memory_budget / MB))
+
+        executor_class = concurrent.futures.ProcessPoolExecutor if self.processes \
+            else concurrent.futures.ThreadPoolExecutor
+
+        executor = self.executor or executor_class(max_workers=self.workers)
+
+        scratch = tempfile.mkdtemp(prefix='gvi_imports_', dir=self.scratch_dir) if self.processes else None
+
+        prefetcher = Prefetcher(self.prefetch_budget).start(job.key[1] for job in pending) \
+            if self.prefetch_budget else None
+
+        running = {}
+        deferred = 0
+        submitted = 0
+
+        try:
+            while pending or running:
+                with self._budget:
+                    for job in list(pending):
+                        if self.running >= self.workers:
+                            break
+                        if self.in_flight and self.in_flight + job.memory > self.memory_budget:
+                            continue
+                        pool_dir, filename = job.key
+                        if prefetcher:
+                            prefetcher.started(filename)
+                        print("scheduling {}: ~{:.0f}MB, ~{:.1f}s estimated, {:.0f}MB in flight".format(
+                            filename, job.memory / MB, job.seconds, self.in_flight / MB))
+                        if scratch:
+                            future = executor.submit(
+                                _run_import_to_scratch, job.loader, pool_dir, filename,
+                                os.path.join(scratch, str(submitted))
+                            )
+                        else:
+                            future = executor.submit(_run_import, job.loader, pool_dir, filename)
+                        running[future] = job
+                        submitted += 1
+                        pending.remove(job)
+                        self.in_flight += job.memory
+                        self.running += 1
+
+                    self.peak_memory = max(self.peak_memory, self.in_flight)
+                    self.peak_workers = max(self.peak_workers, self.running)
+
+                    if pending and self.running < self.workers and len(pending) != deferred:
+                        print("deferring {} files until memory frees up".format(len(pending)))
+                    deferred = len(pending) if self.running < self.workers else 0
+
+                    if not running:
+                        # everything in flight belongs to other runs sharing this scheduler
+                        self._budget.wait()
+                        continue
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    job = running.pop(future)
+                    self._release(job)
+                    yield job, self._mapped(job, future) if scratch else future
+        finally:
+            if prefetcher:
+                prefetcher.stop()
+            # a run abandoned part way mustn't hold on to its share of the budget
+            for job in running.values():
+                self._release(job)
+            if not self.executor:
+                executor.shutdown(wait=True)
+            if scratch:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+        print("import schedule: peak ~{:.0f}MB estimated in flight, {} concurrent imports".format(
+            self.peak_memory / MB, self.peak_workers))
+
+    def _release(self, job):
+        with self._budget:
+            self.in_flight -= job.memory
+            self.running -= 1
+            self._budget.notify_all()
+
+    @staticmethod
+    def _mapped(job, future):
+        """ A future of the DataFrame mapped from the scratch files a worker process wrote """
+        mapped = concurrent.futures.Future()
+        with Timer(factor=1000) as t:
+            try:
+                manifest, counts = future.result()
+                # the worker's copies of the filter & sampler counted its rows, not the parent's
+                for counter, counter_counts in zip(getattr(job.loader, 'counters', []), counts):
+                    counter.merge_counts(counter_counts)
+                mapped.set_result(read_frame(manifest))
+            except Exception as exc:
+                mapped.set_exception(exc)
+            print("mapping {} took {}.ms".format(job.key[1], round(t.elapsed, 1)))
+        return mapped
@@ -0,0 +1,173 @@
+import os
+import shutil
+import tempfile
+import concurrent.futures
+import pandas as pd
+from natsort import natsorted
+from contexttimer import Timer
+
+from lib.gene_variant_identifier import GeneVariantIdentifier, POOL_SORT, SUMMARY_SORTS
+from lib import columns as c
+
+SHARD_FILE = 'shard_{}.pkl'
+
+
+def plan_shards(chromosomes, shards=None):
+    """ Deal the (natsorted) chromosomes out into at most `shards` groups, one per chromosome by default """
+    chromosomes = natsorted(chromosomes)
+    if not shards or shards >= len(chromosomes):
+        return [[chromo] for chromo in chromosomes]
+    return [chromosomes[i::shards] for i in range(shards)]
+
+
+def run_shard(pool_root, chromosomes, outfile, scheduler=None):
+    """
+    Import & analyse a single shard of chromosomes, writing the resulting sheets to `outfile`. The imports go
+    through `scheduler` if given, rather than the one the config describes
+    """
+    with Timer(factor=1000) as t:
+        gvi = GeneVariantIdentifier(pool_root, chromosomes=chromosomes)
+
+        if scheduler is not None:
+            gvi.scheduler = scheduler
+
+        df = gvi.load_dataframes()
+
+        dfs = gvi.analyse(df) if df is not None and not df.empty else {}
+
+        pd.to_pickle(dfs, outfile)
+
+        if gvi.sampler:
+            gvi.report_preview()
+
+        print("shard {} took {}.ms".format(','.join(chromosomes), round(t.elapsed, 1)))
+
+    return outfile
+
+
+def load_shard(filename):
+    return pd.read_pickle(filename)
+
+
+def merge_shards(shard_results, top=None):
+    """ Assemble the sheets of each shard's analyse() output into a single set of sheets """
+    sheets = {}
+
+    for dfs in shard_results:
+        for sheet_name, df in dfs.items():
+            sheets.setdefault(sheet_name, []).append(df)
+
+    summary_sheets = {c.COLUMNS[col].title: sort for col, sort in SUMMARY_SORTS.items()}
+
+    merged = {
+        pool: _merge_pool(frames)
+        for pool, frames in natsorted(sheets.items())
+        if pool not in summary_sheets
+    }
+
+    for sheet_name, sort in summary_sheets.items():
+        if sheet_name in sheets:
+            frames = sheets[sheet_name]
+            merged[sheet_name] = _restore_categories(
+                pd.concat(frames, ignore_index=True, sort=False), frames
+            ).sort_values(**sort).reset_index(drop=True)
+            if top:
+                merged[sheet_name] = merged[sheet_name].head(top)
+
+    return merged
+
+
+def _merge_pool(frames):
+    df = pd.concat(frames, ignore_index=True, sort=False)
+
+    # pivoted sample columns are ('pool', <sample>) tuples and only exist in shards where the sample had hits
+    sample_cols = sorted(col for col in df.columns if isinstance(col, tuple))
+    df[sample_cols] = df[sample_cols].fillna(0).astype('int64')
+
+    df = df[[col for col in df.columns if not isinstance(col, tuple)] + sample_cols]
+
+    return _restore_categories(df, frames).sort_values(**POOL_SORT).reset_index(drop=True)
+
+
+def _restore_categories(df, frames):
+    # concatenating categoricals with differing categories falls back to object
+    for col in df.columns:
+        if any(col in frame and frame[col].dtype.name == c.CATEGORY for frame in frames):
+            df[col] = df[col].astype(c.CATEGORY)
+    return df
+
+
+class ShardRunner(object):
+    """
+    Analyses a pool root one group of chromosomes at a time, in worker processes, and merges the shards' sheets.
+    Given a shared `scheduler` (see lib.batch) the shards instead run one after another in the calling thread,
+    importing through the scheduler's workers & memory budget.
+    """
+
+    def __init__(self, pool_root, shards=None, workers=None, scratch_dir=None, scheduler=None):
+        self.pool_root = pool_root
+        self.shards = shards
+        self.workers = workers
+        self.scratch_dir = scratch_dir
+        self.scheduler = scheduler
+
+    def plan(self):
+        return plan_shards(GeneVariantIdentifier(self.pool_root).discover_chromosomes(), self.shards)
+
+    def apply(self):
+        gvi = GeneVariantIdentifier(self.pool_root)
+
+        plan = plan_shards(gvi.discover_chromosomes(), self.shards)
+
+        scratch = tempfile.mkdtemp(prefix='gvi_shards_', dir=self.scratch_dir)
+
+        try:
+            with Timer(factor=1000) as t:
+                outfiles = self.run_shards(plan, scratch)
+                print("sharded analysis took {}.ms total".format(round(t.elapsed, 1)))
+
+            with Timer(factor=1000) as t:
+                dfs = merge_shards((load_shard(outfile) for outfile in outfiles), top=gvi.summary_top)
+                print("shard merge took {}.ms".format(round(t.elapsed, 1)))
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        with Timer(factor=1000) as t:
+            outfile = gvi.exporter.export(dfs)
+            print("xlsx export took {}.ms total".format(round(t.elapsed, 1)))
+
+        return outfile
+
+    def run_shards(self, plan, scratch):
+        outfiles = [os.path.join(scratch, SHARD_FILE.format(i)) for i in range(len(plan))]
+
+        if not plan:
+            return outfiles
+
+        if self.scheduler is not None:
+            for chromosomes, outfile in zip(plan, outfiles):
+                try:
+                    run_shard(self.pool_root, chromosomes, outfile, scheduler=self.scheduler)
+                except Exception as exc:
+                    raise RuntimeError(
+                        'shard %r generated an exception: %s' % (','.join(chromosomes), exc)
+                    ) from exc
+            return outfiles
+
+        workers = min(self.workers or os.cpu_count() or 1, len(plan))
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            future_map = {
+                executor.submit(run_shard, self.pool_root, chromosomes, outfile): chromosomes
+                for chromosomes, outfile in zip(plan, outfiles)
+            }
+            for future in concurrent.futures.as_completed(future_map):
+                chromosomes = future_map[future]
+                try:
+                    future.result()
+                except Exception as exc:
+                    raise RuntimeError(
+                        'shard %r generated an exception: %s' % (','.join(chromosomes), exc)
+                    ) from exc
+
+        return outfiles
@@ -0,0 +1,46 @@
+"""
+Run the chromosome shards of a pool root as standalone jobs, e.g. across cluster nodes:
+
+    python -m lib.sharding plan <pool_root> --shards 4
+    python -m lib.sharding run <pool_root> --chromosomes chr1,chr5 --out shard_0.pkl
+    python -m lib.sharding merge <pool_root> shard_*.pkl
+"""
+import argparse
+
+from lib.gene_variant_identifier import GeneVariantIdentifier
+from lib.sharding import ShardRunner, run_shard, load_shard, merge_shards
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m lib.sharding')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    plan = commands.add_parser('plan', help='print the chromosomes of each shard, one shard per line')
+    plan.add_argument('pool_root')
+    plan.add_argument('--shards', type=int, default=None)
+
+    run = commands.add_parser('run', help='import & analyse one shard, writing an intermediate result file')
+    run.add_argument('pool_root')
+    run.add_argument('--chromosomes', required=True, help='comma separated, as printed by plan')
+    run.add_argument('--out', required=True)
+
+    merge = commands.add_parser('merge', help='assemble shard result files & export the workbook')
+    merge.add_argument('pool_root')
+    merge.add_argument('shard_files', nargs='+')
+
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        for chromosomes in ShardRunner(args.pool_root, shards=args.shards).plan():
+            print(','.join(chromosomes))
+    elif args.command == 'run':
+        print(run_shard(args.pool_root, args.chromosomes.split(','), args.out))
+    elif args.command == 'merge':
+        gvi = GeneVariantIdentifier(args.pool_root)
+        dfs = merge_shards((load_shard(shard_file) for shard_file in args.shard_files), top=gvi.summary_top)
+        print(gvi.exporter.export(dfs))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,14 @@
+import os
+import functools
 import pandas as pd
 
 
+def file_signature(filename):
+    """ Cheap change detection without reading the file """
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
 def reset_categorical_index(df):
     # just a straight reset_index does not work with
     # CategoricalIndexes so we have to do it ourselves
@@ -31,3 +39,26 @@ def df_append(df1, df2, merge_categories=False, **kwargs):
                     c2.cat.set_categories(new_cats, inplace=True)
 
     return df1.append(df2, **kwargs)
+
+
+def df_concat(frames, **kwargs):
+    """ Concatenate all at once retaining category dtypes, merging categories like df_append does pairwise """
+    frames = [df for df in frames if df is not None]
+
+    if not frames:
+        return None
+
+    categories = {}
+    for col in frames[0].columns:
+        if all(col in df and df[col].dtype.name == 'category' for df in frames):
+            all_categories = [df[col].cat.categories for df in frames]
+            if any(set(cats) != set(all_categories[0]) for cats in all_categories[1:]):
+                categories[col] = functools.reduce(lambda a, b: a.union(b), all_categories)
+
+    if categories:
+        frames = [
+            df.assign(**{col: df[col].cat.set_categories(cats) for col, cats in categories.items()})
+            for df in frames
+        ]
+
+    return pd.concat(frames, **kwargs)
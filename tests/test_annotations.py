@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+from lib.annotations import IntervalAnnotation
+
+
+def brute_force(intervals, chromo, pos):
+    """ The latest starting interval covering the position, as IntervalAnnotation picks """
+    covering = [
+        (start, i) for i, (c, start, end, _) in enumerate(intervals)
+        if c == chromo and start <= pos <= end
+    ]
+    return intervals[max(covering)[1]][3] if covering else None
+
+
+def write_bed(path, intervals):
+    with open(path, 'w') as file:
+        for chromo, start, end, name in intervals:
+            file.write(f'{chromo}\t{start - 1}\t{end}\t{name}\n')
+
+
+def test_lookup_matches_brute_force_with_nested_intervals(tmp_path):
+    rng = np.random.RandomState(0)
+    intervals = []
+    for i in range(300):
+        chromo = ['chr1', 'chr2'][i % 2]
+        start = int(rng.randint(1, 10000))
+        # a few long spans covering many shorter ones
+        length = int(rng.randint(1, 8000 if i % 25 == 0 else 200))
+        intervals.append((chromo, start, start + length, f'g{i}'))
+
+    # unique starts, so the latest starting interval is well defined
+    starts = {}
+    intervals = [starts.setdefault((c, s), (c, s, e, n)) for c, s, e, n in intervals if (c, s) not in starts]
+
+    path = str(tmp_path / 'genes.bed')
+    write_bed(path, intervals)
+
+    chromos = np.array(['chr1', '2', 'Chr1', 'chr3'] * 500)
+    positions = rng.randint(1, 20000, len(chromos))
+
+    annotation = IntervalAnnotation(path)
+    hits = annotation.lookup(chromos, positions)
+    names = [annotation.index['names'][hit] if hit >= 0 else None for hit in hits]
+
+    expected = [brute_force(intervals, 'chr' + chromo.lower().replace('chr', ''), pos)
+                for chromo, pos in zip(chromos, positions)]
+
+    assert len(annotation.index['skips']) > 2
+    assert names == expected
+
+
+def test_annotate_fills_missing_values_only(tmp_path):
+    path = str(tmp_path / 'genes.bed')
+    write_bed(path, [('chr1', 100, 200, 'GENE_A'), ('chr1', 150, 160, 'GENE_B')])
+
+    df = pd.DataFrame({
+        'chromo': ['chr1', 'chr1', 'chr1', 'chr1'],
+        'pos': [120, 155, 500, 130],
+        'gene_id': [None, '', None, 'KNOWN']
+    })
+
+    df = IntervalAnnotation(path).annotate(df)
+
+    assert df['gene_id'].tolist() == ['GENE_A', 'GENE_B', None, 'KNOWN']
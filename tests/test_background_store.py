@@ -0,0 +1,90 @@
+import os
+import numpy as np
+import pytest
+
+from lib.background_store import BackgroundStore, MAX_POS
+
+
+def add(store, positions, source):
+    return store.add(['chr1'] * len(positions), positions, ['A>T'] * len(positions), source=source)
+
+
+def test_contains_added_sites(tmp_path):
+    store = BackgroundStore(str(tmp_path))
+    add(store, [10, 20, 30], 'a')
+
+    found = store.contains(['chr1', 'chr1', 'chr2', 'chr1'], [20, 21, 20, 30])
+
+    assert found.tolist() == [True, False, False, True]
+
+
+def test_adds_after_compaction_keep_compacted_sites(tmp_path):
+    store = BackgroundStore(str(tmp_path))
+    add(store, [1, 2, 3], 'a')
+    add(store, [4, 5, 6], 'a')
+    store.compact()
+    add(store, [7], 'b')
+    add(store, [8], 'c')
+
+    store = BackgroundStore(str(tmp_path))
+    segment_files = [entry['segment'] for entry in store.manifest]
+
+    assert len(segment_files) == len(set(segment_files)) == 3
+    assert sorted(segment_files + ['chromosomes.json', 'manifest.json']) == sorted(os.listdir(str(tmp_path)))
+    assert store.contains(['chr1'] * 8, list(range(1, 9))).all()
+
+
+def test_compact_merges_per_source(tmp_path):
+    store = BackgroundStore(str(tmp_path))
+    add(store, [1, 2], 'a')
+    add(store, [2, 3], 'a')
+    add(store, [2, 9], 'b')
+    store.compact()
+
+    assert sorted((entry['source'], entry['sites']) for entry in store.manifest) == [('a', 3), ('b', 2)]
+    assert store.contains(['chr1'] * 3, [1, 2, 3], exclude_source='b').all()
+
+
+def test_adds_compact_once_a_source_has_enough_segments(tmp_path):
+    store = BackgroundStore(str(tmp_path), compact_segments=3)
+    add(store, [1], 'a')
+    add(store, [2], 'a')
+    add(store, [3], 'b')
+
+    assert len(store.manifest) == 3
+
+    add(store, [4], 'a')
+
+    store = BackgroundStore(str(tmp_path))
+
+    assert sorted((entry['source'], entry['sites']) for entry in store.manifest) == [('a', 3), ('b', 1)]
+    assert len(os.listdir(str(tmp_path))) == 4
+    assert store.contains(['chr1'] * 4, [1, 2, 3, 4]).all()
+
+
+def test_excludes_own_source(tmp_path):
+    store = BackgroundStore(str(tmp_path))
+    add(store, [10, 20], '/projects/a')
+    add(store, [20, 30], '/projects/b')
+
+    found = store.contains(['chr1'] * 3, [10, 20, 30], exclude_source='/projects/a')
+
+    assert found.tolist() == [False, True, True]
+
+
+def test_rejects_positions_outside_the_key(tmp_path):
+    store = BackgroundStore(str(tmp_path))
+
+    with pytest.raises(RuntimeError):
+        add(store, [MAX_POS], 'a')
+
+    with pytest.raises(RuntimeError):
+        store.contains(['chr1'], [-1])
+
+
+def test_rejects_too_many_chromosomes(tmp_path):
+    store = BackgroundStore(str(tmp_path))
+    chromos = [f'contig{i}' for i in range(1 << 16)] + ['one_more']
+
+    with pytest.raises(RuntimeError):
+        store.add(chromos, np.ones(len(chromos), dtype=np.int64), ['A>T'] * len(chromos), source='a')
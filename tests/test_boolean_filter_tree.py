@@ -0,0 +1,175 @@
+import re
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.filters import BooleanFilterTree
+from lib.filters import boolean_filter_tree as bft
+
+RULES = [
+    {'name': 'coding', 'exclude': {'column': 'effect', 'eq': 'INTRON'}},
+    {'name': 'quality', 'include': {'or': [{'column': 'qual', 'ge': 20}, {'column': 'effect', 'eq': 'STOP'}]}}
+]
+
+
+def frame():
+    return pd.DataFrame({
+        'effect': ['INTRON', 'MISSENSE', 'STOP', 'MISSENSE', 'INTRON', 'STOP'],
+        'qual': [50, 10, 5, 30, 10, 40]
+    })
+
+
+def test_worker_counts_merge_into_the_parent(tmp_path):
+    parent = BooleanFilterTree(RULES, stats_file=str(tmp_path / 'stats.yaml'), adaptive=True)
+    local = BooleanFilterTree(RULES, stats_file=str(tmp_path / 'local.yaml'), adaptive=True)
+
+    for _ in range(2):
+        # as an import worker process gets it
+        worker = pickle.loads(pickle.dumps(parent))
+        worker.reset_counts()
+        worker.apply(frame())
+        parent.merge_counts(pickle.loads(pickle.dumps(worker.counts())))
+
+        local.apply(frame())
+
+    assert parent.rows == local.rows == 12
+    assert parent.removed == local.removed == {'coding': 4, 'quality': 2}
+    assert {key: (stats['rows'], stats['kept']) for key, stats in parent.stats.items()} == \
+        {key: (stats['rows'], stats['kept']) for key, stats in local.stats.items()}
+    assert parent.describe_removed() == local.describe_removed()
+
+
+# leaf functions of each rule keyword, as included & as excluded
+LEAVES = {
+    'eq': (bft._eq, bft._ne),
+    'ne': (bft._ne, bft._eq),
+    'gt': (bft._gt, bft._le),
+    'lt': (bft._lt, bft._ge),
+    'ge': (bft._ge, bft._lt),
+    'le': (bft._le, bft._gt),
+    'startswith': (bft._sw, bft._not_sw),
+    'endswith': (bft._ew, bft._not_ew),
+    'matches': (bft._matches, bft._doesnt_match)
+}
+
+
+def random_sites_frame(rng, rows=200, sites=40):
+    """ Per-sample rows of a few sites, so site level rules are deduplicated & sample level ones aren't """
+    site = rng.randint(0, sites, rows)
+    effects = np.array(['INTRON', 'MISSENSE', 'STOP', 'SYNONYMOUS', None], dtype=object)
+    genes = np.array([f'AT1G0{i}' for i in range(6)] + [np.nan], dtype=object)
+    site_qual = np.where(rng.rand(sites) < 0.1, np.nan, rng.randint(0, 60, sites).astype(float))
+
+    df = pd.DataFrame({
+        'effect': pd.Categorical(effects[rng.randint(0, len(effects), sites)][site]),
+        'gene_id': genes[rng.randint(0, len(genes), sites)][site],
+        'qual': site_qual[site],
+        'depth': rng.randint(0, 5, sites)[site],
+        'sample': pd.Categorical(rng.choice(['S1', 'S2', 'S3'], rows)),
+        'pool': pd.Categorical(rng.choice(['pool1', 'pool2'], rows))
+    })
+    # labels out of order, as after earlier filtering & concatenation
+    df.index = rng.permutation(rows) * 3
+    return df
+
+
+def random_leaf(rng):
+    column, op, value = [
+        ('effect', 'eq', 'INTRON'), ('effect', 'ne', 'STOP'), ('effect', 'startswith', 'S'),
+        ('gene_id', 'endswith', '3'), ('gene_id', 'matches', r'AT1G0[0-2]'), ('gene_id', 'eq', 'nan'),
+        ('qual', 'ge', 20.0), ('qual', 'lt', 40.0), ('depth', 'gt', 1), ('depth', 'le', 3),
+        ('sample', 'eq', 'S2'), ('pool', 'ne', 'pool1'), ('sample', 'endswith', '3')
+    ][rng.randint(0, 13)]
+    return {'column': column, op: value}
+
+
+def random_rule(rng, depth=0):
+    if depth >= 2 or rng.rand() < 0.4:
+        return random_leaf(rng)
+    return {rng.choice(['and', 'or']): [random_rule(rng, depth + 1) for _ in range(rng.randint(3, 6))]}
+
+
+def random_rules(rng):
+    rules = []
+    for i in range(rng.randint(1, 5)):
+        if rng.rand() < 0.5:
+            # an exclude only inverts a leaf, see BooleanFilterTree.parse_rule
+            rules.append({'name': f'rule{i}', 'exclude': random_leaf(rng)})
+        else:
+            rules.append({'name': f'rule{i}', 'include': random_rule(rng)})
+    return rules
+
+
+def verdicts(rule, df, invert=False):
+    """ Each row's verdict, every child evaluated on every row in config order & combined one row at a time """
+    if 'and' in rule:
+        return [all(row) for row in zip(*(verdicts(child, df) for child in rule['and']))]
+    if 'or' in rule:
+        return [any(row) for row in zip(*(verdicts(child, df) for child in rule['or']))]
+    op = next(key for key in rule if key != 'column')
+    value = re.compile(rule[op]) if op == 'matches' else rule[op]
+    return LEAVES[op][invert](rule['column'], value, df).tolist()
+
+
+def row_by_row(rules, df):
+    rows = zip(*(verdicts(rule.get('include', rule.get('exclude')), df, 'exclude' in rule) for rule in rules))
+    return df[np.array([all(row) for row in rows], dtype=bool)]
+
+
+def shuffled_stats(tree, rng, stats_file):
+    """ Stats recorded by a run, with made up selectivity & cost so the next run orders the rules differently """
+    tree.apply(random_sites_frame(rng))
+    for stats in tree.stats.values():
+        stats['kept'] = int(rng.randint(0, stats['rows'] + 1))
+        stats['seconds'] = float(rng.rand())
+    tree.save_stats()
+    return BooleanFilterTree(tree.config, stats_file=stats_file, adaptive=True)
+
+
+@pytest.mark.parametrize('seed', range(30))
+@pytest.mark.parametrize('adaptive', [False, True])
+@pytest.mark.parametrize('inplace', [False, True])
+def test_apply_matches_row_by_row_evaluation(tmp_path, seed, adaptive, inplace):
+    rng = np.random.RandomState(seed)
+    rules = random_rules(rng)
+    df = random_sites_frame(rng)
+
+    tree = BooleanFilterTree(rules, stats_file=str(tmp_path / 'stats.yaml'), adaptive=adaptive)
+    if adaptive:
+        tree = shuffled_stats(tree, rng, str(tmp_path / 'stats.yaml'))
+
+    expected = row_by_row(rules, df)
+
+    if inplace:
+        got = df.copy()
+        assert tree.apply(got, inplace=True) is None
+    else:
+        got = tree.apply(df)
+
+    pd.testing.assert_frame_equal(got, expected)
+    assert tree.rows == len(df)
+    assert sum(tree.removed.values()) == len(df) - len(expected)
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_deduplicated_rules_match_every_row(seed):
+    rng = np.random.RandomState(seed)
+    df = random_sites_frame(rng)
+    tree = BooleanFilterTree([{'name': f'rule{i}', 'include': random_rule(rng)} for i in range(5)])
+
+    codes = {}
+    for rule in tree.rules:
+        rows = []
+
+        def counted(frame, rule=rule):
+            rows.append(len(frame))
+            return rule(frame)
+        counted.__rule_columns__ = rule.__rule_columns__
+
+        got = BooleanFilterTree._deduplicated(counted, df, codes)
+
+        pd.testing.assert_series_equal(got, rule(df), check_names=False)
+        if not rule.__rule_columns__ & {'sample', 'pool'}:
+            # once per site rather than once per sample
+            assert rows[0] <= 40
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib import columns as c
+from lib.membership import Membership
+
+
+def merged_hit_columns(df):
+    """ The groupby & inner merge chain Membership replaced """
+    for title, intersect, count_by in [
+        (c.background, [c.chromo, c.pos], c.pool),
+        (c.cand_pos, [c.pool, c.chromo, c.pos], c.sample),
+        (c.cand_gene, [c.gene_id], c.sample)
+    ]:
+        df = df.merge(
+            (df.groupby(intersect)[count_by].agg('nunique') - 1).to_frame(name=title),
+            left_on=intersect,
+            right_on=intersect,
+            how='inner'
+        )
+    return df
+
+
+def random_frame(rng, rows):
+    pools = rng.choice(['pool1', 'pool2', 'pool3'], rows)
+    return pd.DataFrame({
+        c.chromo: pd.Categorical(rng.choice(['chr1', 'chr2', 'chr3'], rows)),
+        c.pos: rng.randint(1, 40, rows).astype(np.uint64),
+        c.gene_id: rng.choice([f'AT1G0{i}' for i in range(8)], rows),
+        c.pool: pd.Categorical(pools),
+        # sample names repeat across pools, like S1 of two different pools
+        c.sample: pd.Categorical([
+            f'{pool}_S{i}' if i % 2 else f'S{i}' for pool, i in zip(pools, rng.randint(0, 5, rows))
+        ]),
+        c.qual: rng.rand(rows)
+    })
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_the_merge_chain(seed):
+    rng = np.random.RandomState(seed)
+    df = random_frame(rng, int(rng.randint(1, 300)))
+
+    expected = merged_hit_columns(df)
+    got = Membership(df).add_hit_columns(df)
+
+    pd.testing.assert_frame_equal(got, expected, check_dtype=False, check_categorical=False)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rows_without_a_site_or_gene_are_dropped(seed):
+    df = random_frame(np.random.RandomState(seed), 200)
+    df.loc[::7, c.gene_id] = np.nan
+    df.loc[3::11, c.chromo] = np.nan
+
+    expected = merged_hit_columns(df)
+    got = Membership(df).add_hit_columns(df)
+
+    assert len(got) == len(expected) == (df[c.gene_id].notna() & df[c.chromo].notna()).sum()
+    pd.testing.assert_frame_equal(got, expected, check_dtype=False, check_categorical=False)
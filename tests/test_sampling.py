@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.sampling import SiteSampler
+from lib.importers import snp_eff_importer
+from lib.importers.snp_eff_importer import SnpEffImporter, ENGINES
+
+
+def random_sites(n=5000, seed=0):
+    rng = np.random.RandomState(seed)
+    chromos = pd.Categorical(rng.choice(['chr1', 'chr2', 'Chr3', '4'], n))
+    positions = rng.randint(1, 10 ** 7, n).astype(np.uint64)
+    return chromos, positions
+
+
+def test_mask_matches_keep():
+    chromos, positions = random_sites()
+    sampler = SiteSampler(fraction=0.3, chromosomes=['chr1', 'chr3', 'chr4'], seed=5)
+
+    mask = sampler.mask(chromos, positions)
+
+    assert mask.tolist() == [sampler.keep(chromo, int(pos)) for chromo, pos in zip(chromos, positions)]
+    assert sampler.counts() == (len(mask), int(mask.sum()))
+
+
+def test_sites_are_deterministic_by_seed():
+    chromos, positions = random_sites()
+
+    first = SiteSampler(fraction=0.2, seed=1).mask(chromos, positions)
+
+    assert (SiteSampler(fraction=0.2, seed=1).mask(chromos, positions) == first).all()
+    assert (SiteSampler(fraction=0.2, seed=2).mask(chromos, positions) != first).any()
+
+
+def test_fraction_is_roughly_kept():
+    chromos, positions = random_sites(n=20000)
+
+    mask = SiteSampler(fraction=0.1).mask(chromos, positions)
+
+    assert mask.mean() == pytest.approx(0.1, abs=0.02)
+
+
+def test_chromosomes_whatever_their_prefix():
+    chromos, positions = random_sites()
+
+    mask = SiteSampler(chromosomes=['Chr2', '3']).mask(chromos, positions)
+
+    assert mask.tolist() == [chromo in ('chr2', 'Chr3') for chromo in chromos]
+
+
+def write_snpeff(path, rng, rows=3000, newline='\n'):
+    lines = ['# Chromo\tPosition\tReference\tChange']
+    for i in range(rows):
+        chromo = rng.choice(['chr1', 'Chr2', 'scaffold_000123456', 'chrUn_a_longer_name'])
+        # a comment may end a row part way
+        lines.append(f'{chromo}\t{rng.randint(1, 10 ** 9)}\tA\tT' + ('#note' if i % 97 == 0 else ''))
+        if i % 50 == 0:
+            lines.append(['', '   ', '# a comment\tline', ' \r'][i // 50 % 4])
+    with open(path, 'w', newline='') as file:
+        file.write(newline.join(lines))
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('newline', ['\n', '\r\n'])
+@pytest.mark.parametrize('block_size', [997, snp_eff_importer.BLOCK_SIZE])
+def test_snpeff_preview_parses_only_the_sampled_rows(tmp_path, monkeypatch, engine, newline, block_size):
+    monkeypatch.setattr(snp_eff_importer, 'BLOCK_SIZE', block_size)
+    path = str(tmp_path / 'S1.snpeff')
+    write_snpeff(path, np.random.RandomState(7), newline=newline)
+
+    chromosomes = ['chr1', 'scaffold_000123456', 'chrUn_a_longer_name']
+
+    sampler = SiteSampler(fraction=0.25, seed=3)
+    df = SnpEffImporter(sampler=sampler, chromosomes=chromosomes, engine=engine).read_snp_txt(path)
+
+    full = SnpEffImporter(chromosomes=chromosomes).read_snp_txt(path)
+    expected = full[SiteSampler(fraction=0.25, seed=3).mask(full['chromo'].values, full['pos'].values)]
+
+    assert sampler.counts() == (len(full), len(expected))
+    pd.testing.assert_frame_equal(
+        df.astype(str), expected.reset_index(drop=True).astype(str), check_categorical=False
+    )
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+
+from lib.scheduler import write_frame, read_frame
+
+
+def test_frames_round_trip_through_scratch_files(tmp_path):
+    df = pd.DataFrame({
+        'chromo': pd.Categorical(['chr1', 'chr2', 'chr1', None]),
+        'pos': np.array([10, 20, 30, 40], dtype=np.int64),
+        'qual': [1.5, np.nan, 3.0, 4.0],
+        'effect': ['MISSENSE', 'MISSENSE', None, 'MISSENSE'],
+        'hgvs': ['p.A1V', 'p.A2V', 'p.A3V', None]
+    })
+
+    manifest = write_frame(df, str(tmp_path))
+    mapped = read_frame(manifest)
+
+    pd.testing.assert_frame_equal(mapped, df)
+    assert [encoding for *_, encoding in manifest['columns']] == ['category', None, None, 'object', None]
+
+
+def test_numeric_columns_stay_mapped(tmp_path):
+    df = pd.DataFrame({'pos': np.arange(100, dtype=np.int64), 'qual': np.linspace(0, 1, 100)})
+
+    mapped = read_frame(write_frame(df, str(tmp_path)))
+
+    assert all(isinstance(mapped[col].values.base, np.memmap) or isinstance(mapped[col].values, np.memmap)
+               for col in df.columns)
+
+
+def test_missing_frames_pass_through(tmp_path):
+    assert write_frame(None, str(tmp_path)) is None
+    assert read_frame(None) is None
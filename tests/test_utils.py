@@ -0,0 +1,27 @@
+import functools
+import pandas as pd
+
+from lib import utils
+
+
+def frames():
+    return [
+        pd.DataFrame({'chromo': pd.Categorical(['chr2', 'chr1']), 'pos': [1, 2]}),
+        pd.DataFrame({'chromo': pd.Categorical(['chr1', 'chr1']), 'pos': [3, 4]}),
+        pd.DataFrame({'chromo': pd.Categorical(['chr10', 'chr3']), 'pos': [5, 6]})
+    ]
+
+
+def test_df_concat_matches_pairwise_append():
+    appended = functools.reduce(
+        lambda a, b: utils.df_append(a, b, merge_categories=True, ignore_index=True), frames()
+    )
+    concatenated = utils.df_concat(frames(), ignore_index=True)
+
+    pd.testing.assert_frame_equal(concatenated, appended)
+    assert concatenated['chromo'].dtype.name == 'category'
+
+
+def test_df_concat_skips_missing_frames():
+    assert utils.df_concat([None, None]) is None
+    assert len(utils.df_concat([None, *frames()], ignore_index=True)) == 6